@@ -0,0 +1,105 @@
+"""
+Benchmark for rendering the trajectories of :mod:`~opendrift_leeway_webgui.simulation`.
+
+Draws synthetic trajectories for different numbers of particles without the basemap and
+measures the time for plotting and saving the figure. Requires OpenDrift and cartopy, e.g. run
+it inside the ``opendrift-leeway-custom`` container or a virtual environment with both installed:
+
+python3 benchmarks/plotting.py --particles 100 1000 10000
+"""
+
+import argparse
+import importlib.util
+import io
+import json
+import time
+from pathlib import Path
+
+import cartopy.crs as ccrs
+import matplotlib
+import matplotlib.pyplot as plt
+import numpy as np
+
+#: The standalone simulation script, loaded by its path because the container does not contain the Django project
+SIMULATION_SCRIPT = Path(__file__).resolve().parents[1] / "opendrift_leeway_webgui" / "simulation.py"
+
+matplotlib.use("Agg")
+
+
+def load_simulation():
+    """
+    Load the simulation script as a module without importing the Django project
+
+    :return: The simulation module
+    """
+    spec = importlib.util.spec_from_file_location("simulation", SIMULATION_SCRIPT)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def synthetic_trajectories(particles, steps, seed=0):
+    """
+    Generate random walks around Lampedusa, a fifth of the particles gets stranded halfway
+
+    :param particles: Number of particles
+    :param steps: Number of time steps
+    :param seed: Seed of the random number generator
+    :return: Longitudes and latitudes of shape (particles, steps)
+    """
+    rng = np.random.default_rng(seed)
+    lon = 12.6 + np.cumsum(rng.normal(0.002, 0.003, (particles, steps)), axis=1)
+    lat = 35.4 + np.cumsum(rng.normal(0.001, 0.003, (particles, steps)), axis=1)
+    stranded = rng.random(particles) < 0.2
+    lon[stranded, steps // 2 :] = np.nan
+    lat[stranded, steps // 2 :] = np.nan
+    return lon, lat
+
+
+def benchmark(simulation, particles, duration):
+    """
+    Measure plotting and saving a figure with the given number of particles
+
+    :param simulation: The loaded simulation module
+    :param particles: Number of particles
+    :param duration: Duration of the simulation in hours (one position per hour)
+    :return: The measured times in seconds
+    """
+    lon, lat = synthetic_trajectories(particles, duration + 1)
+    crs = ccrs.Mercator()
+    gcrs = ccrs.PlateCarree(globe=crs.globe)
+    fig = plt.figure(figsize=(8, 8))
+    ax = plt.axes(projection=crs)
+    start = time.perf_counter()
+    simulation.plot_trajectories(ax, lon, lat, duration, gcrs)
+    plotted = time.perf_counter()
+    ax.set_extent([np.nanmin(lon), np.nanmax(lon), np.nanmin(lat), np.nanmax(lat)])
+    fig.savefig(io.BytesIO(), format="png")
+    saved = time.perf_counter()
+    plt.close(fig)
+    return {"particles": particles, "plot": plotted - start, "savefig": saved - plotted, "total": saved - start}
+
+
+def main():
+    """
+    Run the benchmark for all requested particle numbers
+    """
+    parser = argparse.ArgumentParser(description="Benchmark trajectory plotting")
+    parser.add_argument("--particles", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--duration", help="Simulated hours", type=int, default=12)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    simulation = load_simulation()
+    results = []
+    for particles in args.particles:
+        result = benchmark(simulation, particles, args.duration)
+        print("{particles:>6} particles: plot {plot:.3f}s, savefig {savefig:.3f}s, total {total:.3f}s".format(**result))
+        results.append(result)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""
+Offline benchmark for the simulation script :mod:`~opendrift_leeway_webgui.simulation`.
+
+Generates synthetic current and wind fields around Lampedusa in a temporary simulation root and runs
+``simulation.py --no-web`` without basemap for every combination of the given drifter numbers, durations
+and object types. The wall time, the timing of the phases, the peak memory usage and the sizes of the
+result files are written as JSON, which can be compared with the results of another version. Requires
+OpenDrift, e.g. run it inside the ``opendrift-leeway-custom`` container or a virtual environment with
+OpenDrift installed. No network access is needed:
+
+python3 benchmarks/simulation.py --particles 100 1000 --durations 6 24 --output results.json
+python3 benchmarks/simulation.py --output new.json --compare results.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import xarray as xr
+
+#: The simulation script which is benchmarked
+SIMULATION_SCRIPT = Path(__file__).resolve().parents[1] / "opendrift_leeway_webgui" / "simulation.py"
+
+#: Start of the synthetic forcing
+FORCING_START = datetime(2026, 1, 1)
+
+#: Start position of the drifters, south-west of Lampedusa, so some of them strand
+START_POSITION = (12.45, 35.45)
+
+#: Prefix of the timing record in the output of the simulation script
+TIMING_PREFIX = "TIMING "
+
+
+def synthetic_field(lon, lat, hours, mean, amplitude, standard_names, seed):
+    """
+    Generate a velocity field with a mean flow, a slowly rotating eddy and random noise
+
+    :param lon: Longitudes of the grid
+    :param lat: Latitudes of the grid
+    :param hours: Number of hourly time steps
+    :param mean: Mean velocity (east, north) in m/s
+    :param amplitude: Velocity of the eddy in m/s
+    :param standard_names: CF standard names of the east and north components
+    :param seed: Seed of the random number generator
+    :return: The field as dataset
+    """
+    rng = np.random.default_rng(seed)
+    times = np.arange(hours)[:, None, None]
+    x = np.radians(lon)[None, None, :] * 20
+    y = np.radians(lat)[None, :, None] * 20
+    phase = 2 * np.pi * times / 12.42  # semi-diurnal tidal period
+    shape = (hours, len(lat), len(lon))
+    u = mean[0] + amplitude * np.sin(y + phase) * np.cos(x) + rng.normal(0, amplitude / 10, shape)
+    v = mean[1] - amplitude * np.cos(y + phase) * np.sin(x) + rng.normal(0, amplitude / 10, shape)
+    return xr.Dataset(
+        {
+            name: (
+                ("time", "lat", "lon"),
+                values.astype(np.float32),
+                {"standard_name": standard_name, "units": "m s-1"},
+            )
+            for name, values, standard_name in zip(("u", "v"), (u, v), standard_names)
+        },
+        coords={
+            "time": [FORCING_START + timedelta(hours=hour) for hour in range(hours)],
+            "lat": ("lat", lat, {"standard_name": "latitude", "units": "degrees_north"}),
+            "lon": ("lon", lon, {"standard_name": "longitude", "units": "degrees_east"}),
+        },
+    )
+
+
+def write_forcing(input_dir, hours):
+    """
+    Write synthetic currents and winds to the input directory
+
+    :param input_dir: The input directory of the simulation root
+    :param hours: Number of hourly time steps
+    """
+    input_dir.mkdir(parents=True, exist_ok=True)
+    currents = synthetic_field(
+        np.arange(10, 15.01, 0.05),
+        np.arange(33, 37.01, 0.05),
+        hours,
+        mean=(0.2, 0.05),
+        amplitude=0.3,
+        standard_names=("x_sea_water_velocity", "y_sea_water_velocity"),
+        seed=0,
+    )
+    currents.to_netcdf(input_dir / "currents.nc")
+    winds = synthetic_field(
+        np.arange(10, 15.01, 0.25),
+        np.arange(33, 37.01, 0.25),
+        hours,
+        mean=(4, 2),
+        amplitude=3,
+        standard_names=("x_wind", "y_wind"),
+        seed=1,
+    )
+    winds.to_netcdf(input_dir / "wind.nc")
+
+
+def run_simulation(root, python, particles, duration, object_type, extra_arguments):
+    """
+    Run the simulation script once and collect its measurements
+
+    :param root: The simulation root with the synthetic forcing
+    :param python: The Python interpreter which runs the script
+    :param particles: Number of drifters
+    :param duration: Duration in hours
+    :param object_type: The Leeway object type
+    :param extra_arguments: Further arguments of the simulation script
+    :return: The measurements
+    """
+    simulation_id = f"benchmark-{particles}-{duration}-{object_type}"
+    command = [
+        python,
+        str(SIMULATION_SCRIPT),
+        "--no-web",
+        "--wms-url",
+        "",
+        "--longitude",
+        str(START_POSITION[0]),
+        "--latitude",
+        str(START_POSITION[1]),
+        "--start-time",
+        (FORCING_START + timedelta(hours=1)).strftime("%Y-%m-%d %H:%M"),
+        "--duration",
+        str(duration),
+        "--number",
+        str(particles),
+        "--object-type",
+        str(object_type),
+        "--id",
+        simulation_id,
+        *extra_arguments,
+    ]
+    start = time.perf_counter()
+    process = subprocess.run(
+        command,
+        capture_output=True,
+        text=True,
+        env={**os.environ, "SIMULATION_ROOT": str(root)},
+        check=False,
+    )
+    wall_time = time.perf_counter() - start
+    if process.returncode:
+        raise RuntimeError(f"Simulation failed with exit code {process.returncode}:\n{process.stderr}")
+    timing = next(
+        (
+            json.loads(line.removeprefix(TIMING_PREFIX))
+            for line in reversed(process.stdout.splitlines())
+            if line.startswith(TIMING_PREFIX)
+        ),
+        {},
+    )
+    output_dir = root / "output"
+    sizes = {}
+    for extension in ("nc", "geojson", "png"):
+        path = output_dir / f"{simulation_id}.{extension}"
+        if path.is_file():
+            sizes[extension] = path.stat().st_size
+            path.unlink()
+    return {
+        "particles": particles,
+        "duration": duration,
+        "object_type": object_type,
+        "wall_time": round(wall_time, 3),
+        "phases": timing.get("phases", {}),
+        "peak_rss_mb": timing.get("peak_rss_mb"),
+        "sizes": sizes,
+    }
+
+
+def environment(python):
+    """
+    Describe the benchmarked version and the machine
+
+    :param python: The Python interpreter which runs the script
+    """
+    opendrift_version = subprocess.run(
+        [python, "-c", "import opendrift; print(opendrift.__version__)"],
+        capture_output=True,
+        text=True,
+        check=False,
+    ).stdout.strip()
+    commit = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        capture_output=True,
+        text=True,
+        cwd=SIMULATION_SCRIPT.parent,
+        check=False,
+    ).stdout.strip()
+    return {
+        "commit": commit or None,
+        "opendrift": opendrift_version or None,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def compare(results, baseline):
+    """
+    Print the change of the wall time and the peak memory usage relative to a previous run
+
+    :param results: The results of this run
+    :param baseline: The results of the previous run
+    """
+    key = ("particles", "duration", "object_type")
+    previous = {tuple(result[field] for field in key): result for result in baseline["results"]}
+    print(f"Compared to {baseline['environment'].get('commit') or 'baseline'}:")
+    for result in results:
+        other = previous.get(tuple(result[field] for field in key))
+        if other is None:
+            continue
+        changes = []
+        for field in ("wall_time", "peak_rss_mb"):
+            if result[field] and other[field]:
+                changes.append(f"{field} {(result[field] / other[field] - 1) * 100:+.1f}%")
+        print(
+            "{particles:>6} particles, {duration:>3}h, object type {object_type:>3}: ".format(**result),
+            ", ".join(changes),
+        )
+
+
+def main():
+    """
+    Run the benchmark for all combinations of the requested parameters
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the simulation script with synthetic forcing")
+    parser.add_argument("--particles", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument("--durations", help="Simulated hours", type=int, nargs="+", default=[6, 24])
+    parser.add_argument("--object-types", type=int, nargs="+", default=[27, 1])
+    parser.add_argument("--repeat", help="Number of runs of every combination", type=int, default=1)
+    parser.add_argument("--python", help="Python interpreter with OpenDrift", default=sys.executable)
+    parser.add_argument("--root", help="Simulation root for the forcing and results. Default: Temporary directory")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="JSON file of a previous run to compare the results with")
+    parser.add_argument(
+        "simulation_arguments",
+        help="Further arguments of the simulation script, after --",
+        nargs=argparse.REMAINDER,
+    )
+    args = parser.parse_args()
+    extra_arguments = [argument for argument in args.simulation_arguments if argument != "--"]
+
+    with tempfile.TemporaryDirectory(prefix="leeway-benchmark-") as temporary:
+        root = Path(args.root or temporary)
+        (root / "output").mkdir(parents=True, exist_ok=True)
+        write_forcing(root / "input", max(args.durations) + 3)
+
+        results = []
+        for particles, duration, object_type, _ in itertools.product(
+            args.particles, args.durations, args.object_types, range(args.repeat)
+        ):
+            result = run_simulation(root, args.python, particles, duration, object_type, extra_arguments)
+            print(
+                "{particles:>6} particles, {duration:>3}h, object type {object_type:>3}: "
+                "{wall_time:.2f}s, {peak_rss_mb} MiB".format(**result)
+            )
+            results.append(result)
+
+    report = {"environment": environment(args.python), "results": results}
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fp:
+            json.dump(report, fp, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as fp:
+            compare(results, json.load(fp))
+
+
+if __name__ == "__main__":
+    main()
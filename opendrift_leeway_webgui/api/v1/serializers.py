@@ -1,7 +1,7 @@
 from rest_framework import serializers
 
 from ...leeway.models import LeewaySimulation
-from ...leeway.tasks import run_leeway_simulation
+from ...leeway.tasks import start_simulation
 
 
 class LeewaySimulationSerializer(serializers.ModelSerializer):
@@ -19,6 +19,12 @@ class LeewaySimulationSerializer(serializers.ModelSerializer):
     #: True once simulation_finished is set
     completed = serializers.SerializerMethodField()
 
+    #: Expose the model's status property (queued, running, cancelled, failed or finished)
+    status = serializers.ReadOnlyField()
+
+    #: Expose the model's progress property (current phase and steps while running)
+    progress = serializers.ReadOnlyField()
+
     def get_completed(self, obj):
         """
         :param obj: The simulation instance
@@ -54,14 +60,65 @@ class LeewaySimulationSerializer(serializers.ModelSerializer):
             "img",
             "netcdf",
             "geojson",
+            "profile",
             "traceback",
+            "timing",
             "simulation_started",
             "simulation_finished",
+            "simulation_cancelled",
             "error",
             "completed",
+            "status",
+            "progress",
         ]
 
+    def validate_profiling(self, value):
+        """
+        Only staff may run simulations under the profiler
+
+        :param value: Whether the simulation is profiled
+        :type value: bool
+        :rtype: bool
+        """
+        if value and not self.context["request"].user.is_staff:
+            raise serializers.ValidationError("Only staff can profile simulations.")
+        return value
+
     def create(self, validated_data):
-        simulation = LeewaySimulation.objects.create(**validated_data)
-        run_leeway_simulation.apply_async([simulation.uuid])
+        simulation = LeewaySimulation.objects.create(**validated_data, source="api")
+        start_simulation(simulation)
         return simulation
+
+
+class LeewaySimulationStatusSerializer(serializers.ModelSerializer):
+    """
+    Lightweight serializer for polling the status and the live progress of a simulation
+    """
+
+    #: Expose the model's status property (queued, running, cancelled, failed or finished)
+    status = serializers.ReadOnlyField()
+
+    #: Expose the model's progress property (current phase and steps while running)
+    progress = serializers.ReadOnlyField()
+
+    #: Expose the model's error property (last line of traceback)
+    error = serializers.ReadOnlyField()
+
+    class Meta:
+        """
+        Define model and the corresponding fields
+        """
+
+        #: The model class for this serializer
+        model = LeewaySimulation
+
+        #: Only the fields which change while the simulation is pending
+        fields = [
+            "uuid",
+            "status",
+            "progress",
+            "error",
+            "simulation_started",
+            "simulation_finished",
+            "simulation_cancelled",
+        ]
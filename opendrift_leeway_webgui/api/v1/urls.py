@@ -19,6 +19,7 @@ router.register("simulations", views.LeewaySimulationViewSet, "simulations")
 urlpatterns = [
     path("", include(router.urls)),
     path("auth/", include("knox.urls")),
+    path("queues/", views.QueueDepthView.as_view(), name="queues"),
     path("schema/", SpectacularAPIView.as_view(), name="schema"),
     path(
         "docs/",
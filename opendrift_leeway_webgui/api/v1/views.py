@@ -1,7 +1,14 @@
-from rest_framework import mixins, viewsets
-from rest_framework.permissions import IsAuthenticated
+from django.conf import settings
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import extend_schema
+from rest_framework import mixins, status, viewsets
+from rest_framework.decorators import action
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.views import APIView
 
-from .serializers import LeewaySimulationSerializer
+from ...leeway.tasks import cancel_simulation, queue_depths
+from .serializers import LeewaySimulationSerializer, LeewaySimulationStatusSerializer
 
 
 # pylint: disable=too-many-ancestors
@@ -17,6 +24,8 @@ class LeewaySimulationViewSet(
     - Create new simulations
     - List all existing simulations
     - Retrieve a single simulation record
+    - Poll the status and progress of a single simulation
+    - Cancel a queued or running simulation
     """
 
     #: Only enable this viewset for authenticated users
@@ -39,3 +48,43 @@ class LeewaySimulationViewSet(
         Automatically set the user field on creation
         """
         serializer.save(user=self.request.user)
+
+    @action(detail=True, serializer_class=LeewaySimulationStatusSerializer)
+    def status(self, request, uuid=None):  # pylint: disable=unused-argument
+        """
+        Return only the status (``queued``, ``running``, ``cancelled``, ``failed`` or ``finished``) and the live
+        progress of a simulation. While it is queued or running, the ``Retry-After`` header tells clients how many
+        seconds to wait before polling again.
+        """
+        simulation = self.get_object()
+        response = Response(self.get_serializer(simulation).data)
+        if simulation.status in ("queued", "running"):
+            response["Retry-After"] = str(settings.SIMULATION_STATUS_RETRY_AFTER)
+        return response
+
+    @action(detail=True, methods=["post"], serializer_class=LeewaySimulationStatusSerializer)
+    def cancel(self, request, uuid=None):  # pylint: disable=unused-argument
+        """
+        Cancel a queued or running simulation. Finished simulations can't be cancelled.
+        """
+        simulation = self.get_object()
+        if not cancel_simulation(simulation):
+            return Response({"detail": "The simulation is already finished."}, status=status.HTTP_409_CONFLICT)
+        return Response(self.get_serializer(simulation).data)
+
+
+class QueueDepthView(APIView):
+    """
+    A view for staff users which shows the number of tasks waiting in each Celery queue
+    (see :setting:`CELERY_TASK_QUEUES`)
+    """
+
+    #: Only enable this view for staff users
+    permission_classes = (IsAdminUser,)
+
+    @extend_schema(responses=OpenApiTypes.OBJECT)
+    def get(self, request):  # pylint: disable=unused-argument
+        """
+        Return the number of waiting tasks by queue name
+        """
+        return Response(queue_depths())
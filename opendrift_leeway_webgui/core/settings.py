@@ -12,6 +12,7 @@ import os
 from pathlib import Path
 
 from django.core.exceptions import ImproperlyConfigured
+from kombu import Queue
 
 from .logging_formatter import ColorFormatter, RequestFormatter
 from .utils import strtobool
@@ -29,6 +30,109 @@ SIMULATION_SCRIPT_PATH = BASE_DIR / "simulation.py"
 #: Number of drifters simulated
 OPENDRIFT_NUMBER_DRIFTERS = int(os.environ.get("LEEWAY_OPENDRIFT_NUMBER_DRIFTERS", 100))
 
+#: Maximum plausible drift speed in m/s. The forcing data is cropped to the area reachable at this speed.
+OPENDRIFT_MAX_DRIFT_SPEED = float(os.environ.get("LEEWAY_OPENDRIFT_MAX_DRIFT_SPEED", 3.0))
+
+#: Time step of the model calculation in minutes
+OPENDRIFT_TIME_STEP = int(os.environ.get("LEEWAY_OPENDRIFT_TIME_STEP", 10))
+
+#: Interval in minutes in which the particle positions are written to the results
+OPENDRIFT_EXPORT_TIME_STEP = int(os.environ.get("LEEWAY_OPENDRIFT_EXPORT_TIME_STEP", 10))
+
+#: Compression of the NetCDF results (``zlib``, ``zstd``, ... or ``none``) and its level
+NETCDF_COMPRESSION = os.environ.get("LEEWAY_NETCDF_COMPRESSION", "zlib")
+NETCDF_COMPRESSION_LEVEL = int(os.environ.get("LEEWAY_NETCDF_COMPRESSION_LEVEL", 4))
+
+#: Storage precision of the floating point variables of the NetCDF results (``float32`` or ``float64``)
+NETCDF_PRECISION = os.environ.get("LEEWAY_NETCDF_PRECISION", "float32")
+
+#: Number of decimal places of the coordinates in the GeoJSON results (5 decimal places are about 1 m)
+GEOJSON_PRECISION = int(os.environ.get("LEEWAY_GEOJSON_PRECISION", 5))
+
+#: WMS and layer of the basemap of the result images. The tiles are cached in ``SIMULATION_ROOT/wms-cache``.
+BASEMAP_WMS_URL = os.environ.get("LEEWAY_BASEMAP_WMS_URL", "https://sgx.geodatenzentrum.de/wms_topplus_open")
+BASEMAP_WMS_LAYER = os.environ.get("LEEWAY_BASEMAP_WMS_LAYER", "web")
+
+#: How simulations are run: ``docker`` starts a new container for every simulation, ``worker`` hands them to the
+#: long-lived simulation worker (``simulation.py --serve``) which has all dependencies and the landmask preloaded,
+#: ``process`` runs them in the Celery worker process, which requires OpenDrift in its environment, and ``fake``
+#: only writes canned results for load tests (see :mod:`~opendrift_leeway_webgui.leeway.runners`)
+SIMULATION_RUNNER = os.environ.get("LEEWAY_SIMULATION_RUNNER", "docker")
+
+#: Seconds after the last heartbeat of the simulation worker after which its jobs fail, because it is not running
+SIMULATION_WORKER_TIMEOUT = int(os.environ.get("LEEWAY_SIMULATION_WORKER_TIMEOUT", 60))
+
+#: Seconds the ``fake`` runner waits before writing its results
+SIMULATION_FAKE_DELAY = float(os.environ.get("LEEWAY_SIMULATION_FAKE_DELAY", 0))
+
+#: Number of lines of stdout and stderr of a simulation run which are kept after they were logged, the tail of stderr
+#: is stored as traceback of failed simulations
+SIMULATION_OUTPUT_TAIL = int(os.environ.get("LEEWAY_SIMULATION_OUTPUT_TAIL", 200))
+
+#: CPU cores per simulation process. The docker containers of simulations are limited to this number of cores for each
+#: of their processes (``0`` disables the limit) and the concurrency of the Celery workers is derived from it.
+SIMULATION_CPUS = float(os.environ.get("LEEWAY_SIMULATION_CPUS", 1))
+
+#: Memory in MiB per simulation process, mostly for the landmask and the forcing data. The docker containers of
+#: simulations are limited to this memory for each of their processes plus :setting:`SIMULATION_MEMORY_PER_DRIFTER_HOUR`
+#: (``0`` disables the limit) and the concurrency of the Celery workers is derived from it.
+SIMULATION_MEMORY = int(os.environ.get("LEEWAY_SIMULATION_MEMORY", 3072))
+
+#: Additional memory in MiB per simulated drifter and hour
+SIMULATION_MEMORY_PER_DRIFTER_HOUR = float(os.environ.get("LEEWAY_SIMULATION_MEMORY_PER_DRIFTER_HOUR", 0.01))
+
+#: Memory in MiB of the host which is reserved for other services, e.g. the web application and Redis
+SIMULATION_RESERVED_MEMORY = int(os.environ.get("LEEWAY_SIMULATION_RESERVED_MEMORY", 1024))
+
+#: Number of processes used for the members of ensemble simulations
+SIMULATION_ENSEMBLE_WORKERS = int(os.environ.get("LEEWAY_SIMULATION_ENSEMBLE_WORKERS", 2))
+
+#: Maximum number of ensemble simulations which run at the same time. The Celery workers reserve the cores and memory
+#: of their additional processes (see :setting:`SIMULATION_ENSEMBLE_WORKERS`), while all other simulations only take
+#: one process. Further ensemble simulations wait in the queue. ``0`` disables the limit and the reservation.
+SIMULATION_MAX_RUNNING_ENSEMBLES = int(os.environ.get("LEEWAY_SIMULATION_MAX_RUNNING_ENSEMBLES", 1))
+
+#: Whether pending simulations which are close in space and time are run together in one OpenDrift run, so the
+#: forcing data is only loaded once
+SIMULATION_BATCHING = bool(strtobool(os.environ.get("LEEWAY_SIMULATION_BATCHING", "False")))
+
+#: Maximum difference of the start times in hours for simulations to be batched
+SIMULATION_BATCH_TIME_WINDOW = int(os.environ.get("LEEWAY_SIMULATION_BATCH_TIME_WINDOW", 6))
+
+#: Maximum distance of the start positions in kilometers for simulations to be batched
+SIMULATION_BATCH_DISTANCE = float(os.environ.get("LEEWAY_SIMULATION_BATCH_DISTANCE", 50))
+
+#: Maximum number of simulations in one batch
+SIMULATION_BATCH_SIZE = int(os.environ.get("LEEWAY_SIMULATION_BATCH_SIZE", 10))
+
+#: Whether the GeoJSON and PNG files are rendered from the NetCDF file in a separate task after the simulation,
+#: so the simulation runs don't wait on the map rendering
+SIMULATION_RENDER_STAGE = bool(strtobool(os.environ.get("LEEWAY_SIMULATION_RENDER_STAGE", "False")))
+
+#: The Celery queue of the render tasks, e.g. to process them with a separate worker
+SIMULATION_RENDER_QUEUE = os.environ.get("LEEWAY_SIMULATION_RENDER_QUEUE", "celery")
+
+#: The Celery queues of simulations by their source: The web form is used for live cases, mail in the field with
+#: low bandwidth, the API and the admin for bulk jobs. The queues are consumed in the order of
+#: :setting:`CELERY_TASK_QUEUES`.
+SIMULATION_TASK_QUEUES = {
+    "web": os.environ.get("LEEWAY_SIMULATION_TASK_QUEUE_WEB", "interactive"),
+    "mail": os.environ.get("LEEWAY_SIMULATION_TASK_QUEUE_MAIL", "mail"),
+    "api": os.environ.get("LEEWAY_SIMULATION_TASK_QUEUE_API", "bulk"),
+}
+SIMULATION_TASK_QUEUES["admin"] = SIMULATION_TASK_QUEUES["api"]
+
+#: The Celery queue of the downloads of the ICON weather data, so a long download doesn't delay simulations
+ICON_DOWNLOAD_QUEUE = os.environ.get("LEEWAY_ICON_DOWNLOAD_QUEUE", "downloads")
+
+#: Maximum number of simulations of one user which run at the same time, so one client can't starve the others.
+#: Further simulations of the user wait in the queue. ``0`` disables the limit.
+SIMULATION_MAX_RUNNING_PER_USER = int(os.environ.get("LEEWAY_SIMULATION_MAX_RUNNING_PER_USER", 2))
+
+#: Seconds after which a simulation which is held back by :setting:`SIMULATION_MAX_RUNNING_PER_USER` or
+#: :setting:`SIMULATION_MAX_RUNNING_ENSEMBLES` is tried again
+SIMULATION_USER_RETRY_DELAY = int(os.environ.get("LEEWAY_SIMULATION_USER_RETRY_DELAY", 30))
+
 
 ########################
 # DJANGO CORE SETTINGS #
@@ -178,12 +282,29 @@ SIMULATION_ROOT = os.environ.get("LEEWAY_SIMULATION_ROOT", os.path.join(BASE_DIR
 #: The output path of simulation results
 SIMULATION_OUTPUT = os.path.join(SIMULATION_ROOT, "output")
 
-#: The path where ICON weather data is stored
-ICON_DATA_PATH = os.path.join(SIMULATION_ROOT, "input", "ICON_EU_120.nc")
+#: The directory where jobs for the long-lived simulation worker are queued
+SIMULATION_QUEUE = os.path.join(SIMULATION_ROOT, "queue")
+
+#: The directory where ICON weather data is stored, one NetCDF file per time step
+ICON_DATA_PATH = os.path.join(SIMULATION_ROOT, "input", "ICON_EU_120")
 
 #: Maximum number of workers for ICON data download
 ICON_MAX_WORKERS = int(os.environ.get("LEEWAY_ICON_MAX_WORKERS", 4))
 
+#: Regions of interest to which the ICON data is cropped, as ``name:lon_min,lon_max,lat_min,lat_max`` separated by
+#: semicolons. Each region is stored in its own subdirectory of :setting:`ICON_DATA_PATH`. Without regions, the
+#: whole ICON-EU domain is stored.
+ICON_REGIONS = {
+    name.strip(): tuple(float(bound) for bound in bounds.split(","))
+    for name, bounds in (
+        region.split(":") for region in os.environ.get("LEEWAY_ICON_REGIONS", "").split(";") if region.strip()
+    )
+}
+
+#: Storage type of the ICON wind components: ``int16`` packs them with a resolution of 0.01 m/s, ``float32`` keeps
+#: them unchanged. They are compressed like the NetCDF results (see :setting:`NETCDF_COMPRESSION`).
+ICON_ENCODING = os.environ.get("LEEWAY_ICON_ENCODING", "int16")
+
 #: Number of days for keeping simulations and results.
 SIMULATION_RETENTION = int(os.environ.get("LEEWAY_SIMULATION_RETENTION", 7))
 
@@ -265,6 +386,26 @@ LOGGING = {
 }
 
 
+###########
+# CACHING #
+###########
+
+#: The caches (see :setting:`django:CACHES`). The ``progress`` cache holds the live progress of running simulations
+#: and must be shared by the web application and the Celery workers, the ``default`` cache is Django's local one.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "progress": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.environ.get("LEEWAY_CACHE_URL", "redis://localhost:6379/1"),
+    },
+}
+
+#: Seconds which API clients are asked to wait before polling the status of a pending simulation again
+SIMULATION_STATUS_RETRY_AFTER = int(os.environ.get("LEEWAY_SIMULATION_STATUS_RETRY_AFTER", 10))
+
+
 ##########
 # CELERY #
 ##########
@@ -281,6 +422,11 @@ CELERY_TIMEZONE = "UTC"
 #: and there’s a need to report what task is currently running.
 CELERY_TASK_TRACK_STARTED = True
 
+#: Number of tasks a Celery worker runs at the same time, unless given with ``--concurrency``. With ``0``, the worker
+#: derives it on startup from the number of simulations which fit on the host (see :setting:`SIMULATION_CPUS`,
+#: :setting:`SIMULATION_MEMORY` and :setting:`SIMULATION_MAX_RUNNING_ENSEMBLES`).
+CELERY_WORKER_CONCURRENCY = int(os.environ.get("LEEWAY_CELERY_WORKER_CONCURRENCY", 0))
+
 #: Task hard time limit in seconds. The worker processing the task will be killed
 #: and replaced with a new one when this is exceeded.
 CELERY_TASK_TIME_LIMIT = 30 * 60
@@ -291,6 +437,30 @@ CELERY_BROKER_URL = "redis://localhost:6379/0"
 #: The backend used to store task results (tombstones). Disabled by default.
 CELERY_RESULT_BACKEND = "redis://localhost:6379/0"
 
+#: The queues consumed by workers started without ``-Q``, from the highest to the lowest priority: live cases from the
+#: web form, mail, the default queue (e.g. webhooks), rendering, bulk simulations and downloads
+CELERY_TASK_QUEUES = [
+    Queue(name)
+    for name in dict.fromkeys(
+        [
+            SIMULATION_TASK_QUEUES["web"],
+            SIMULATION_TASK_QUEUES["mail"],
+            "celery",
+            SIMULATION_RENDER_QUEUE,
+            SIMULATION_TASK_QUEUES["api"],
+            ICON_DOWNLOAD_QUEUE,
+        ]
+    )
+]
+
+#: Consume the queues strictly in the order of :setting:`CELERY_TASK_QUEUES` instead of round robin
+CELERY_BROKER_TRANSPORT_OPTIONS = {"queue_order_strategy": "priority"}
+
+#: Route the downloads of weather data to their own queue
+CELERY_TASK_ROUTES = {
+    "opendrift_leeway_webgui.leeway.tasks.download_icon_weather_data": {"queue": ICON_DOWNLOAD_QUEUE},
+}
+
 
 #############################
 # DJANGO REST API FRAMEWORK #
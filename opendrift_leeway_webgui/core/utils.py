@@ -2,6 +2,8 @@
 Utilities for the opendrift leeway webgui core application
 """
 
+import os
+
 BOOLEAN_MAP = {
     "y": True,
     "yes": True,
@@ -26,3 +28,61 @@ def strtobool(value):
         return BOOLEAN_MAP[str(value).lower()]
     except KeyError as exc:
         raise ValueError(f'"{value}" is not a valid bool value') from exc
+
+
+def read_cgroup_limit(name):
+    """
+    Read a limit of the cgroup (v2) of this process, e.g. of the container it runs in
+
+    :param name: The name of the cgroup file, e.g. ``memory.max``
+    :return: The fields of the limit or ``None`` if there is no limit
+    :rtype: list[str] | None
+    """
+    try:
+        with open(f"/sys/fs/cgroup/{name}", encoding="utf-8") as fp:
+            fields = fp.read().split()
+    except OSError:
+        return None
+    return None if not fields or fields[0] == "max" else fields
+
+
+def host_cpus():
+    """
+    The number of CPU cores available to this process, taking the CPU affinity and cgroup quota into account
+    """
+    cpus = float(len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1)
+    if quota := read_cgroup_limit("cpu.max"):
+        cpus = min(cpus, int(quota[0]) / int(quota[1]))
+    return cpus
+
+
+def host_memory():
+    """
+    The memory in MiB available to this process, taking the cgroup limit into account
+    """
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    if limit := read_cgroup_limit("memory.max"):
+        memory = min(memory, int(limit[0]))
+    return memory // 2**20
+
+
+def host_concurrency(cpus_per_process, memory_per_process, reserved_memory=0, reserved_processes=0):
+    """
+    The number of simulations which fit on this host at the same time without competing for cores or memory
+
+    :param cpus_per_process: CPU cores per simulation process, ``0`` if the cores are not limited
+    :param memory_per_process: Memory per simulation process in MiB, ``0`` if the memory is not limited
+    :param reserved_memory: Memory in MiB which is reserved for other services of the host
+    :param reserved_processes: Number of simulation processes which are kept free, e.g. for the additional
+                               processes of ensemble simulations
+    :return: The concurrency, at least one. If neither the cores nor the memory are limited, one simulation per core.
+    :rtype: int
+    """
+    bounds = []
+    if cpus_per_process:
+        bounds.append(host_cpus() // cpus_per_process)
+    if memory_per_process:
+        bounds.append((host_memory() - reserved_memory) // memory_per_process)
+    if not bounds:
+        bounds.append(host_cpus())
+    return max(int(min(bounds)) - reserved_processes, 1)
@@ -1,9 +1,90 @@
+from django.conf import settings
 from django.contrib import admin
 from django.utils.html import format_html
 
 from .models import InvitationToken, LeewaySimulation
+from .tasks import render_leeway_simulation, start_simulation
 
-admin.site.register(LeewaySimulation)
+
+@admin.register(LeewaySimulation)
+class LeewaySimulationAdmin(admin.ModelAdmin):
+    """
+    Admin interface for Leeway simulations, showing the timing of the simulation runs.
+    Slow simulations can be run again under the profiler and the results of finished
+    simulations can be rendered again from their NetCDF files.
+    """
+
+    #: Columns shown in the changelist
+    list_display = (
+        "__str__",
+        "simulation_started",
+        "simulation_finished",
+        "total_time",
+        "peak_memory",
+    )
+
+    #: The timing and the profile are recorded by the simulation run
+    readonly_fields = ("timing", "profile")
+
+    #: Actions available in the changelist
+    actions = ("run_profiled_copy", "render_again")
+
+    @admin.action(description="Run a copy of the selected simulations with profiling")
+    def run_profiled_copy(self, request, queryset):
+        """
+        Run copies of the selected simulations under the profiler. The copies belong to
+        the requesting staff member, so the original users are not notified again.
+        """
+        for simulation in queryset:
+            copy = LeewaySimulation.objects.create(
+                name=f"Profile of {simulation.name or simulation.uuid}",
+                user=request.user,
+                longitude=simulation.longitude,
+                latitude=simulation.latitude,
+                start_time=simulation.start_time,
+                duration=simulation.duration,
+                object_type=simulation.object_type,
+                radius=simulation.radius,
+                ensemble_members=simulation.ensemble_members,
+                outputs=simulation.outputs,
+                profiling=True,
+                source="admin",
+            )
+            start_simulation(copy)
+        self.message_user(request, f"Started {queryset.count()} profiled simulation(s).")
+
+    @admin.action(description="Render the results of the selected simulations again")
+    def render_again(self, request, queryset):
+        """
+        Render the GeoJSON and PNG files of finished simulations from their NetCDF files
+        without notifying the users
+        """
+        renderable = queryset.exclude(netcdf="").exclude(netcdf__isnull=True).exclude(outputs="nc")
+        for simulation in renderable:
+            render_leeway_simulation.apply_async([simulation.uuid, False], queue=settings.SIMULATION_RENDER_QUEUE)
+        self.message_user(
+            request,
+            f"Rendering {renderable.count()} of {queryset.count()} simulation(s), "
+            "the others have no NetCDF file or no rendered results.",
+        )
+
+    @admin.display(description="Total time (s)")
+    def total_time(self, obj):
+        """
+        The duration of the simulation run, including the separate render stage
+        """
+        if not obj.timing:
+            return None
+        return round(obj.timing.get("total", 0) + (obj.timing.get("render") or {}).get("total", 0), 3)
+
+    @admin.display(description="Peak memory (MiB)")
+    def peak_memory(self, obj):
+        """
+        The peak resident set size of the simulation run, including the separate render stage
+        """
+        if not obj.timing:
+            return None
+        return max(obj.timing.get("peak_rss_mb") or 0, (obj.timing.get("render") or {}).get("peak_rss_mb") or 0)
 
 
 @admin.register(InvitationToken)
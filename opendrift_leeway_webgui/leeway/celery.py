@@ -10,8 +10,11 @@ from imaplib import IMAP4_SSL
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "opendrift_leeway_webgui.core.settings")
 
 from celery import Celery
+from celery.signals import worker_init
 from django.conf import settings
 
+from opendrift_leeway_webgui.core.utils import host_concurrency
+
 from .utils import mail_to_simulation
 
 app = Celery("leeway")
@@ -26,6 +29,24 @@ for section in config.sections():
         os.environ.setdefault(f"LEEWAY_{KEY.upper()}", VALUE)
 
 
+@worker_init.connect
+def configure_concurrency(sender, **kwargs):  # pylint: disable=unused-argument
+    """
+    Derive the concurrency of a starting worker from the cores and memory of the host, unless it is configured
+    with ``--concurrency`` or :setting:`CELERY_WORKER_CONCURRENCY`. This only runs in workers, so the web
+    application doesn't inspect the host on startup. The signal is sent before the pool is created, so the pool
+    is started with the derived concurrency.
+    """
+    if not sender.options.get("concurrency") and not sender.app.conf.worker_concurrency:
+        sender.concurrency = host_concurrency(
+            settings.SIMULATION_CPUS,
+            settings.SIMULATION_MEMORY,
+            settings.SIMULATION_RESERVED_MEMORY,
+            # Ordinary simulations run in one process, the additional processes of ensembles are kept free
+            settings.SIMULATION_MAX_RUNNING_ENSEMBLES * max(settings.SIMULATION_ENSEMBLE_WORKERS - 1, 0),
+        )
+
+
 @app.on_after_configure.connect
 def setup_periodic_tasks(sender, **kwargs):
     """
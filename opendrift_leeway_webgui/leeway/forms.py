@@ -134,6 +134,7 @@ class LeewaySimulationForm(ModelForm):
             "start_time",
             "duration",
             "radius",
+            "ensemble_members",
         ]
         help_texts = {
             "duration": "Length of simulation in hours.",
@@ -141,6 +142,19 @@ class LeewaySimulationForm(ModelForm):
             "start_time": "All times are UTC. Only simulations +/- 5 days from now are possible.",
         }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Submissions without an ensemble size (e.g. older clients) run a single simulation
+        self.fields["ensemble_members"].required = False
+
+    def clean_ensemble_members(self):
+        """
+        Default to a single member if the field was left empty.
+
+        :rtype: int
+        """
+        return self.cleaned_data.get("ensemble_members") or 1
+
     def _clean_coordinate(self, prefix, max_deg):
         """
         Assemble and validate a coordinate from its sub-fields.
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:38
+
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("leeway", "0013_iconfiles"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="leewaysimulation",
+            name="ensemble_members",
+            field=models.PositiveSmallIntegerField(
+                default=1,
+                help_text=(
+                    "Number of perturbed simulations (start time, position, radius and forcing source) "
+                    "which are run in parallel and merged into one result."
+                ),
+                validators=[django.core.validators.MinValueValidator(1), django.core.validators.MaxValueValidator(32)],
+                verbose_name="Ensemble members",
+            ),
+        ),
+    ]
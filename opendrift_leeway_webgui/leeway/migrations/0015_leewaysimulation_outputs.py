@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:47
+
+from django.db import migrations, models
+
+import opendrift_leeway_webgui.leeway.models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("leeway", "0014_leewaysimulation_ensemble_members"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="leewaysimulation",
+            name="outputs",
+            field=models.CharField(
+                default="nc,geojson,png",
+                help_text=(
+                    "Comma separated list of the result files (nc, geojson, png). "
+                    "Files which are not requested are not generated, which makes the simulation faster."
+                ),
+                max_length=32,
+                validators=[opendrift_leeway_webgui.leeway.models.validate_outputs],
+                verbose_name="Outputs",
+            ),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("leeway", "0015_leewaysimulation_outputs"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="leewaysimulation",
+            name="timing",
+            field=models.JSONField(
+                blank=True,
+                help_text="Seconds spent in the phases of the simulation run and its peak memory usage in MiB.",
+                null=True,
+                verbose_name="Timing",
+            ),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.18 on 2026-10-18 14:51
+
+from django.db import migrations, models
+
+import opendrift_leeway_webgui.leeway.models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("leeway", "0016_leewaysimulation_timing"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="leewaysimulation",
+            name="profile",
+            field=models.FileField(
+                blank=True,
+                null=True,
+                storage=opendrift_leeway_webgui.leeway.models.simulation_storage,
+                upload_to="",
+                verbose_name="Profile",
+            ),
+        ),
+        migrations.AddField(
+            model_name="leewaysimulation",
+            name="profiling",
+            field=models.BooleanField(
+                default=False,
+                help_text="Run the simulation under a profiler. The profile can only be downloaded by staff.",
+                verbose_name="Profiling",
+            ),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("leeway", "0017_leewaysimulation_profiling"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="leewaysimulation",
+            name="simulation_cancelled",
+            field=models.DateTimeField(blank=True, null=True, verbose_name="Simulation cancelled"),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("leeway", "0018_leewaysimulation_simulation_cancelled"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="leewaysimulation",
+            name="source",
+            field=models.CharField(
+                choices=[("web", "Web form"), ("mail", "Mail"), ("api", "API"), ("admin", "Admin")],
+                default="web",
+                editable=False,
+                max_length=8,
+                verbose_name="Source",
+            ),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("leeway", "0019_leewaysimulation_source"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="iconfiles",
+            name="modified",
+            field=models.DateTimeField(
+                blank=True, null=True, verbose_name="Modification time in the directory listing"
+            ),
+        ),
+        migrations.AddField(
+            model_name="iconfiles",
+            name="size",
+            field=models.PositiveBigIntegerField(blank=True, null=True, verbose_name="Size in the directory listing"),
+        ),
+    ]
@@ -3,12 +3,15 @@ from datetime import datetime
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.exceptions import ValidationError
 from django.core.files.storage import FileSystemStorage
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from django.utils.crypto import get_random_string
 from django.utils.translation import gettext_lazy as _
 
-from .utils import LEEWAY_OBJECT_TYPES
+from .progress import get_progress
+from .utils import LEEWAY_OBJECT_TYPES, MAX_ENSEMBLE_MEMBERS
 
 
 def simulation_storage():
@@ -18,6 +21,35 @@ def simulation_storage():
     return FileSystemStorage(location=settings.SIMULATION_OUTPUT, base_url=settings.SIMULATION_URL)
 
 
+#: The result files which can be requested for a simulation
+SIMULATION_OUTPUTS = ["nc", "geojson", "png"]
+
+
+#: The ways of submitting simulations, which determine their Celery queue (see :setting:`SIMULATION_TASK_QUEUES`)
+SIMULATION_SOURCES = [
+    ("web", _("Web form")),
+    ("mail", _("Mail")),
+    ("api", _("API")),
+    ("admin", _("Admin")),
+]
+
+
+def validate_outputs(value):
+    """
+    Validate a comma separated list of requested result files
+
+    :param value: The requested result files
+    :type value: str
+    :raises ~django.core.exceptions.ValidationError: If the list is empty or contains unknown files
+    """
+    outputs = [output.strip() for output in value.split(",")]
+    if not all(outputs) or not set(outputs).issubset(SIMULATION_OUTPUTS):
+        raise ValidationError(
+            _("Enter a comma separated list of %(outputs)s."),
+            params={"outputs": ", ".join(SIMULATION_OUTPUTS)},
+        )
+
+
 class LeewaySimulation(models.Model):
     """
     Required information for simulation run
@@ -33,7 +65,34 @@ class LeewaySimulation(models.Model):
     object_type = models.IntegerField(choices=LEEWAY_OBJECT_TYPES, default=27)
     simulation_started = models.DateTimeField(null=True)
     simulation_finished = models.DateTimeField(null=True)
+    simulation_cancelled = models.DateTimeField(null=True, blank=True, verbose_name=_("Simulation cancelled"))
     radius = models.IntegerField(default=1000)
+    source = models.CharField(
+        max_length=8,
+        choices=SIMULATION_SOURCES,
+        default="web",
+        editable=False,
+        verbose_name=_("Source"),
+    )
+    ensemble_members = models.PositiveSmallIntegerField(
+        default=1,
+        validators=[MinValueValidator(1), MaxValueValidator(MAX_ENSEMBLE_MEMBERS)],
+        verbose_name=_("Ensemble members"),
+        help_text=_(
+            "Number of perturbed simulations (start time, position, radius and forcing source) "
+            "which are run in parallel and merged into one result."
+        ),
+    )
+    outputs = models.CharField(
+        max_length=32,
+        default=",".join(SIMULATION_OUTPUTS),
+        validators=[validate_outputs],
+        verbose_name=_("Outputs"),
+        help_text=_(
+            "Comma separated list of the result files (nc, geojson, png). "
+            "Files which are not requested are not generated, which makes the simulation faster."
+        ),
+    )
     img = models.FileField(null=True, storage=simulation_storage, verbose_name=_("Image file"))
     netcdf = models.FileField(null=True, storage=simulation_storage, verbose_name=_("NetCDF file"))
     geojson = models.FileField(
@@ -41,7 +100,24 @@ class LeewaySimulation(models.Model):
         storage=simulation_storage,
         verbose_name=_("GeoJSON of simulated trajectories"),
     )
+    profiling = models.BooleanField(
+        default=False,
+        verbose_name=_("Profiling"),
+        help_text=_("Run the simulation under a profiler. The profile can only be downloaded by staff."),
+    )
+    profile = models.FileField(null=True, blank=True, storage=simulation_storage, verbose_name=_("Profile"))
     traceback = models.TextField(blank=True, verbose_name=_("traceback"))
+    timing = models.JSONField(
+        null=True,
+        blank=True,
+        verbose_name=_("Timing"),
+        help_text=_("Seconds spent in the phases of the simulation run and its peak memory usage in MiB."),
+    )
+
+    def save(self, *args, **kwargs):
+        # The outputs are compared as comma separated names without whitespace (see :func:`validate_outputs`)
+        self.outputs = ",".join(output.strip() for output in self.outputs.split(","))
+        super().save(*args, **kwargs)
 
     @property
     def error(self):
@@ -50,6 +126,25 @@ class LeewaySimulation(models.Model):
         """
         return self.traceback.splitlines()[-1] if self.traceback else None
 
+    @property
+    def status(self):
+        """
+        The state of the simulation: ``queued``, ``running``, ``cancelled``, ``failed`` or ``finished``
+        """
+        if self.simulation_cancelled:
+            return "cancelled"
+        if self.simulation_finished:
+            return "failed" if self.traceback else "finished"
+        return "running" if self.simulation_started else "queued"
+
+    @property
+    def progress(self):
+        """
+        The current phase and the completed and total steps of the phase while the simulation is running
+        (see :mod:`~opendrift_leeway_webgui.leeway.progress`)
+        """
+        return get_progress(self.uuid) if self.status == "running" else None
+
     def __str__(self):
         # pylint: disable=no-member
         return f"{self.name or self.uuid} {self.user.email}"
@@ -124,4 +219,6 @@ class IconFiles(models.Model):
 
     frt = models.CharField(max_length=2, verbose_name=_("Forecast time"))
     file_name = models.CharField(max_length=127, verbose_name=_("File name of downloaded file"))
+    size = models.PositiveBigIntegerField(null=True, blank=True, verbose_name=_("Size in the directory listing"))
+    modified = models.DateTimeField(null=True, blank=True, verbose_name=_("Modification time in the directory listing"))
     download_date = models.DateTimeField(auto_now_add=True)
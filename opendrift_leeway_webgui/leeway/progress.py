@@ -0,0 +1,86 @@
+"""
+Live progress of running simulations.
+
+``simulation.py`` prints its progress as lines of JSON with the prefix :data:`PROGRESS_PREFIX`. The runners
+pass them to :func:`set_progress` while the simulation is running, which stores them in the ``progress`` cache
+(see :setting:`django:CACHES`), so the web application and the API can read them without a database query.
+"""
+
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+#: Prefix of the lines with the progress in the output of ``simulation.py``
+PROGRESS_PREFIX = "PROGRESS "
+
+
+def progress_key(uuid):
+    """
+    The cache key of the progress of a simulation
+
+    :param uuid: The UUID of the simulation
+    """
+    return f"leeway:progress:{uuid}"
+
+
+def parse_progress(line):
+    """
+    Extract the progress from a line of the output of ``simulation.py``
+
+    :param line: A line of stdout
+    :return: The current phase and the completed and total steps of the phase, if the line contains the progress
+    :rtype: dict | None
+    """
+    if not line.startswith(PROGRESS_PREFIX):
+        return None
+    try:
+        return json.loads(line.removeprefix(PROGRESS_PREFIX))
+    except ValueError:
+        logger.warning("Invalid progress record: %s", line)
+        return None
+
+
+def set_progress(uuid, progress):
+    """
+    Publish the progress of a running simulation. It expires after :setting:`CELERY_TASK_TIME_LIMIT`,
+    so the progress of simulations whose worker was killed doesn't remain forever.
+    Errors of the cache are only logged, because the progress is not worth failing the simulation for.
+
+    :param uuid: The UUID of the simulation
+    :param progress: The progress (see :func:`parse_progress`)
+    """
+    try:
+        caches["progress"].set(progress_key(uuid), progress, timeout=settings.CELERY_TASK_TIME_LIMIT)
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        logger.debug("Could not publish the progress of simulation %s: %s", uuid, exc)
+
+
+def get_progress(uuid):
+    """
+    Get the progress of a running simulation
+
+    :param uuid: The UUID of the simulation
+    :return: The progress (see :func:`parse_progress`) or ``None`` if no progress was published
+    :rtype: dict | None
+    """
+    try:
+        return caches["progress"].get(progress_key(uuid))
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        logger.debug("Could not get the progress of simulation %s: %s", uuid, exc)
+        return None
+
+
+def clear_progress(uuid):
+    """
+    Remove the progress of a simulation once it is finished
+
+    :param uuid: The UUID of the simulation
+    """
+    try:
+        caches["progress"].delete(progress_key(uuid))
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        logger.debug("Could not clear the progress of simulation %s: %s", uuid, exc)
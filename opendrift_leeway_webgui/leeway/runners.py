@@ -0,0 +1,524 @@
+"""
+The ways of running ``simulation.py`` (see :setting:`SIMULATION_RUNNER`).
+
+A runner is a function which takes the id of the simulation job, the command line arguments of
+``simulation.py`` and optionally a callback for the progress of the simulation (see
+:mod:`~opendrift_leeway_webgui.leeway.progress`) and the resource limits of the job (see
+:func:`~opendrift_leeway_webgui.leeway.tasks.resource_limits`), runs the simulation and returns its exit code
+and the tails of its stdout and stderr (see :class:`SimulationOutput`). Only the ``docker`` runner enforces
+the resource limits, the simulation worker is limited as a whole by the options of its container.
+"""
+
+import base64
+import collections
+import contextlib
+import functools
+import importlib.util
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import billiard
+import numpy as np
+import xarray as xr
+from django.conf import settings
+
+from .progress import parse_progress
+
+logger = logging.getLogger(__name__)
+
+#: The heartbeat file of the simulation worker in the queue directory
+WORKER_HEARTBEAT = "worker.heartbeat"
+
+#: A transparent PNG image with one pixel, written by :func:`run_fake`
+FAKE_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+)
+
+#: Lines on stderr which don't indicate a failure: Python warnings and log messages of libraries below ERROR
+STDERR_WARNING = re.compile(r":\d+: \w*Warning: |^(DEBUG|INFO|WARNING|WARN)\b|\s-\s(DEBUG|INFO|WARNING)\s-\s")
+
+#: Lines of the output are truncated to this number of characters
+MAX_LINE_LENGTH = 1000
+
+#: Seconds to wait for ``docker kill`` when a simulation is cancelled, so a slow Docker daemon doesn't block the request
+DOCKER_KILL_TIMEOUT = 10
+
+
+class SimulationOutput:
+    """
+    The output of a simulation run, which is logged line by line while the simulation is running.
+    Only the last :setting:`SIMULATION_OUTPUT_TAIL` lines of stdout and stderr are kept, so chatty
+    libraries can't fill up the memory of the Celery worker or the traceback of the simulation.
+    Warnings on stderr (see :data:`STDERR_WARNING`) are logged as warnings and not kept, so the
+    tail of stderr only contains the actual errors. Progress lines on stdout are passed to *on_progress*.
+
+    :param job_id: The id of the simulation job
+    :param on_progress: The function which is called with the progress of the simulation
+    """
+
+    def __init__(self, job_id, on_progress=None):
+        self.job_id = job_id
+        self.on_progress = on_progress
+        self.stdout = collections.deque(maxlen=settings.SIMULATION_OUTPUT_TAIL)
+        self.stderr = collections.deque(maxlen=settings.SIMULATION_OUTPUT_TAIL)
+        self.warnings = 0
+        # Whether the last line on stderr was a warning, so its indented continuation lines are warnings as well
+        self.in_warning = False
+
+    @staticmethod
+    def clean(line):
+        """
+        Strip the line break, keep only the last state of progress bars and truncate long lines
+
+        :param line: A line of the output
+        """
+        return line.rstrip("\r\n").rsplit("\r", 1)[-1][:MAX_LINE_LENGTH]
+
+    def add_stdout(self, line):
+        """
+        Log and keep a line from stdout or pass it on if it contains the progress
+
+        :param line: The line
+        """
+        line = self.clean(line)
+        if (progress := parse_progress(line)) is not None:
+            logger.debug("%s: %s", self.job_id, line, extra={"simulation": self.job_id, "stream": "stdout"})
+            if self.on_progress:
+                self.on_progress(progress)
+            return
+        logger.info("%s: %s", self.job_id, line, extra={"simulation": self.job_id, "stream": "stdout"})
+        self.stdout.append(line)
+
+    def add_stderr(self, line):
+        """
+        Log a line from stderr and keep it unless it is a warning
+
+        :param line: The line
+        """
+        line = self.clean(line)
+        self.in_warning = bool(STDERR_WARNING.search(line)) or (self.in_warning and line[:1].isspace())
+        if self.in_warning:
+            self.warnings += 1
+            logger.warning("%s: %s", self.job_id, line, extra={"simulation": self.job_id, "stream": "stderr"})
+        elif line:
+            logger.error("%s: %s", self.job_id, line, extra={"simulation": self.job_id, "stream": "stderr"})
+            self.stderr.append(line)
+
+    def result(self, exit_code):
+        """
+        The result of the runner
+
+        :param exit_code: The exit code of the simulation
+        :return: The exit code and the tails of stdout and stderr
+        :rtype: tuple[int, str, str]
+        """
+        logger.info(
+            "Simulation job %s finished with exit code %s and %s warning line(s)",
+            self.job_id,
+            exit_code,
+            self.warnings,
+        )
+        return exit_code, "\n".join(self.stdout), "\n".join(self.stderr)
+
+
+class LineWriter(io.TextIOBase):
+    """
+    A text stream which passes every complete line to a callback, to stream redirected output
+
+    :param callback: The function which is called with every line
+    """
+
+    def __init__(self, callback):
+        super().__init__()
+        self.callback = callback
+        self.pending = ""
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        *lines, self.pending = (self.pending + text).split("\n")
+        for line in lines:
+            self.callback(line)
+        return len(text)
+
+    def close(self):
+        if self.pending:
+            self.callback(self.pending)
+            self.pending = ""
+        super().close()
+
+
+def read_lines(stream, callback):
+    """
+    Pass every line of a stream to a callback until the stream is closed
+
+    :param stream: The stream, e.g. a pipe of a subprocess
+    :param callback: The function which is called with every line
+    """
+    for line in stream:
+        callback(line)
+
+
+def follow_file(path, position, callback, final=False):
+    """
+    Pass the lines which were appended to a file since the last call to a callback
+
+    :param path: The file, which may not exist yet
+    :param position: The position in bytes up to which the file was read before
+    :param callback: The function which is called with every line
+    :param final: Whether the file is complete, so a last line without line break is passed as well
+    :return: The new position
+    :rtype: int
+    """
+    if not path.is_file():
+        return position
+    with path.open("rb") as fp:
+        fp.seek(position)
+        while line := fp.readline():
+            if not line.endswith(b"\n") and not final:
+                # The line is still being written
+                break
+            callback(line.decode("utf-8", errors="replace"))
+            position += len(line)
+    return position
+
+
+def container_name(job_id):
+    """
+    The name of the docker container which runs a simulation job, so it can be killed when the simulation is cancelled
+
+    :param job_id: The id of the simulation job
+    """
+    return f"leeway-{job_id}"
+
+
+def docker_limits(limits):
+    """
+    The options of ``docker run`` which enforce the resource limits of a simulation job
+
+    :param limits: The CPU cores and the memory in MiB, ``0`` or ``None`` for no limit
+    :return: The options
+    :rtype: list[str]
+    """
+    options = []
+    if limits and limits["cpus"]:
+        options += ["--cpus", str(limits["cpus"])]
+    if limits and limits["memory"]:
+        # Without swap, so the limit is a hard limit instead of slowing the host down
+        options += ["--memory", f"{limits['memory']}m", "--memory-swap", f"{limits['memory']}m"]
+    return options
+
+
+def run_in_docker(job_id, arguments, on_progress=None, limits=None):
+    """
+    Run the simulation in a new docker container and stream its output
+
+    :param job_id: The id of the simulation job
+    :param arguments: The command line arguments of ``simulation.py``
+    :param on_progress: The function which is called with the progress of the simulation
+    :param limits: The CPU cores and the memory in MiB the container may use
+    """
+    params = [
+        "docker",
+        "run",
+        "--rm",
+        "--name",
+        container_name(job_id),
+        "--user",
+        f"{os.getuid()}:{os.getgid()}",
+        "-e",
+        "HOME=/tmp/code/leeway",
+        "-e",
+        "MPLCONFIGDIR=/tmp/code/leeway/.matplotlib",
+        "-e",
+        "PYTHONUNBUFFERED=1",
+        "-e",
+        f"COPERNICUSMARINE_SERVICE_USERNAME={settings.COPERNICUSMARINE_SERVICE_USERNAME}",
+        "-e",
+        f"COPERNICUSMARINE_SERVICE_PASSWORD={settings.COPERNICUSMARINE_SERVICE_PASSWORD}",
+        "-e",
+        f"COPERNICUSMARINE_USERNAME={settings.COPERNICUSMARINE_SERVICE_USERNAME}",
+        "-e",
+        f"COPERNICUSMARINE_PASSWORD={settings.COPERNICUSMARINE_SERVICE_PASSWORD}",
+        "--volume",
+        f"{settings.SIMULATION_ROOT}:/tmp/code/leeway",
+        "--volume",
+        f"{settings.SIMULATION_SCRIPT_PATH}:/tmp/code/leeway/simulation.py",
+        *docker_limits(limits),
+        "opendrift-leeway-custom:latest",
+        "python3",
+        "leeway/simulation.py",
+        *arguments,
+    ]
+    output = SimulationOutput(job_id, on_progress)
+    with subprocess.Popen(
+        params,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        errors="replace",
+    ) as sim_proc:
+        # Read stderr in a thread, so neither of the pipes can fill up and block the simulation
+        stderr_reader = threading.Thread(target=read_lines, args=(sim_proc.stderr, output.add_stderr))
+        stderr_reader.start()
+        for line in sim_proc.stdout:
+            output.add_stdout(line)
+        stderr_reader.join()
+        exit_code = sim_proc.wait()
+    if exit_code == 137 and limits and limits["memory"]:
+        # The container was killed, usually by the kernel because it exceeded its memory limit
+        output.add_stderr(f"Killed, the simulation probably exceeded its memory limit of {limits['memory']} MiB")
+    return output.result(exit_code)
+
+
+def worker_alive(queue):
+    """
+    Whether the simulation worker touched its heartbeat file (see ``simulation.py --serve``) within
+    :setting:`SIMULATION_WORKER_TIMEOUT`
+
+    :param queue: The queue directory
+    :rtype: bool
+    """
+    try:
+        age = time.time() - (queue / WORKER_HEARTBEAT).stat().st_mtime
+    except FileNotFoundError:
+        return False
+    return age < settings.SIMULATION_WORKER_TIMEOUT
+
+
+def run_in_worker(job_id, arguments, on_progress=None, limits=None, poll_interval=1):  # pylint: disable=unused-argument
+    """
+    Hand the simulation over to the long-lived simulation worker (see ``simulation.py --serve``)
+    via the queue directory and stream its output from the log files until it is done
+
+    :param job_id: The id of the simulation job
+    :param arguments: The command line arguments of ``simulation.py``
+    :param on_progress: The function which is called with the progress of the simulation
+    :param limits: The resource limits of the job, which are not enforced
+    :param poll_interval: Seconds between checks whether the job is done
+
+    If the heartbeat of the worker is older than :setting:`SIMULATION_WORKER_TIMEOUT`, the job is withdrawn
+    and fails, so a dead worker doesn't block the task until its time limit. If the task is stopped while it waits,
+    e.g. by its soft time limit, the job is withdrawn as well. Jobs of tasks which were killed by the hard time
+    limit expire after :setting:`CELERY_TASK_TIME_LIMIT` and are discarded by the worker.
+    """
+    queue = Path(settings.SIMULATION_QUEUE)
+    queue.mkdir(parents=True, exist_ok=True)
+    job = queue / f"{job_id}.json"
+    # Write to a temporary file first so the worker never picks up a partially written job
+    part = queue / f"{job_id}.json.PART"
+    done = queue / f"{job_id}.done"
+    log, err = queue / f"{job_id}.log", queue / f"{job_id}.err"
+    finished = False
+    try:
+        part.write_text(
+            json.dumps({"args": arguments, "expires": time.time() + settings.CELERY_TASK_TIME_LIMIT}),
+            encoding="utf-8",
+        )
+        part.rename(job)
+        output = SimulationOutput(job_id, on_progress)
+        log_position = err_position = 0
+        while not done.is_file():
+            time.sleep(poll_interval)
+            log_position = follow_file(log, log_position, output.add_stdout)
+            err_position = follow_file(err, err_position, output.add_stderr)
+            if not worker_alive(queue) and not done.is_file():
+                logger.error("Simulation worker is not running, giving up job %s", job_id)
+                output.add_stderr(f"The simulation worker did not respond for {settings.SIMULATION_WORKER_TIMEOUT}s")
+                for path in (job, queue / f"{job_id}.running", log, err):
+                    path.unlink(missing_ok=True)
+                finished = True
+                return output.result(1)
+        follow_file(log, log_position, output.add_stdout, final=True)
+        follow_file(err, err_position, output.add_stderr, final=True)
+        exit_code = int(done.read_text(encoding="utf-8").strip() or 1)
+        for path in (log, err, done):
+            path.unlink(missing_ok=True)
+        finished = True
+        return output.result(exit_code)
+    finally:
+        if not finished:
+            withdraw_job(queue, job_id, arguments)
+
+
+def withdraw_job(queue, job_id, arguments):
+    """
+    Withdraw a job of the simulation worker whose result nobody waits for anymore. A queued job is removed, a
+    running job is stopped via the cancel file of its simulation and the worker discards its result.
+
+    :param queue: The queue directory
+    :param job_id: The id of the simulation job
+    :param arguments: The command line arguments of ``simulation.py``
+    """
+    simulation_id = arguments[arguments.index("--id") + 1] if "--id" in arguments else job_id
+    logger.warning("Withdrawing job %s of the simulation worker", job_id)
+    for path in (queue / f"{job_id}.json.PART", queue / f"{job_id}.json"):
+        path.unlink(missing_ok=True)
+    if (queue / f"{job_id}.running").exists():
+        (queue / f"{job_id}.abandoned").touch()
+        cancel_file(simulation_id).touch()
+        if not (queue / f"{job_id}.running").exists():
+            # The job finished in the meantime, so the worker doesn't see the markers anymore
+            (queue / f"{job_id}.abandoned").unlink(missing_ok=True)
+            cancel_file(simulation_id).unlink(missing_ok=True)
+    for path in (queue / f"{job_id}.done", queue / f"{job_id}.log", queue / f"{job_id}.err"):
+        path.unlink(missing_ok=True)
+
+
+@functools.cache
+def simulation_module():
+    """
+    Import ``simulation.py`` as module, which requires OpenDrift in the environment of the Celery worker.
+    The simulation root is passed via the environment, because the module reads it on import.
+    """
+    os.environ["SIMULATION_ROOT"] = str(settings.SIMULATION_ROOT)
+    spec = importlib.util.spec_from_file_location("leeway_simulation", settings.SIMULATION_SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@functools.cache
+def in_process_landmask():
+    """
+    Load the landmask once per Celery worker process
+    """
+    return simulation_module().reader_global_landmask.Reader()
+
+
+def run_in_process(job_id, arguments, on_progress=None, limits=None):  # pylint: disable=unused-argument
+    """
+    Run the simulation directly in the Celery worker process without the overhead of a container.
+    OpenDrift must be installed in the environment of the Celery worker. The output is streamed by
+    redirecting :data:`sys.stdout` and :data:`sys.stderr`, so the Celery worker must not run tasks in threads.
+
+    :param job_id: The id of the simulation job
+    :param arguments: The command line arguments of ``simulation.py``
+    :param on_progress: The function which is called with the progress of the simulation
+    :param limits: The resource limits of the job, which are not enforced
+    """
+    simulation = simulation_module()
+    if multiprocessing.current_process().daemon or billiard.current_process().daemon:
+        # Daemonic processes can't start the processes for ensemble members. The children of the Celery prefork
+        # pool are created by billiard, so multiprocessing doesn't know that they are daemonic.
+        arguments = [*arguments, "--workers", "1"]
+    output = SimulationOutput(job_id, on_progress)
+    with (
+        LineWriter(output.add_stdout) as stdout,
+        LineWriter(output.add_stderr) as stderr,
+        contextlib.redirect_stdout(stdout),
+        contextlib.redirect_stderr(stderr),
+    ):
+        exit_code = simulation.run_arguments(arguments, landmask=in_process_landmask())
+    return output.result(exit_code)
+
+
+def run_fake(job_id, arguments, on_progress=None, limits=None):  # pylint: disable=unused-argument
+    """
+    Don't run the simulation, but write canned results after waiting :setting:`SIMULATION_FAKE_DELAY` seconds.
+    The trajectories drift north-east from the start position. This allows load testing the queueing,
+    mails and webhooks without OpenDrift.
+
+    :param job_id: The id of the simulation job
+    :param arguments: The command line arguments of ``simulation.py``
+    :param on_progress: The function which is called with the progress of the simulation
+    :param limits: The resource limits of the job, which are not enforced
+    """
+
+    def argument(name, default=None):
+        return arguments[arguments.index(name) + 1] if name in arguments else default
+
+    if on_progress:
+        on_progress({"phase": "fake", "step": None, "steps": None})
+    time.sleep(settings.SIMULATION_FAKE_DELAY)
+    if cancel_file(argument("--id")).is_file():
+        return 1, "", "SimulationCancelled: The simulation was cancelled"
+    if "--batch" in arguments:
+        batch = json.loads((Path(settings.SIMULATION_ROOT) / argument("--batch")).read_text(encoding="utf-8"))
+        cases = batch["cases"]
+    else:
+        cases = [
+            {
+                "id": argument("--id"),
+                "longitude": float(argument("--longitude")),
+                "latitude": float(argument("--latitude")),
+                "start_time": argument("--start-time"),
+                "duration": int(argument("--duration", 12)),
+            }
+        ]
+    outputs = argument("--outputs", "nc,geojson,png").split(",")
+    output = Path(settings.SIMULATION_OUTPUT)
+    output.mkdir(parents=True, exist_ok=True)
+    for case in cases:
+        start_time = datetime.strptime(case["start_time"], "%Y-%m-%d %H:%M")
+        hours = np.arange(case["duration"] + 1)
+        lon = case["longitude"] + 0.01 * hours
+        lat = case["latitude"] + 0.005 * hours
+        if "nc" in outputs and "--render" not in arguments:
+            xr.Dataset(
+                {"lon": (("trajectory", "time"), lon[None]), "lat": (("trajectory", "time"), lat[None])},
+                coords={"trajectory": [0], "time": [start_time + timedelta(hours=int(hour)) for hour in hours]},
+            ).to_netcdf(output / f"{case['id']}.nc")
+        if "geojson" in outputs:
+            geojson = {
+                "type": "GeometryCollection",
+                "geometries": [{"type": "LineString", "coordinates": np.stack([lon, lat], axis=-1).tolist()}],
+            }
+            (output / f"{case['id']}.geojson").write_text(json.dumps(geojson), encoding="utf-8")
+        if "png" in outputs:
+            (output / f"{case['id']}.png").write_bytes(FAKE_PNG)
+    timing = {"phases": {"fake": settings.SIMULATION_FAKE_DELAY}, "total": settings.SIMULATION_FAKE_DELAY}
+    return 0, f"Fake simulation of {len(cases)} case(s)\nTIMING {json.dumps(timing)}", ""
+
+
+def cancel_file(simulation_id):
+    """
+    The file which tells ``simulation.py`` to stop the run of a simulation, which it checks on every
+    progress report. It is created in the queue directory, which all runners share with the web application.
+
+    :param simulation_id: The id of the simulation (``--id``)
+    :rtype: pathlib.Path
+    """
+    return Path(settings.SIMULATION_QUEUE) / f"{simulation_id}.cancel"
+
+
+def cancel_run(simulation_id):
+    """
+    Stop the runs of a simulation: create its cancel file and kill its docker containers right away,
+    because killing them doesn't depend on the progress reports. If the containers can't be killed within
+    :data:`DOCKER_KILL_TIMEOUT`, the failure is only logged and the run stops at its next progress report.
+
+    :param simulation_id: The id of the simulation
+    """
+    path = cancel_file(simulation_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+    if settings.SIMULATION_RUNNER == "docker":
+        containers = [container_name(simulation_id), container_name(f"{simulation_id}-render")]
+        try:
+            subprocess.run(
+                ["docker", "kill", *containers], capture_output=True, check=False, timeout=DOCKER_KILL_TIMEOUT
+            )
+        except (OSError, subprocess.TimeoutExpired) as exc:
+            logger.warning("Could not kill the containers of simulation %s: %s", simulation_id, exc)
+
+
+#: The available ways of running a simulation (see :setting:`SIMULATION_RUNNER`)
+SIMULATION_RUNNERS = {
+    "docker": run_in_docker,
+    "worker": run_in_worker,
+    "process": run_in_process,
+    "fake": run_fake,
+}
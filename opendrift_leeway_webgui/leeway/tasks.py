@@ -1,54 +1,37 @@
+import json
 import logging
-import os
-import subprocess
+import math
+from datetime import timedelta
 from pathlib import Path
 
 import requests as http_requests
 from celery import shared_task
 from django.apps import apps
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
 from django.utils import timezone
+from kombu.exceptions import ChannelError
 
+from .progress import clear_progress, set_progress
+from .runners import SIMULATION_RUNNERS, cancel_file, cancel_run
 from .utils import download_and_merge, send_result_mail
 
 logger = logging.getLogger(__name__)
 
+#: Prefix of the line with the timing record in the output of ``simulation.py``
+TIMING_PREFIX = "TIMING "
 
-@shared_task
-def run_leeway_simulation(request_id):
+
+def simulation_arguments(simulation, outputs=None, render=False):
     """
-    Get parameters for simulation from database and kick off the simulation
-    process in a docker container. The result is then mailed to the user.
+    Build the command line arguments of ``simulation.py`` for the given simulation
+
+    :param simulation: The simulation
+    :param outputs: The comma separated result files, defaults to the outputs of the simulation
+    :param render: Whether only the results are rendered from the NetCDF file of an earlier run
     """
-    # pylint: disable=invalid-name
-    LeewaySimulation = apps.get_model(app_label="leeway", model_name="LeewaySimulation")
-    simulation = LeewaySimulation.objects.get(uuid=request_id)
-    simulation.simulation_started = timezone.now()
-    simulation.save()
-    params = [
-        "docker",
-        "run",
-        "--user",
-        f"{os.getuid()}:{os.getgid()}",
-        "-e",
-        "HOME=/tmp/code/leeway",
-        "-e",
-        "MPLCONFIGDIR=/tmp/code/leeway/.matplotlib",
-        "-e",
-        f"COPERNICUSMARINE_SERVICE_USERNAME={settings.COPERNICUSMARINE_SERVICE_USERNAME}",
-        "-e",
-        f"COPERNICUSMARINE_SERVICE_PASSWORD={settings.COPERNICUSMARINE_SERVICE_PASSWORD}",
-        "-e",
-        f"COPERNICUSMARINE_USERNAME={settings.COPERNICUSMARINE_SERVICE_USERNAME}",
-        "-e",
-        f"COPERNICUSMARINE_PASSWORD={settings.COPERNICUSMARINE_SERVICE_PASSWORD}",
-        "--volume",
-        f"{settings.SIMULATION_ROOT}:/tmp/code/leeway",
-        "--volume",
-        f"{settings.SIMULATION_SCRIPT_PATH}:/tmp/code/leeway/simulation.py",
-        "opendrift-leeway-custom:latest",
-        "python3",
-        "leeway/simulation.py",
+    arguments = [
         "--longitude",
         str(simulation.longitude),
         "--latitude",
@@ -57,28 +40,353 @@ def run_leeway_simulation(request_id):
         str(simulation.radius),
         "--number",
         str(settings.OPENDRIFT_NUMBER_DRIFTERS),
+        "--max-drift-speed",
+        str(settings.OPENDRIFT_MAX_DRIFT_SPEED),
+        "--time-step",
+        str(settings.OPENDRIFT_TIME_STEP),
+        "--export-time-step",
+        str(settings.OPENDRIFT_EXPORT_TIME_STEP),
+        "--netcdf-compression",
+        settings.NETCDF_COMPRESSION,
+        "--netcdf-compression-level",
+        str(settings.NETCDF_COMPRESSION_LEVEL),
+        "--netcdf-precision",
+        settings.NETCDF_PRECISION,
+        "--geojson-precision",
+        str(settings.GEOJSON_PRECISION),
+        "--wms-url",
+        settings.BASEMAP_WMS_URL,
+        "--wms-layer",
+        settings.BASEMAP_WMS_LAYER,
         "--start-time",
         str(simulation.start_time.strftime("%Y-%m-%d %H:%M")),
         "--object-type",
         str(simulation.object_type),
         "--duration",
         str(simulation.duration),
+        "--ensemble",
+        str(simulation.ensemble_members),
+        "--outputs",
+        outputs or simulation.outputs,
+        "--workers",
+        str(settings.SIMULATION_ENSEMBLE_WORKERS),
         "--id",
         str(simulation.uuid),
     ]
-    with subprocess.Popen(params, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True) as sim_proc:
-        stdout, stderr = sim_proc.communicate()
-    logger.info("Output from simulation %s: %s", simulation.uuid, stdout)
-    if stderr:
-        logger.error("Error during simulation %s: %s", simulation.uuid, stderr)
-        simulation.traceback = stderr.strip()
+    if render:
+        arguments.append("--render")
+    elif simulation.profiling:
+        arguments.append("--profile")
+    return arguments
+
+
+def resource_limits(simulations):
+    """
+    The CPU cores and the memory which a simulation run may use. Both scale with the number of processes
+    of ensemble simulations, the memory also with the number of simulated drifters and hours.
+
+    :param simulations: The simulations which are run together
+    :return: The CPU cores and the memory in MiB, ``0`` if the resource is not limited
+    :rtype: dict
+    """
+    members = max(simulation.ensemble_members for simulation in simulations)
+    processes = min(members, max(settings.SIMULATION_ENSEMBLE_WORKERS, 1)) if members > 1 else 1
+    drifter_hours = settings.OPENDRIFT_NUMBER_DRIFTERS * sum(simulation.duration for simulation in simulations)
+    memory = 0
+    if settings.SIMULATION_MEMORY:
+        memory = processes * settings.SIMULATION_MEMORY + settings.SIMULATION_MEMORY_PER_DRIFTER_HOUR * drifter_hours
+    return {"cpus": processes * settings.SIMULATION_CPUS, "memory": math.ceil(memory)}
+
+
+def claim_simulation(simulation):
+    """
+    Mark the simulation as started unless another task has already started it
+
+    :param simulation: The simulation to claim
+    :return: Whether the simulation was claimed
+    :rtype: bool
+    """
+    now = timezone.now()
+    claimed = (
+        type(simulation)
+        .objects.filter(pk=simulation.pk, simulation_started__isnull=True, simulation_cancelled__isnull=True)
+        .update(simulation_started=now)
+    )
+    simulation.simulation_started = now
+    return bool(claimed)
+
+
+def user_at_capacity(simulation):
+    """
+    Whether the user of the simulation already runs :setting:`SIMULATION_MAX_RUNNING_PER_USER` simulations.
+    Simulations which were started longer than :setting:`CELERY_TASK_TIME_LIMIT` ago are not counted,
+    because their worker was killed.
+
+    :param simulation: The simulation which is about to be started
+    :rtype: bool
+    """
+    if not settings.SIMULATION_MAX_RUNNING_PER_USER or simulation.simulation_started or simulation.simulation_cancelled:
+        return False
+    running = (
+        type(simulation)
+        .objects.filter(
+            user_id=simulation.user_id,
+            simulation_started__gte=timezone.now() - timedelta(seconds=settings.CELERY_TASK_TIME_LIMIT),
+            simulation_finished__isnull=True,
+        )
+        .count()
+    )
+    return running >= settings.SIMULATION_MAX_RUNNING_PER_USER
+
+
+def ensembles_at_capacity(simulation):
+    """
+    Whether :setting:`SIMULATION_MAX_RUNNING_ENSEMBLES` ensemble simulations are already running, if the simulation
+    is an ensemble simulation. The Celery workers only keep the processes of this number of ensembles free.
+    Like in :func:`user_at_capacity`, simulations whose worker was killed are not counted.
+
+    :param simulation: The simulation which is about to be started
+    :rtype: bool
+    """
+    if not settings.SIMULATION_MAX_RUNNING_ENSEMBLES or simulation.ensemble_members <= 1:
+        return False
+    if simulation.simulation_started or simulation.simulation_cancelled:
+        return False
+    running = (
+        type(simulation)
+        .objects.filter(
+            ensemble_members__gt=1,
+            simulation_started__gte=timezone.now() - timedelta(seconds=settings.CELERY_TASK_TIME_LIMIT),
+            simulation_finished__isnull=True,
+        )
+        .count()
+    )
+    return running >= settings.SIMULATION_MAX_RUNNING_ENSEMBLES
+
+
+def claim_simulation_of_user(task, simulation):
+    """
+    Claim a simulation (see :func:`claim_simulation`) unless its user is at capacity (see :func:`user_at_capacity`)
+    or it is an ensemble simulation and the ensembles are at capacity (see :func:`ensembles_at_capacity`),
+    in which case the task is retried after :setting:`SIMULATION_USER_RETRY_DELAY` seconds.
+
+    :param task: The bound task which runs the simulation
+    :param simulation: The simulation
+    :return: Whether the simulation was claimed
+    :rtype: bool
+    """
+    with transaction.atomic():
+        # Lock the user, so concurrent tasks of the same user can't exceed the limit together
+        get_user_model().objects.select_for_update().filter(pk=simulation.user_id).first()
+        if user_at_capacity(simulation):
+            logger.info("Simulation %s waits until fewer simulations of its user are running", simulation.uuid)
+            raise task.retry(countdown=settings.SIMULATION_USER_RETRY_DELAY)
+        if ensembles_at_capacity(simulation):
+            logger.info("Ensemble simulation %s waits until fewer ensembles are running", simulation.uuid)
+            raise task.retry(countdown=settings.SIMULATION_USER_RETRY_DELAY)
+        return claim_simulation(simulation)
+
+
+def claim_batch_members(simulation):
+    """
+    Claim the pending simulations which can be run together with *simulation* (see :func:`compatible_simulations`).
+    Simulations of users who are at capacity (see :func:`user_at_capacity`) are left to their own tasks.
+
+    :param simulation: The simulation which leads the batch
+    :return: The claimed simulations
+    :rtype: list
+    """
+    members = []
+    for other in compatible_simulations(simulation):
+        with transaction.atomic():
+            # Lock the user like claim_simulation_of_user(), so the batch can't exceed the limit of the user either
+            get_user_model().objects.select_for_update().filter(pk=other.user_id).first()
+            if not user_at_capacity(other) and claim_simulation(other):
+                members.append(other)
+    return members
+
+
+def compatible_simulations(simulation):
+    """
+    Find pending simulations which are close enough in space and time to *simulation* and have the same duration,
+    so they can be run together with it without waiting for a longer simulation (see :setting:`SIMULATION_BATCHING`)
+
+    :param simulation: The simulation which is about to be started
+    :return: The compatible simulations, at most :setting:`SIMULATION_BATCH_SIZE` minus one
+    """
+    window = timedelta(hours=settings.SIMULATION_BATCH_TIME_WINDOW)
+    delta_lat = settings.SIMULATION_BATCH_DISTANCE / 111.32
+    delta_lon = delta_lat / max(math.cos(math.radians(simulation.latitude)), 0.01)
+    return (
+        type(simulation)
+        .objects.filter(
+            simulation_started__isnull=True,
+            simulation_cancelled__isnull=True,
+            ensemble_members=1,
+            profiling=False,
+            outputs=simulation.outputs,
+            duration=simulation.duration,
+            start_time__range=(simulation.start_time - window, simulation.start_time + window),
+            latitude__range=(simulation.latitude - delta_lat, simulation.latitude + delta_lat),
+            longitude__range=(simulation.longitude - delta_lon, simulation.longitude + delta_lon),
+        )
+        .exclude(pk=simulation.pk)
+        .order_by("pk")[: settings.SIMULATION_BATCH_SIZE - 1]
+    )
+
+
+def write_batch_file(simulations):
+    """
+    Write the cases of a batch of simulations to a file in the queue directory
+
+    :param simulations: The simulations of the batch, the first one is used to name the file
+    :return: The path of the batch file relative to :setting:`SIMULATION_ROOT`
+    :rtype: pathlib.Path
+    """
+    queue = Path(settings.SIMULATION_QUEUE)
+    queue.mkdir(parents=True, exist_ok=True)
+    batch_file = queue / f"{simulations[0].uuid}.batch"
+    cases = [
+        {
+            "id": str(simulation.uuid),
+            "longitude": simulation.longitude,
+            "latitude": simulation.latitude,
+            "radius": simulation.radius,
+            "object_type": simulation.object_type,
+            "start_time": simulation.start_time.strftime("%Y-%m-%d %H:%M"),
+            "duration": simulation.duration,
+        }
+        for simulation in simulations
+    ]
+    batch_file.write_text(json.dumps({"cases": cases}), encoding="utf-8")
+    return batch_file.relative_to(settings.SIMULATION_ROOT)
+
+
+def parse_timing(stdout):
+    """
+    Extract the timing record which ``simulation.py`` prints at the end of a run
+
+    :param stdout: The output of the simulation run
+    :return: The phases of the run with their durations, the total duration and the peak memory usage
+    :rtype: dict | None
+    """
+    for line in reversed(stdout.splitlines()):
+        if line.startswith(TIMING_PREFIX):
+            try:
+                return json.loads(line.removeprefix(TIMING_PREFIX))
+            except ValueError:
+                logger.warning("Invalid timing record: %s", line)
+                return None
+    return None
+
+
+def progress_publisher(simulations):
+    """
+    Build the progress callback of the runners, which publishes the progress of a run for all its simulations
+
+    :param simulations: The simulations which are run together
+    :return: The callback
+    :rtype: ~collections.abc.Callable
+    """
+
+    def publish(progress):
+        for simulation in simulations:
+            set_progress(simulation.uuid, progress)
+
+    return publish
+
+
+def simulation_error(exit_code, stderr):
+    """
+    The error of a simulation run which is stored as its traceback. Output on stderr of successful
+    runs, e.g. warnings of libraries, is only logged.
+
+    :param exit_code: The exit code of the simulation run
+    :param stderr: The tail of the error output of the simulation run
+    :return: The tail of the error output if the simulation failed, otherwise an empty string
+    :rtype: str
+    """
+    if not exit_code:
+        return ""
+    return stderr.strip() or f"Simulation failed with exit code {exit_code}"
+
+
+def remove_simulation_files(simulation):
+    """
+    Remove the result files and the partially written files of a cancelled simulation
+
+    :param simulation: The cancelled simulation
+    """
+    simulation_output = Path(settings.SIMULATION_OUTPUT)
+    # The results, profile, ensemble members and temporary files
+    for path in simulation_output.glob(f"{simulation.uuid}.*"):
+        path.unlink(missing_ok=True)
+
+
+def cancel_simulation(simulation):
+    """
+    Cancel a queued or running simulation. Its task is revoked in case it is still queued and its run
+    is stopped (see :func:`~opendrift_leeway_webgui.leeway.runners.cancel_run`). Once the run has stopped,
+    the task removes the partial results and the cancel file, so the worker is free for the next simulation.
+    The render task is not revoked, because it does this cleanup if the simulation is cancelled between
+    the stages.
+
+    :param simulation: The simulation to cancel
+    :return: Whether the simulation was cancelled, i.e. it was not finished already
+    :rtype: bool
+    """
+    now = timezone.now()
+    cancelled = (
+        type(simulation)
+        .objects.filter(pk=simulation.pk, simulation_finished__isnull=True)
+        .update(simulation_cancelled=now, simulation_finished=now)
+    )
+    if not cancelled:
+        return False
+    simulation.refresh_from_db()
+    logger.info("Cancelling simulation %s", simulation.uuid)
+    run_leeway_simulation.app.control.revoke(str(simulation.uuid))
+    if simulation.simulation_started:
+        cancel_run(str(simulation.uuid))
+    remove_simulation_files(simulation)
+    clear_progress(simulation.uuid)
+    return True
+
+
+def finish_cancelled_simulation(simulation):
+    """
+    Clean up after the run of a cancelled simulation has stopped
+
+    :param simulation: The cancelled simulation
+    """
+    logger.info("Simulation %s was cancelled", simulation.uuid)
+    remove_simulation_files(simulation)
+    cancel_file(str(simulation.uuid)).unlink(missing_ok=True)
+    clear_progress(simulation.uuid)
+
+
+def finish_simulation(simulation, error, timing=None, notify=True):
+    """
+    Store the results of a simulation run, mail them to the user and trigger the webhooks
+
+    :param simulation: The finished simulation
+    :param error: The error of the simulation run (see :func:`simulation_error`)
+    :param timing: The timing record of the simulation run (see :func:`parse_timing`)
+    :param notify: Whether the user is notified by mail and webhooks
+    """
+    if error:
+        simulation.traceback = error
+    simulation.timing = timing
     simulation.simulation_finished = timezone.now()
+    clear_progress(simulation.uuid)
+    # The simulation may have been cancelled after its run had already finished
+    cancel_file(str(simulation.uuid)).unlink(missing_ok=True)
     # Check if output files exist
     simulation_output = Path(settings.SIMULATION_OUTPUT)
     img_filename = f"{simulation.uuid}.png"
     if (simulation_output / img_filename).is_file():
         simulation.img.name = img_filename
-    else:
+    elif "png" in simulation.outputs.split(","):
         logger.error("Could not find simulation result.")
 
     geojson_filename = f"{simulation.uuid}.geojson"
@@ -88,13 +396,161 @@ def run_leeway_simulation(request_id):
     netcdf_filename = f"{simulation.uuid}.nc"
     if (simulation_output / netcdf_filename).is_file():
         simulation.netcdf.name = netcdf_filename
+
+    profile_filename = f"{simulation.uuid}.prof"
+    if (simulation_output / profile_filename).is_file():
+        simulation.profile.name = profile_filename
     simulation.save()
+    if not notify:
+        return
     send_result_mail(simulation)
     # Dispatch a webhook delivery task for each of the user's configured webhooks
     for webhook in simulation.user.webhooks.all():
         deliver_webhook.apply_async([webhook.pk, str(simulation.uuid)])
 
 
+def start_simulation(simulation):
+    """
+    Queue the task of a new simulation on the Celery queue of its source (see :setting:`SIMULATION_TASK_QUEUES`)
+
+    :param simulation: The simulation
+    """
+    run_leeway_simulation.apply_async(
+        [simulation.uuid],
+        task_id=str(simulation.uuid),
+        queue=settings.SIMULATION_TASK_QUEUES[simulation.source],
+    )
+
+
+def queue_depths():
+    """
+    The number of tasks waiting in each of the Celery queues (see :setting:`CELERY_TASK_QUEUES`)
+
+    :return: The number of tasks by queue name
+    :rtype: dict
+    """
+    app = run_leeway_simulation.app
+    depths = {}
+    with app.connection_for_read() as connection:
+        for queue in app.conf.task_queues:
+            try:
+                depths[queue.name] = queue(connection.default_channel).queue_declare(passive=True).message_count
+            except ChannelError:
+                # The broker removes empty queues
+                depths[queue.name] = 0
+    return depths
+
+
+@shared_task(bind=True, max_retries=None)
+def run_leeway_simulation(self, request_id):
+    """
+    Get parameters for simulation from database and kick off the simulation
+    process in a docker container or the simulation worker. The result is then
+    mailed to the user.
+
+    If :setting:`SIMULATION_BATCHING` is enabled, compatible pending simulations
+    are run together with this one in a single OpenDrift run.
+
+    If :setting:`SIMULATION_RENDER_STAGE` is enabled, only the NetCDF file is written
+    and the other results are rendered from it by :func:`render_leeway_simulation`.
+
+    If the user already runs :setting:`SIMULATION_MAX_RUNNING_PER_USER` simulations, the task is
+    retried after :setting:`SIMULATION_USER_RETRY_DELAY` seconds. Simulations of users at capacity
+    aren't added to batches either. Ensemble simulations also wait while :setting:`SIMULATION_MAX_RUNNING_ENSEMBLES`
+    ensembles are running.
+
+    The id of the task is the UUID of the simulation, so it can be revoked by :func:`cancel_simulation`.
+    """
+    # pylint: disable=invalid-name
+    LeewaySimulation = apps.get_model(app_label="leeway", model_name="LeewaySimulation")
+    simulation = LeewaySimulation.objects.get(uuid=request_id)
+    if not claim_simulation_of_user(self, simulation):
+        logger.info("Simulation %s has already been started in a batch or was cancelled", simulation.uuid)
+        return
+    batch = [simulation]
+    # Profiled simulations are run on their own, so the profile only covers one simulation
+    if settings.SIMULATION_BATCHING and simulation.ensemble_members == 1 and not simulation.profiling:
+        batch += claim_batch_members(simulation)
+    render_stage = settings.SIMULATION_RENDER_STAGE and simulation.outputs != "nc"
+    arguments = simulation_arguments(simulation, outputs="nc" if render_stage else None)
+    batch_file = None
+    if len(batch) > 1:
+        logger.info("Running simulations %s in one batch", ", ".join(str(other.uuid) for other in batch))
+        batch_file = write_batch_file(batch)
+        arguments += ["--batch", str(batch_file)]
+    exit_code, stdout, stderr = SIMULATION_RUNNERS[settings.SIMULATION_RUNNER](
+        str(simulation.uuid), arguments, on_progress=progress_publisher(batch), limits=resource_limits(batch)
+    )
+    if batch_file:
+        (Path(settings.SIMULATION_ROOT) / batch_file).unlink(missing_ok=True)
+    error = simulation_error(exit_code, stderr)
+    timing = parse_timing(stdout)
+    if timing and len(batch) > 1:
+        timing["batch_size"] = len(batch)
+    cancelled = set(
+        LeewaySimulation.objects.filter(
+            pk__in=[finished.pk for finished in batch], simulation_cancelled__isnull=False
+        ).values_list("pk", flat=True)
+    )
+    simulation_output = Path(settings.SIMULATION_OUTPUT)
+    for finished in batch:
+        if finished.pk in cancelled:
+            finish_cancelled_simulation(finished)
+        elif simulation.pk in cancelled:
+            # The run of the batch was stopped because the simulation which led it was cancelled
+            logger.info("Queueing simulation %s again", finished.uuid)
+            finished.simulation_started = None
+            finished.save(update_fields=["simulation_started"])
+            start_simulation(finished)
+        elif render_stage and not error and (simulation_output / f"{finished.uuid}.nc").is_file():
+            finished.timing = timing
+            finished.save(update_fields=["timing"])
+            render_leeway_simulation.apply_async(
+                [finished.uuid], queue=settings.SIMULATION_RENDER_QUEUE, task_id=f"{finished.uuid}-render"
+            )
+        else:
+            if render_stage and "nc" not in finished.outputs.split(","):
+                # The NetCDF file of a failed run was only written for rendering
+                (simulation_output / f"{finished.uuid}.nc").unlink(missing_ok=True)
+            finish_simulation(finished, error, timing)
+
+
+@shared_task
+def render_leeway_simulation(request_id, notify=True):
+    """
+    Render the GeoJSON and PNG files of a simulation from its NetCDF file without running the
+    simulation again, either as separate stage after :func:`run_leeway_simulation` or to update
+    the results of a finished simulation. Then store the results and notify the user.
+
+    :param request_id: The UUID of the simulation
+    :param notify: Whether the user is notified by mail and webhooks
+    """
+    # pylint: disable=invalid-name
+    LeewaySimulation = apps.get_model(app_label="leeway", model_name="LeewaySimulation")
+    simulation = LeewaySimulation.objects.get(uuid=request_id)
+    if simulation.simulation_cancelled:
+        finish_cancelled_simulation(simulation)
+        return
+    outputs = [output for output in simulation.outputs.split(",") if output != "nc"]
+    arguments = simulation_arguments(simulation, outputs=",".join(outputs), render=True)
+    exit_code, stdout, stderr = SIMULATION_RUNNERS[settings.SIMULATION_RUNNER](
+        f"{simulation.uuid}-render",
+        arguments,
+        on_progress=progress_publisher([simulation]),
+        limits=resource_limits([simulation]),
+    )
+    simulation.refresh_from_db(fields=["simulation_cancelled"])
+    if simulation.simulation_cancelled:
+        finish_cancelled_simulation(simulation)
+        return
+    if "nc" not in simulation.outputs.split(","):
+        # The NetCDF file was only kept for rendering
+        (Path(settings.SIMULATION_OUTPUT) / f"{simulation.uuid}.nc").unlink(missing_ok=True)
+    timing = dict(simulation.timing or {})
+    timing["render"] = parse_timing(stdout)
+    finish_simulation(simulation, simulation_error(exit_code, stderr), timing, notify=notify)
+
+
 @shared_task(bind=True, max_retries=3, default_retry_delay=60)
 def deliver_webhook(self, webhook_id, simulation_uuid):
     """
@@ -9,6 +9,7 @@ from django.urls import include, path
 
 from .views import (
     IndexRedirectView,
+    LeewaySimulationCancelView,
     LeewaySimulationCreateView,
     LeewaySimulationDeleteView,
     LeewaySimulationDetailView,
@@ -46,6 +47,11 @@ urlpatterns = [
                     LeewaySimulationDeleteView.as_view(),
                     name="simulation_delete",
                 ),
+                path(
+                    "<pk>/cancel/",
+                    LeewaySimulationCancelView.as_view(),
+                    name="simulation_cancel",
+                ),
             ]
         ),
     ),
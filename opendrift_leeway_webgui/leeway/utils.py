@@ -7,9 +7,11 @@ import bz2
 import os
 import re
 import tempfile
+import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
 from pathlib import Path
+from typing import Iterator
 
 import numpy as np
 import requests
@@ -140,6 +142,9 @@ LEEWAY_OBJECT_TYPES = (
     (77, "Immigration vessel, Cuban refugee-raft, with sail (*7)"),
 )
 
+#: Maximum number of ensemble members of a simulation
+MAX_ENSEMBLE_MEMBERS = 32
+
 SIMULATION_ARGUMENTS = [
     "latitude",
     "longitude",
@@ -147,6 +152,7 @@ SIMULATION_ARGUMENTS = [
     "radius",
     "object_type",
     "start_time",
+    "ensemble_members",
 ]
 
 
@@ -191,6 +197,7 @@ def mail_result_text(simulation):
         f"- Start time: {simulation.start_time}\n"
         f"- Duration: {simulation.duration}\n"
         f"- Object type: {simulation.object_type}\n"
+        f"- Ensemble members: {simulation.ensemble_members}\n"
     )
 
 
@@ -199,7 +206,7 @@ def mail_to_simulation(message):
     Parse content of incoming mail and create a simulation and a response
     """
     # pylint: disable=import-outside-toplevel
-    from .tasks import run_leeway_simulation
+    from .tasks import start_simulation
 
     # pylint: disable=invalid-name
     LeewaySimulation = apps.get_model(app_label="leeway", model_name="LeewaySimulation")
@@ -212,11 +219,11 @@ def mail_to_simulation(message):
         return
     arguments_subject = parse_mail_arguments(message.get("Subject"))
     arguments_body = parse_mail_arguments(message.get_payload(), delimiter="\n")
-    arguments = {**arguments_subject, **arguments_body, "user": user}
+    arguments = {**arguments_subject, **arguments_body, "user": user, "source": "mail"}
     simulation = LeewaySimulation(**arguments)
     simulation.save()
     send_confirmation_mail(simulation)
-    run_leeway_simulation(str(simulation.uuid))
+    start_simulation(simulation)
 
 
 def parse_mail_arguments(text, delimiter=";"):
@@ -231,6 +238,12 @@ def parse_mail_arguments(text, delimiter=";"):
             if key in SIMULATION_ARGUMENTS:
                 if key in ["longitude", "latitude"]:
                     arguments[key.strip()] = normalize_dms2dec(value.strip())
+                elif key == "ensemble_members":
+                    # The simulation is not validated like the form, so keep the number within its limits
+                    try:
+                        arguments[key] = min(max(int(value), 1), MAX_ENSEMBLE_MEMBERS)
+                    except ValueError:
+                        continue
                 else:
                     arguments[key.strip()] = value.strip()
     return arguments
@@ -248,37 +261,98 @@ def normalize_dms2dec(data):
 
 ### Download ICON EU wind data for opendrift
 
+#: Size of the chunks in which the compressed GRIB2 files are downloaded and decompressed
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
-def _list_bz2_files(url: str) -> list[str]:
-    """Fetch the DWD directory listing and return all sorted .bz2 filenames."""
-    resp = requests.get(url, timeout=30)
-    resp.raise_for_status()
-    files = re.findall(r'href="([^"]+\.bz2)"', resp.text)
-    return sorted(set(files))
+#: Common time units of all files in the ICON store
+ICON_TIME_UNITS = "hours since 1970-01-01 00:00:00"
 
+#: Resolution of the wind components in m/s if they are packed as int16 (see ICON_ENCODING)
+ICON_SCALE_FACTOR = 0.01
 
-def _download_and_decompress(url: str, dest_path: Path) -> Path:
-    """Download a .bz2 file, decompress it in-memory, write GRIB2 to *dest_path*.
 
-    Returns *dest_path* on success so futures can report it easily.
-    Raises on any HTTP or decompression error.
+#: Entry of the DWD directory listing with the file name, the modification time and the size
+LISTING_ENTRY = re.compile(r'href="([^"]+\.bz2)".*?(\d{2}-\w{3}-\d{4} \d{2}:\d{2})\s+(\d+)')
+
+#: Component of an ICON file name, U and V files of the same time step only differ in it
+COMPONENT = re.compile(r"_[UV]_10M", re.IGNORECASE)
+
+
+def _list_bz2_files(url: str) -> dict[str, tuple[datetime | None, int | None]]:
+    """Fetch the DWD directory listing and return the modification time and size of all .bz2 files.
+
+    Returns a dict sorted by filename. Modification time and size are None if the
+    listing doesn't contain them.
     """
-    resp = requests.get(url, timeout=120, stream=True)
+    resp = requests.get(url, timeout=30)
     resp.raise_for_status()
-    dest_path.write_bytes(bz2.decompress(resp.content))
-    return dest_path
+    files = dict.fromkeys(re.findall(r'href="([^"]+\.bz2)"', resp.text), (None, None))
+    for name, modified, size in LISTING_ENTRY.findall(resp.text):
+        files[name] = (datetime.strptime(modified, "%d-%b-%Y %H:%M").replace(tzinfo=timezone.utc), int(size))
+    return dict(sorted(files.items()))
+
 
+def _changed_time_steps(u_files: dict, v_files: dict, known: dict) -> list[tuple[str, str]]:
+    """Pair the U and V files of each time step and return the pairs with a new or changed file.
 
-def _parallel_download(tasks: list[tuple[str, Path]], max_workers: int) -> list[Path]:
+    A file has changed if its modification time or size differs from the *known* ones of the
+    last download. Time steps whose other component is not listed yet are left for a later run.
+    """
+    v_names = {COMPONENT.sub("", name): name for name in v_files}
+    steps = []
+    for u_name, u_listing in u_files.items():
+        v_name = v_names.get(COMPONENT.sub("", u_name))
+        if v_name and (known.get(u_name) != u_listing or known.get(v_name) != v_files[v_name]):
+            steps.append((u_name, v_name))
+    return steps
+
+
+def _download_and_decompress(url: str, dest_path: Path) -> tuple[Path, int, int, float]:
+    """Download a .bz2 file and decompress it chunk by chunk while streaming GRIB2 to *dest_path*.
+
+    At most DOWNLOAD_CHUNK_SIZE bytes of compressed and decompressed data are held in memory
+    at once, so the memory usage does not depend on the file size.
+    Returns *dest_path*, the compressed and decompressed sizes in bytes and the duration in
+    seconds, so futures can report the throughput.
+    Raises on any HTTP or decompression error.
+    """
+    start = time.perf_counter()
+    compressed = decompressed = 0
+    decompressor = bz2.BZ2Decompressor()
+    with requests.get(url, timeout=120, stream=True) as resp:
+        resp.raise_for_status()
+        with open(dest_path, "wb") as fp:
+            for chunk in resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                compressed += len(chunk)
+                while True:
+                    if decompressor.eof:
+                        # The file consists of several bz2 streams
+                        chunk = decompressor.unused_data + chunk
+                        if not chunk:
+                            break
+                        decompressor = bz2.BZ2Decompressor()
+                    elif not chunk and decompressor.needs_input:
+                        break
+                    # Limit the output, a chunk of highly compressible data can unpack to many times its size
+                    decompressed += fp.write(decompressor.decompress(chunk, max_length=DOWNLOAD_CHUNK_SIZE))
+                    chunk = b""
+    if not decompressor.eof:
+        raise EOFError(f"{url} ended before the end of the bz2 stream")
+    return dest_path, compressed, decompressed, time.perf_counter() - start
+
+
+def _parallel_download(tasks: list[tuple[str, Path]], max_workers: int) -> Iterator[Path]:
     """Download and decompress *tasks* = [(url, dest_path), …] in parallel.
 
-    Uses a ThreadPoolExecutor with MAX_WORKERS threads. Progress is printed
-    as each file completes (thread-safe). Returns a sorted list of paths.
-    Raises RuntimeError if any download fails.
+    Uses a ThreadPoolExecutor with MAX_WORKERS threads and yields each path
+    as soon as its file completes, so the caller can process it while the
+    other downloads continue. The throughput of each file is printed.
+    Raises RuntimeError after the other downloads if any download fails.
     """
     completed = 0
-    results: list[Path] = []
     errors: list[str] = []
+    start = time.perf_counter()
+    total = 0
 
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
         future_to_url = {executor.submit(_download_and_decompress, url, dest): url for url, dest in tasks}
@@ -287,16 +361,35 @@ def _parallel_download(tasks: list[tuple[str, Path]], max_workers: int) -> list[
             url = future_to_url[future]
             fname = url.split("/")[-1]
             try:
-                path = future.result()
-                results.append(path)
-                completed += 1
+                path, compressed, decompressed, seconds = future.result()
             except Exception:
                 errors.append(fname)
-
+                continue
+            completed += 1
+            total += compressed
+            print(
+                f"  [{completed}/{len(tasks)}] {fname}: {compressed / 2**20:.1f} MiB "
+                f"({decompressed / 2**20:.1f} MiB unpacked) in {seconds:.1f}s, "
+                f"{compressed / 2**20 / max(seconds, 1e-3):.1f} MiB/s"
+            )
+            yield path
+
+    seconds = time.perf_counter() - start
+    print(f"  Downloaded {total / 2**20:.1f} MiB in {seconds:.1f}s, {total / 2**20 / max(seconds, 1e-3):.1f} MiB/s")
     if errors:
         raise RuntimeError(f"{len(errors)} download(s) failed:\n  " + "\n  ".join(errors))
 
-    return sorted(results)
+
+def _decode_time_step(*gribs: Path) -> xr.Dataset:
+    """Decode the U and V GRIB2 files of one time step and merge them into one dataset for OpenDrift."""
+    components = []
+    for grib in gribs:
+        with xr.open_dataset(grib, engine="cfgrib", backend_kwargs={"errors": "ignore", "indexpath": ""}) as ds:
+            # Drop scalar coords that differ between the components to avoid merge conflicts
+            keep = {"valid_time", "latitude", "longitude"}
+            ds = ds.drop_vars([c for c in ds.coords if c not in keep], errors="ignore")
+            components.append(ds.expand_dims("valid_time").load())
+    return _rename_for_opendrift(xr.merge(components, join="outer"))
 
 
 def _rename_for_opendrift(ds: xr.Dataset) -> xr.Dataset:
@@ -340,23 +433,90 @@ def _rename_for_opendrift(ds: xr.Dataset) -> xr.Dataset:
     return ds
 
 
-def _merge_netCDF(big_file: str, new_ds, cutoff_hours=None):
-    big_ds = xr.open_dataset(big_file)
+def _time_chunk_path(store: Path, valid_time) -> Path:
+    """Return the path of the file which holds the time step *valid_time* in *store*."""
+    return store / f"{np.datetime_as_string(valid_time, unit='h')}.nc"
+
 
-    # Remove overlapping times from big_ds
-    ds1_no_overlap = big_ds.sel(time=~big_ds.time.isin(new_ds.time))
+def _icon_encoding() -> dict:
+    """Return the encoding of the time steps in the store, with the wind components packed as ICON_ENCODING."""
+    encoding = {"time": {"units": ICON_TIME_UNITS}}
+    for name in ("u10", "v10"):
+        if settings.ICON_ENCODING == "int16":
+            encoding[name] = {
+                "dtype": "int16",
+                "scale_factor": np.float32(ICON_SCALE_FACTOR),
+                "_FillValue": np.iinfo(np.int16).min,
+            }
+        else:
+            encoding[name] = {"dtype": "float32"}
+        if settings.NETCDF_COMPRESSION != "none":
+            encoding[name]["compression"] = settings.NETCDF_COMPRESSION
+            encoding[name]["complevel"] = settings.NETCDF_COMPRESSION_LEVEL
+    return encoding
 
-    # Concatenate along time
-    big_ds = xr.concat([ds1_no_overlap, new_ds], dim="time")
-    big_ds = big_ds.sortby("time")
 
-    now = np.datetime64("now")
-    cutoff_time = now - np.timedelta64(cutoff_hours, "h")
+def _crop_to_regions(ds: xr.Dataset, store: str) -> Iterator[tuple[Path, xr.Dataset]]:
+    """Crop *ds* to each of the ICON_REGIONS and yield the store of the region and the cropped data.
 
-    big_ds = big_ds.sel(time=big_ds.time >= cutoff_time)
-    big_ds.to_netcdf(f"{big_file}.PART")
-    os.remove(big_file)
-    os.rename(f"{big_file}.PART", big_file)
+    Without regions, the whole dataset is yielded with *store* itself.
+    """
+    if not settings.ICON_REGIONS:
+        yield Path(store), ds
+    for name, (lon_min, lon_max, lat_min, lat_max) in settings.ICON_REGIONS.items():
+        yield (
+            Path(store) / name,
+            ds.sel(
+                longitude=(ds.longitude >= lon_min) & (ds.longitude <= lon_max),
+                latitude=(ds.latitude >= lat_min) & (ds.latitude <= lat_max),
+            ),
+        )
+
+
+def _store_time_steps(store: str, new_ds, cutoff_hours=None) -> list[Path]:
+    """Append *new_ds* to the store of each region of interest (see _crop_to_regions and _append_to_store).
+
+    Returns the paths of the written files.
+    """
+    written = []
+    for region_store, region_ds in _crop_to_regions(new_ds, store):
+        written += _append_to_store(region_store, region_ds, cutoff_hours)
+    return written
+
+
+def _append_to_store(store: str, new_ds, cutoff_hours=None):
+    """Append a forecast run to the time-chunked store, a directory with one NetCDF file per time step.
+
+    Each time step of *new_ds* replaces the file of the same time step of an older run,
+    the rest of the store is not touched. All files share the same time units, so
+    OpenDrift can open the store with ``open_mfdataset``. Time steps older than
+    *cutoff_hours* are dropped by deleting their files.
+    Returns the paths of the written files.
+    """
+    store = Path(store)
+    store.mkdir(parents=True, exist_ok=True)
+    written = []
+    for valid_time in new_ds.time.values:
+        path = _time_chunk_path(store, valid_time)
+        new_ds.sel(time=[valid_time]).to_netcdf(f"{path}.PART", encoding=_icon_encoding())
+        os.replace(f"{path}.PART", path)
+        written.append(path)
+
+    if cutoff_hours is not None:
+        cutoff_time = np.datetime64("now") - np.timedelta64(cutoff_hours, "h")
+        for path in store.glob("*.nc"):
+            if np.datetime64(path.stem) < cutoff_time:
+                path.unlink()
+    return written
+
+
+def _migrate_merged_file(store: str):
+    """Move the time steps of the single merged NetCDF file of earlier versions into the store."""
+    merged_file = Path(f"{store}.nc")
+    if merged_file.is_file():
+        with xr.open_dataset(merged_file) as merged_ds:
+            _store_time_steps(store, merged_ds)
+        merged_file.unlink()
 
 
 def download_and_merge(
@@ -366,11 +526,14 @@ def download_and_merge(
     cutoff_hours=120,
 ):
     """
-    1. Download ICON-EU 10 m wind data (U/V components) from DWD OpenData
+    1. Download the new or changed ICON-EU 10 m wind data (U/V components) from DWD OpenData
     2. Unpack bz2 GRIB2 files in parallel
-    3. merge u and v component
+    3. merge u and v component of each time step as soon as both are downloaded
     4. make compatible with OpenDrift's GenericModelReader.
-    5. merge into a single NetCDF file, keep everything until cutoff_hours
+    5. crop to the regions of interest and append to their time-chunked stores
+       in compact encoding, keep everything until cutoff_hours
+
+    Steps 3-5 run while the other files are still downloading.
 
     Parameters:
         frt: str
@@ -378,12 +541,13 @@ def download_and_merge(
         max_workers: int
             Number of parallel download workers
         output_file: str
-            Existing netCDF file
+            Directory of the time-chunked store, one NetCDF file per time step,
+            or of one such store per region of interest
         cutoff_hours: int
             Data that is older than cutoff_hours will be deleted
     Returns:
-        xr.Dataset
-            The merged NetCDF file
+        list[Path]
+            The files of the store which were written
     """
     if max_workers is None:
         max_workers = settings.ICON_MAX_WORKERS
@@ -393,7 +557,10 @@ def download_and_merge(
         raise ValueError(f"Invalid frt: {frt}")
 
     IconFiles = apps.get_model(app_label="leeway", model_name="IconFiles")
-    last_downloads = IconFiles.objects.filter(frt=frt).values_list("file_name", flat=True)
+    known = {
+        file_name: (modified, size)
+        for file_name, modified, size in IconFiles.objects.filter(frt=frt).values_list("file_name", "modified", "size")
+    }
 
     BASE_URL_U = f"https://opendata.dwd.de/weather/nwp/icon-eu/grib/{frt}/u_10m/"
     BASE_URL_V = f"https://opendata.dwd.de/weather/nwp/icon-eu/grib/{frt}/v_10m/"
@@ -403,69 +570,50 @@ def download_and_merge(
     u_files = _list_bz2_files(BASE_URL_U)
     v_files = _list_bz2_files(BASE_URL_V)
 
-    if u_files is None or v_files is None:
+    if not u_files or not v_files:
         print("No files found.")
         return None
 
-    if sorted([*u_files, *v_files]) == sorted(last_downloads):
+    # Forget the files of previous runs which are no longer listed
+    IconFiles.objects.filter(frt=frt).exclude(file_name__in=[*u_files, *v_files]).delete()
+
+    steps = _changed_time_steps(u_files, v_files, known)
+    if not steps:
         print(f"{frt} already downloaded.")
         return None
 
-    print(f"  U files: {len(u_files)}   V files: {len(v_files)}")
+    print(f"  U files: {len(u_files)}   V files: {len(v_files)}   New or changed time steps: {len(steps)}")
     print(f"\nDownloading in parallel with {max_workers} workers")
 
+    _migrate_merged_file(output_file)
+    # The U and V files of each time step by their common name (see COMPONENT)
+    pairs = {COMPONENT.sub("", u.removesuffix(".bz2")): (u, v) for u, v in steps}
+    listing = {**u_files, **v_files}
+    written = []
     with tempfile.TemporaryDirectory() as tmpdir:
         tmp = Path(tmpdir)
 
-        # Build task lists: (url, destination_path)
-        u_tasks = [(BASE_URL_U + f, tmp / f.replace(".bz2", "")) for f in u_files]
-        v_tasks = [(BASE_URL_V + f, tmp / f.replace(".bz2", "")) for f in v_files]
-
-        u_gribs = _parallel_download(u_tasks, max_workers=max_workers)
-        v_gribs = _parallel_download(v_tasks, max_workers=max_workers)
-
-        print("\nLoading GRIB2 files into xarray …")
-        ds_u = xr.open_mfdataset(
-            u_gribs,
-            engine="cfgrib",
-            combine="nested",
-            concat_dim="valid_time",
-            coords="different",
-            compat="no_conflicts",
-            join="outer",
-            parallel=True,
-            backend_kwargs={"errors": "ignore"},
-        )
-        ds_v = xr.open_mfdataset(
-            v_gribs,
-            engine="cfgrib",
-            combine="nested",
-            concat_dim="valid_time",
-            coords="different",
-            compat="no_conflicts",
-            join="outer",
-            parallel=True,
-            backend_kwargs={"errors": "ignore"},
-        )
-
-        # Drop scalar coords that differ between timesteps to avoid merge conflicts
-        keep = {"valid_time", "latitude", "longitude"}
-        ds_u = ds_u.drop_vars([c for c in ds_u.coords if c not in keep], errors="ignore")
-        ds_v = ds_v.drop_vars([c for c in ds_v.coords if c not in keep], errors="ignore")
-
-        ds = xr.merge([ds_u, ds_v], join="outer")
-
-        print("\nRenaming variables for OpenDrift compatibility …")
-        ds = _rename_for_opendrift(ds)
-
-        if output_file:
-            if os.path.exists(output_file):
-                _merge_netCDF(output_file, ds, cutoff_hours)
-            else:
-                ds.to_netcdf(output_file)
-        for f in u_files:
-            IconFiles(frt=frt, file_name=f, download_date=datetime.now()).save()
-        for f in v_files:
-            IconFiles(frt=frt, file_name=f, download_date=datetime.now()).save()
-        IconFiles.objects.filter(download_date__lt=datetime.now() - timedelta(hours=23)).delete()
-    return ds
+        # Build one task list for both components: (url, destination_path)
+        tasks = [(BASE_URL_U + u, tmp / u.replace(".bz2", "")) for u, _ in steps]
+        tasks += [(BASE_URL_V + v, tmp / v.replace(".bz2", "")) for _, v in steps]
+
+        # Decode and store each time step as soon as both of its files are downloaded
+        downloaded: dict[str, Path] = {}
+        for grib in _parallel_download(tasks, max_workers=max_workers):
+            key = COMPONENT.sub("", grib.name)
+            if key not in downloaded:
+                downloaded[key] = grib
+                continue
+            other = downloaded.pop(key)
+            ds = _decode_time_step(other, grib)
+            written += _store_time_steps(output_file, ds, cutoff_hours)
+            downloaded_files = pairs[key]
+            IconFiles.objects.filter(frt=frt, file_name__in=downloaded_files).delete()
+            IconFiles.objects.bulk_create(
+                IconFiles(frt=frt, file_name=name, modified=listing[name][0], size=listing[name][1])
+                for name in downloaded_files
+            )
+            # Free the temporary disk space while the other files are still downloading
+            other.unlink()
+            grib.unlink()
+    return written
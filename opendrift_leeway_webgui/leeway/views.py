@@ -15,7 +15,7 @@ from django.views.generic.list import ListView
 
 from .forms import LeewaySimulationForm, RegistrationForm, WebhookForm
 from .models import InvitationToken, LeewaySimulation, Webhook
-from .tasks import deliver_webhook, run_leeway_simulation
+from .tasks import cancel_simulation, deliver_webhook, start_simulation
 
 
 class IndexRedirectView(RedirectView):
@@ -59,7 +59,6 @@ class LeewaySimulationCreateView(LoginRequiredMixin, CreateView):
         """
         When the form is valid, set the current user and save the simulation
         """
-        run_leeway_simulation.apply_async([form.instance.uuid])
         form.instance.user = self.request.user
         messages.success(
             self.request,
@@ -68,7 +67,9 @@ class LeewaySimulationCreateView(LoginRequiredMixin, CreateView):
                 f"the simulation is finished.\nYour request ID is {form.instance.uuid}."
             ),
         )
-        return super().form_valid(form)
+        response = super().form_valid(form)
+        start_simulation(form.instance)
+        return response
 
 
 # pylint: disable=too-many-ancestors
@@ -110,6 +111,25 @@ class LeewaySimulationDeleteView(LoginRequiredMixin, DeleteView):
         return super().get_queryset().filter(user=self.request.user)
 
 
+class LeewaySimulationCancelView(LoginRequiredMixin, View):
+    """
+    Cancel a queued or running simulation of the current user
+    """
+
+    def post(self, request, pk):
+        """
+        Cancel the simulation and redirect back to the simulation list.
+        """
+        simulation = LeewaySimulation.objects.filter(pk=pk, user=request.user).first()
+        if simulation is None:
+            raise Http404
+        if cancel_simulation(simulation):
+            messages.success(request, f"Simulation {simulation.name or simulation.uuid} was cancelled.")
+        else:
+            messages.error(request, f"Simulation {simulation.name or simulation.uuid} is already finished.")
+        return redirect("simulation_list")
+
+
 class RegistrationView(CreateView):
     """
     Public registration form for new users arriving via an invitation token link.
@@ -245,11 +265,14 @@ class SimulationFileView(LoginRequiredMixin, View):
     Serve simulation output files (PNG, NetCDF) with login and ownership protection.
 
     The filename stem must match the UUID of an existing simulation owned by the
-    requesting user. Any other request is rejected with 403 or 404.
+    requesting user. Any other request is rejected with 403 or 404. Profiles are
+    only served to staff, but for the simulations of all users.
     """
 
     ALLOWED_EXTENSIONS = {".png", ".nc", ".geojson"}
 
+    STAFF_EXTENSIONS = {".prof"}
+
     def get(self, request, path):
         """
         Serve the requested simulation file if the user owns it.
@@ -260,9 +283,13 @@ class SimulationFileView(LoginRequiredMixin, View):
         if Path(path).name != path:
             raise Http404
 
-        if Path(path).suffix not in self.ALLOWED_EXTENSIONS:
+        staff_only = Path(path).suffix in self.STAFF_EXTENSIONS
+        if Path(path).suffix not in self.ALLOWED_EXTENSIONS and not staff_only:
             raise Http404
 
+        if staff_only and not request.user.is_staff:
+            return HttpResponseForbidden("You do not have permission to access this file.")
+
         base_dir = Path(settings.SIMULATION_OUTPUT).resolve()
         file_path = (base_dir / path).resolve()
 
@@ -280,7 +307,7 @@ class SimulationFileView(LoginRequiredMixin, View):
         except (LeewaySimulation.DoesNotExist, ValueError) as exc:
             raise Http404 from exc
 
-        if simulation.user != request.user:
+        if simulation.user != request.user and not staff_only:
             return HttpResponseForbidden("You do not have permission to access this file.")
 
         content_type, _ = mimetypes.guess_type(str(file_path))
@@ -6,37 +6,77 @@ Use it with the docker container by mounting a directory and copying the file to
 
 docker run -it --volume ./simulation:/code/leeway opendrift/opendrift python3 leeway/simulation.py\
     --longitude 11.9545 --latitude 35.2966 --start-time "2022-12-05 03:00" --duration 12
+
+Alternatively, start a long-lived simulation worker which imports all dependencies and loads the
+landmask only once and then picks up jobs from the queue directory:
+
+docker run -it --volume ./simulation:/tmp/code/leeway opendrift/opendrift python3 leeway/simulation.py --serve
 """
 
 import argparse
+import contextlib
+import cProfile
+import fcntl
+import hashlib
 import json
+import multiprocessing
 import os
+import resource
 import sys
+import threading
+import time
+import traceback
+import urllib.parse
+import urllib.request
 import uuid
-from datetime import datetime, timedelta
-
-# pylint: disable=import-error
-import cartopy.crs as ccrs
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 
-# pylint: disable=import-error, disable=no-name-in-module
-import copernicusmarine
-import matplotlib.pyplot as plt
 import numpy as np
+import xarray as xr
 
 # pylint: disable=import-error
-from cartopy.mpl import gridliner
-from matplotlib import ticker
-from matplotlib.collections import LineCollection
-from matplotlib.colors import ListedColormap
+# The plotting libraries and the CMEMS client are imported where they are used,
+# so simulations without image or without CMEMS forcing don't need to load them
 from opendrift.models.leeway import Leeway
-from opendrift.readers import reader_global_landmask
+from opendrift.readers import open_dataset_opendrift, reader_global_landmask
 from opendrift.readers.reader_netCDF_CF_generic import Reader
 
-INPUTDIR = "/tmp/code/leeway/input"
+#: The directory of the input, output and queue directories, configurable e.g. for benchmarks outside the container
+ROOT = os.environ.get("SIMULATION_ROOT", "/tmp/code/leeway")
+INPUTDIR = os.path.join(ROOT, "input")
+OUTPUTDIR = os.path.join(ROOT, "output")
+QUEUEDIR = os.path.join(ROOT, "queue")
 
+#: File in the queue directory which the simulation worker touches every few seconds while it is alive
+HEARTBEAT_FILE = "worker.heartbeat"
+HEARTBEAT_INTERVAL = 5
 
-def main():  # noqa: C901
-    """Run opendrift leeway simulation"""
+#: Approximate length of one degree of latitude in meters
+METERS_PER_DEGREE = 111_320
+
+#: The result files which can be requested with ``--outputs``
+OUTPUTS = ("nc", "geojson", "png")
+
+
+def parse_outputs(value):
+    """
+    Parse the comma separated list of requested result files
+
+    :param value: The value of the ``--outputs`` option
+    :return: The requested outputs
+    :rtype: set
+    """
+    outputs = {output.strip() for output in value.split(",") if output.strip()}
+    if not outputs or not outputs.issubset(OUTPUTS):
+        raise argparse.ArgumentTypeError(f"Outputs must be a comma separated list of {', '.join(OUTPUTS)}")
+    return outputs
+
+
+def parse_arguments(argv=None):
+    """
+    Parse the command line arguments of a simulation
+    """
     parser = argparse.ArgumentParser(description="Simulate drift of object")
     parser.add_argument("--longitude", help="Start longitude of the drifting object", type=float)
     parser.add_argument("--latitude", help="Start latitude of the drifting object", type=float)
@@ -67,6 +107,79 @@ def main():  # noqa: C901
         type=int,
         default=1000,
     )
+    parser.add_argument(
+        "--max-drift-speed",
+        help="Maximum plausible drift speed in m/s, used to crop the forcing to the reachable area.",
+        type=float,
+        default=3.0,
+    )
+    parser.add_argument(
+        "--time-step",
+        help="Time step of the model calculation in minutes. Default: 10 minutes.",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--export-time-step",
+        help="Interval in minutes in which the particle positions are written to the results. Default: 10 minutes.",
+        type=int,
+        default=10,
+    )
+    parser.add_argument(
+        "--netcdf-compression",
+        help="Compression of the NetCDF variables (e.g. zlib or zstd, 'none' to disable). Default: zlib.",
+        default="zlib",
+    )
+    parser.add_argument(
+        "--netcdf-compression-level",
+        help="Compression level of the NetCDF variables. Default: 4.",
+        type=int,
+        default=4,
+    )
+    parser.add_argument(
+        "--netcdf-precision",
+        help="Storage precision of floating point NetCDF variables. Default: float32.",
+        choices=["float32", "float64"],
+        default="float32",
+    )
+    parser.add_argument(
+        "--netcdf-chunk-trajectories",
+        help="Number of trajectories per NetCDF chunk. Every chunk contains the whole time axis. Default: 64.",
+        type=int,
+        default=64,
+    )
+    parser.add_argument(
+        "--geojson-precision",
+        help="Number of decimal places of the GeoJSON coordinates. Default: 5 (about 1 m).",
+        type=int,
+        default=5,
+    )
+    parser.add_argument(
+        "--wms-url",
+        help="URL of the WMS for the basemap. Use an empty value to disable the basemap.",
+        default="https://sgx.geodatenzentrum.de/wms_topplus_open",
+    )
+    parser.add_argument("--wms-layer", help="Layer of the WMS used for the basemap.", default="web")
+    parser.add_argument(
+        "--wms-warm-up",
+        help=(
+            "Area (WEST,EAST,SOUTH,NORTH) for which the basemap tiles are fetched into the tile cache in advance. "
+            "Can be given multiple times. Without a simulation or --serve, only the cache is warmed up."
+        ),
+        action="append",
+        default=[],
+    )
+    parser.add_argument(
+        "--wms-warm-up-zoom",
+        help="Range (MIN-MAX) of the zoom levels which are warmed up. Default: 6-10.",
+        default="6-10",
+    )
+    parser.add_argument(
+        "--outputs",
+        help=f"Comma separated list of the result files ({', '.join(OUTPUTS)}). Default: All of them.",
+        type=parse_outputs,
+        default=set(OUTPUTS),
+    )
     parser.add_argument("--id", help="ID used for result image name.", default=str(uuid.uuid4()))
     parser.add_argument(
         "--no-web",
@@ -74,15 +187,550 @@ def main():  # noqa: C901
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--batch",
+        help=(
+            "JSON file (relative to the simulation root) with a list of cases which are simulated together. "
+            "The start position, radius, object type, start time and duration are taken from the cases."
+        ),
+    )
+    parser.add_argument(
+        "--ensemble",
+        help=(
+            "Number of perturbed ensemble members which are simulated in parallel and merged into one result. "
+            "The drifters are distributed among the members."
+        ),
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--ensemble-time-spread",
+        help="Maximum perturbation of the start time of ensemble members in hours.",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--workers",
+        help="Number of processes for ensemble members. Default: Number of CPU cores.",
+        type=int,
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        "--render",
+        help=(
+            "Don't run the simulation, but render the requested GeoJSON and PNG files from the NetCDF file "
+            "of an earlier run with the same id, start time, duration and object type."
+        ),
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--profile",
+        help="Run the simulation under cProfile and write the profile to <id>.prof in the output directory.",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--serve",
+        help="Run as long-lived worker which processes the jobs from the queue directory.",
+        action="store_true",
+        default=False,
+    )
+    return parser.parse_args(argv)
 
-    args = parser.parse_args()
 
-    simulation = Leeway(loglevel=50)
+def main(argv=None):
+    """Run opendrift leeway simulation"""
+    args = parse_arguments(argv)
+    if args.wms_warm_up:
+        warm_up_basemap(args)
+    if args.serve:
+        serve()
+    elif not args.wms_warm_up:
+        simulate(args)
+
+
+def simulate(args, landmask=None):
+    """
+    Run a leeway simulation and write the PNG, NetCDF and GeoJSON results, or only render the results
+    of an earlier run (``--render``).
+    The time spent in the phases of the simulation is printed at the end (see :class:`PhaseTimer`).
+
+    :param args: The parsed simulation arguments
+    :param landmask: A preloaded landmask reader which is reused instead of loading a new one
+    """
+    TIMER.reset()
+    PROGRESS.reset(cancel_file=os.path.join(QUEUEDIR, f"{args.id}.cancel"))
+    profiler = cProfile.Profile() if args.profile else contextlib.nullcontext()
+    try:
+        with profiler:
+            cases = load_cases(args)
+            if args.render:
+                render_case(args, cases[0])
+            elif args.ensemble > 1:
+                simulate_ensemble(args, cases[0])
+            else:
+                simulate_cases(args, cases, landmask)
+    finally:
+        if args.profile:
+            # The ensemble members run in separate processes and are not included in the profile
+            profiler.dump_stats(os.path.join(OUTPUTDIR, f"{args.id}.prof"))
+        TIMER.report()
+
 
-    local_sources = [
-        os.path.join(INPUTDIR, data_file) for data_file in os.listdir(INPUTDIR) if data_file.endswith(".nc")
+def simulate_cases(args, cases, landmask=None):
+    """
+    Run the simulation of one or more cases.
+
+    In batch mode (``--batch``) all cases of the batch file are seeded into one simulation, so the
+    forcing is only loaded once, and the results are split into separate files per case.
+
+    :param args: The parsed simulation arguments
+    :param cases: The cases (see :func:`load_cases`)
+    :param landmask: A preloaded landmask reader which is reused instead of loading a new one
+    """
+    start_time = min(case["start_time"] for case in cases)
+    end_time = max(case["end_time"] for case in cases)
+    envelopes = [
+        drift_envelope(case["longitude"], case["latitude"], case["radius"], case["duration"], args.max_drift_speed)
+        for case in cases
     ]
+    envelope = (
+        min(envelope[0] for envelope in envelopes),
+        max(envelope[1] for envelope in envelopes),
+        min(envelope[2] for envelope in envelopes),
+        max(envelope[3] for envelope in envelopes),
+    )
+    print("Cropping forcing to longitude {:.3f} to {:.3f}, latitude {:.3f} to {:.3f}".format(*envelope))
+
+    simulation = Leeway(loglevel=50)
+    with TIMER.phase("forcing"):
+        add_forcing(simulation, args, envelope, start_time, end_time, landmask)
+
+    with TIMER.phase("seeding"):
+        for case in cases:
+            simulation.seed_elements(
+                lon=case["longitude"],
+                lat=case["latitude"],
+                time=case["start_time"],
+                number=args.number,
+                radius=case["radius"],
+                object_type=case["object_type"],
+            )
+
+    batch = len(cases) > 1
+    PROGRESS.track(simulation, "run")
+    with TIMER.phase("run"):
+        # The results are kept in memory instead of being written to an uncompressed file by OpenDrift,
+        # so the compact NetCDF files are the only ones which are written
+        ds = simulation.run(
+            duration=end_time - start_time,
+            time_step=timedelta(minutes=args.time_step),
+            time_step_output=timedelta(minutes=args.export_time_step),
+        )
+
+    for index, case in enumerate(cases):
+        if batch and case_cancelled(case):
+            # The run is shared with the other cases of the batch, so only the results of this one are skipped
+            print(f"Skipping the results of case {case['id']}, it was cancelled")
+            continue
+        outfile = os.path.join(OUTPUTDIR, case["id"])
+        # The elements of each case were seeded en bloc, so they form a contiguous range of trajectories
+        case_ds = ds.isel(trajectory=slice(index * args.number, (index + 1) * args.number))
+        if batch:
+            case_ds = case_ds.sel(time=slice(case["start_time"], case["end_time"]))
+        if "nc" in args.outputs:
+            with TIMER.phase("netcdf"):
+                write_netcdf(case_ds, f"{outfile}.nc", args)
+        write_results(case_ds, case, simulation.leewayprop[case["object_type"]]["OBJKEY"], outfile, args)
+
+
+def case_cancelled(case):
+    """
+    Check whether the web application cancelled a case of a batch. Cancelling the case which leads the batch
+    stops the whole run (see :class:`ProgressReporter`).
+
+    :param case: The case (see :func:`load_cases`)
+    :return: Whether the cancel file of the case exists
+    """
+    return os.path.exists(os.path.join(QUEUEDIR, f"{case['id']}.cancel"))
+
+
+def render_case(args, case):
+    """
+    Write the GeoJSON and PNG files of a case from the NetCDF file of an earlier simulation run, so the
+    results can be rendered in a separate stage or again without running the simulation
+
+    :param args: The parsed simulation arguments
+    :param case: The case (see :func:`load_cases`)
+    """
+    outfile = os.path.join(OUTPUTDIR, case["id"])
+    with TIMER.phase("load"), xr.open_dataset(f"{outfile}.nc") as ds:
+        ds.load()
+    write_results(ds, case, Leeway(loglevel=50).leewayprop[case["object_type"]]["OBJKEY"], outfile, args)
+
+
+def simulate_ensemble(args, case):
+    """
+    Run perturbed members of a single case in parallel, merge their trajectories into one result
+    and add the probability density of the final positions to the NetCDF file
+
+    :param args: The parsed simulation arguments
+    :param case: The case (see :func:`load_cases`)
+    """
+    outfile = os.path.join(OUTPUTDIR, case["id"])
+    workers = max(min(args.workers or 1, args.ensemble), 1)
+    print(f"Running {args.ensemble} ensemble members with {workers} processes")
+    try:
+        member_files = []
+        with TIMER.phase("ensemble members"), contextlib.ExitStack() as stack:
+            if workers == 1:
+                # Run the members one after another in this process, which also works in daemonic processes
+                results = map(run_ensemble_member, [args] * args.ensemble, [case] * args.ensemble, range(args.ensemble))
+            else:
+                # Fork to reuse the already imported modules of the worker
+                executor = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context("fork"), initializer=READER_CACHE.reset
+                )
+                # Don't start the remaining members if one of them failed
+                stack.callback(executor.shutdown, cancel_futures=True)
+                results = executor.map(
+                    run_ensemble_member, [args] * args.ensemble, [case] * args.ensemble, range(args.ensemble)
+                )
+            for member_file, member_peak_rss in results:
+                member_files.append(member_file)
+                if workers > 1:
+                    TIMER.add_child_peak_rss(member_peak_rss)
+                PROGRESS.report("ensemble members", len(member_files), args.ensemble)
+
+        with TIMER.phase("merge"), contextlib.ExitStack() as stack:
+            members = []
+            offset = 0
+            for member_file in member_files:
+                member = stack.enter_context(xr.open_dataset(member_file))
+                # Members which start earlier are cut to the nominal start, so all members share its time axis
+                member = member.sel(time=slice(case["start_time"], None))
+                members.append(member.assign_coords(trajectory=np.arange(offset, offset + member.sizes["trajectory"])))
+                offset += member.sizes["trajectory"]
+            ds = xr.concat(members, dim="trajectory", join="outer", combine_attrs="override").load()
+        ds = ds.assign(probability_density=probability_density(ds["lon"].values, ds["lat"].values))
+        ds.attrs["ensemble_members"] = args.ensemble
+    finally:
+        # Also remove the partial files of failed members and the files of the other members if one of them
+        # failed or the simulation was cancelled
+        for member in range(args.ensemble):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(ensemble_member_file(case, member))
+    if "nc" in args.outputs:
+        with TIMER.phase("netcdf"):
+            write_netcdf(ds, f"{outfile}.nc", args)
+
+    write_results(ds, case, Leeway(loglevel=50).leewayprop[case["object_type"]]["OBJKEY"], outfile, args)
+
+
+def ensemble_member_file(case, member):
+    """
+    Return the path of the NetCDF file of an ensemble member
+
+    :param case: The case (see :func:`load_cases`)
+    :param member: The index of the member
+    """
+    return os.path.join(OUTPUTDIR, f"{case['id']}.member-{member}.nc")
+
+
+def ensemble_member_rng(case, member):
+    """
+    Return the random number generator of the perturbations of an ensemble member. It is seeded from the id of the
+    case and the index of the member, so the members of different cases are perturbed differently, but a member is
+    perturbed the same way when the simulation is repeated.
+
+    :param case: The case (see :func:`load_cases`)
+    :param member: The index of the member
+    :rtype: numpy.random.Generator
+    """
+    case_seed = int.from_bytes(hashlib.sha256(case["id"].encode()).digest()[:8], "big")
+    return np.random.default_rng([case_seed, member])
+
+
+def run_ensemble_member(args, case, member):
+    """
+    Run a single ensemble member with perturbed start time, position, radius and forcing priority.
+    Member 0 is the unperturbed case.
+
+    :param args: The parsed simulation arguments
+    :param case: The case (see :func:`load_cases`)
+    :param member: The index of the member
+    :return: The path of the member's NetCDF file and the peak resident set size of the process (see :func:`peak_rss`)
+    """
+    # Members which have not started yet are skipped after the simulation was cancelled
+    PROGRESS.check_cancelled()
+    rng = ensemble_member_rng(case, member)
+    start_time = case["start_time"]
+    longitude, latitude, radius = case["longitude"], case["latitude"], case["radius"]
+    if member:
+        # Shift the start time by whole export time steps to keep the members on the same time axis
+        spread = args.ensemble_time_spread * 60 // args.export_time_step
+        start_time += timedelta(minutes=args.export_time_step * int(rng.integers(-spread, spread + 1)))
+        start_time = min(start_time, case["end_time"] - timedelta(minutes=args.export_time_step))
+        east, north = rng.normal(0, radius, 2)
+        latitude += north / METERS_PER_DEGREE
+        longitude += east / (METERS_PER_DEGREE * max(np.cos(np.radians(latitude)), 0.01))
+        radius = int(radius * rng.uniform(0.5, 1.5))
+    envelope = drift_envelope(longitude, latitude, radius, case["duration"], args.max_drift_speed)
+
+    simulation = Leeway(loglevel=50)
+    add_forcing(simulation, args, envelope, start_time, case["end_time"], rotate=member)
+    PROGRESS.track(simulation, "ensemble members", report=False)
+    simulation.seed_elements(
+        lon=longitude,
+        lat=latitude,
+        time=start_time,
+        number=max(args.number // args.ensemble, 1),
+        radius=radius,
+        object_type=case["object_type"],
+    )
+    member_file = ensemble_member_file(case, member)
+    simulation.run(
+        duration=case["end_time"] - start_time,
+        time_step=timedelta(minutes=args.time_step),
+        time_step_output=timedelta(minutes=args.export_time_step),
+        outfile=member_file,
+    )
+    print(f"Ensemble member {member} finished")
+    return member_file, peak_rss()
+
+
+def plot_trajectories(ax, lon, lat, duration, transform):
+    """
+    Draw all trajectories as one line collection colored by hours and the initial,
+    stranded and active positions as three scatter plots
+
+    :param ax: The axes to draw on
+    :param lon: Longitudes of the particles (particle, time), NaN where a particle is not seeded or stranded
+    :param lat: Latitudes of the particles (particle, time)
+    :param duration: Duration of the simulation in hours
+    :param transform: The coordinate reference system of the positions
+    :return: The line collection of the trajectories
+    """
+    # pylint: disable=import-outside-toplevel
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+
+    # Project all positions at once instead of letting cartopy transform every segment separately.
+    # The segments only span one output time step, so they are straight in the map projection as well.
+    projected = ax.projection.transform_points(transform, lon, lat)[..., :2]
+    valid_points = ~(np.isnan(lon) | np.isnan(lat))
+    projected[~valid_points] = np.nan
+
+    # Segments between consecutive positions of every particle, skipping those touching a NaN position.
+    # With fewer than two time steps, there are no segments.
+    segments = np.stack([projected[:, :-1], projected[:, 1:]], axis=2).reshape(-1, 2, 2)
+    hours = np.tile(np.linspace(0, duration, max(lon.shape[1] - 1, 0)), lon.shape[0])
+    valid = (valid_points[:, :-1] & valid_points[:, 1:]).reshape(-1)
+
+    lc = LineCollection(segments[valid], cmap="jet", norm=plt.Normalize(0, duration))
+    lc.set_array(hours[valid])
+    lc.set_linewidth(2)
+    line = ax.add_collection(lc, autolim=False)
+
+    rows = np.arange(lon.shape[0])
+    first = first_valid_index(lon)
+    last = last_valid_index(lon)
+    seeded = first >= 0
+    stranded = seeded & (last < lon.shape[1] - 1)
+    active = seeded & (last == lon.shape[1] - 1)
+    markers = {"s": 15, "edgecolor": "black", "linewidth": 0.5}
+    ax.scatter(
+        projected[rows[seeded], first[seeded], 0],
+        projected[rows[seeded], first[seeded], 1],
+        color="green",
+        zorder=100,
+        label="Initial",
+        **markers,
+    )
+    for label, color, selection in (("Stranded", "red", stranded), ("Active", "blue", active)):
+        if selection.any():
+            ax.scatter(
+                projected[rows[selection], last[selection], 0],
+                projected[rows[selection], last[selection], 1],
+                color=color,
+                zorder=101,
+                label=label,
+                **markers,
+            )
+    ax.legend(loc="center right", bbox_to_anchor=(0, 0.5))
+    return line
+
+
+def first_valid_index(values):
+    """
+    Return the index of the first non-NaN value of each row
+
+    :param values: Two-dimensional array of particle positions (particle, time)
+    :return: Array with the index of the first valid position per particle, -1 for rows without valid values
+    """
+    if not values.shape[1]:
+        return np.full(values.shape[0], -1)
+    valid = ~np.isnan(values)
+    return np.where(valid.any(axis=1), np.argmax(valid, axis=1), -1)
+
+
+def last_valid_index(values):
+    """
+    Return the index of the last non-NaN value of each row
+
+    :param values: Two-dimensional array of particle positions (particle, time)
+    :return: Array with the index of the last valid position per particle, -1 for rows without valid values
+    """
+    if not values.shape[1]:
+        return np.full(values.shape[0], -1)
+    valid = ~np.isnan(values)
+    last = values.shape[1] - 1 - np.argmax(valid[:, ::-1], axis=1)
+    return np.where(valid.any(axis=1), last, -1)
+
+
+def probability_density(lon, lat, bins=50):
+    """
+    Calculate the probability density of the final particle positions on a regular grid
+
+    :param lon: Longitudes of the particles (particle, time)
+    :param lat: Latitudes of the particles (particle, time)
+    :param bins: Number of grid cells per dimension
+    :return: The probability of each grid cell with the cell centers as coordinates
+    :rtype: xarray.DataArray
+    """
+    lon = np.where(lon == 0, np.nan, lon)
+    lat = np.where(lat == 0, np.nan, lat)
+    rows = np.arange(lon.shape[0])
+    last = last_valid_index(lon)
+    final_lon, final_lat = lon[rows, last][last >= 0], lat[rows, last][last >= 0]
+    density, lon_edges, lat_edges = np.histogram2d(final_lon, final_lat, bins=bins)
+    density /= max(density.sum(), 1)
+    return xr.DataArray(
+        density.T,
+        dims=("density_lat", "density_lon"),
+        coords={
+            "density_lat": (lat_edges[:-1] + lat_edges[1:]) / 2,
+            "density_lon": (lon_edges[:-1] + lon_edges[1:]) / 2,
+        },
+        attrs={"long_name": "Probability of the final position of the drifting object"},
+    )
+
+
+def write_netcdf(ds, path, args):
+    """
+    Write the results to a compact NetCDF file. Floating point variables are stored with the configured
+    precision and all variables are compressed. The trajectory variables are chunked with the whole time axis
+    per chunk, because the results are usually read particle by particle.
+    The file is written to a temporary file first, so an existing file with the same path can be replaced.
+
+    :param ds: The results
+    :param path: The path of the NetCDF file
+    :param args: The parsed simulation arguments
+    """
+    started = time.perf_counter()
+    # Copy the attributes, which are changed below
+    ds = ds.copy()
+    encoding = {}
+    for name, variable in ds.variables.items():
+        # Only keep the encoding which is required to restore the values and drop the storage settings
+        encoding[name] = {
+            key: value
+            for key, value in variable.encoding.items()
+            if key in ("dtype", "_FillValue", "units", "calendar", "scale_factor", "add_offset")
+        }
+        # The results which OpenDrift keeps in memory declare the storage type of the variables as attribute.
+        # Integer variables are stored with a fill value for the time steps without active elements.
+        storage_dtype = variable.attrs.pop("dtype", None)
+        if storage_dtype is not None and "dtype" not in encoding[name] and variable.dtype.kind != "M":
+            encoding[name]["dtype"] = storage_dtype
+            if np.issubdtype(storage_dtype, np.integer) and name not in ds.coords:
+                encoding[name]["_FillValue"] = np.iinfo(storage_dtype).max
+        if name in ds.coords:
+            continue
+        if args.netcdf_precision == "float32" and variable.dtype == np.float64:
+            encoding[name]["dtype"] = "float32"
+        if args.netcdf_compression != "none":
+            encoding[name]["compression"] = args.netcdf_compression
+            encoding[name]["complevel"] = args.netcdf_compression_level
+        if variable.dims == ("trajectory", "time"):
+            encoding[name]["chunksizes"] = (
+                min(args.netcdf_chunk_trajectories, ds.sizes["trajectory"]),
+                ds.sizes["time"],
+            )
+    ds.to_netcdf(f"{path}.PART", encoding=encoding)
+    os.replace(f"{path}.PART", path)
+    print(
+        f"Wrote {os.path.basename(path)} ({os.path.getsize(path) / 1e6:.2f} MB) in {time.perf_counter() - started:.2f}s"
+    )
+
+
+def load_cases(args):
+    """
+    Return the cases to simulate, either from the batch file or from the command line arguments
+
+    :param args: The parsed simulation arguments
+    :return: A list of dicts with the id, start position, radius, object type, start and end time of each case
+    """
+    if args.batch:
+        with open(os.path.join(ROOT, args.batch), encoding="utf-8") as fp:
+            cases = json.load(fp)["cases"]
+    else:
+        cases = [
+            {
+                "id": args.id,
+                "longitude": args.longitude,
+                "latitude": args.latitude,
+                "radius": args.radius,
+                "object_type": args.object_type,
+                "start_time": args.start_time,
+                "duration": args.duration,
+            }
+        ]
+    for case in cases:
+        case["start_time"] = datetime.strptime(case["start_time"], "%Y-%m-%d %H:%M")
+        case["end_time"] = case["start_time"] + timedelta(hours=case["duration"])
+    return cases
+
+
+def find_local_sources(input_dir=INPUTDIR):
+    """
+    Find the local forcing in the input directory: NetCDF files and time-chunked stores, i.e. directories
+    with one NetCDF file per time step like the ICON download, which are opened together with a wildcard.
+    The stores can also be subdirectories, e.g. one per region of interest of the ICON download.
+
+    :param input_dir: The input directory
+    :return: The modification time of each source by path, a store changes whenever time steps are added or dropped
+    :rtype: dict
+    """
+    sources = {}
+    for entry in sorted(os.listdir(input_dir)):
+        path = os.path.join(input_dir, entry)
+        if os.path.isdir(path):
+            # A store or a directory with one store per region
+            for store in [path] + sorted(os.path.join(path, region) for region in os.listdir(path)):
+                if os.path.isdir(store) and any(data_file.endswith(".nc") for data_file in os.listdir(store)):
+                    sources[os.path.join(store, "*.nc")] = os.path.getmtime(store)
+        elif entry.endswith(".nc"):
+            sources[path] = os.path.getmtime(path)
+    return sources
+
+
+def add_forcing(simulation, args, envelope, start_time, end_time, landmask=None, rotate=0):  # noqa: C901
+    """
+    Add the readers for currents, wind and the landmask to the simulation
+
+    :param simulation: The leeway simulation
+    :param args: The parsed simulation arguments
+    :param envelope: The area to which the forcing is cropped (see :func:`drift_envelope`)
+    :param start_time: Start of the simulation
+    :param end_time: End of the simulation
+    :param landmask: A preloaded landmask reader which is reused instead of loading a new one
+    :param rotate: Rotate the priority of the readers by this number of positions (used for ensemble members)
+    """
+    local_sources = find_local_sources()
     sources = []
+    readers = []
     if not args.no_web:
         if os.environ.get("COPERNICUSMARINE_SERVICE_USERNAME") not in (
             None,
@@ -96,17 +744,11 @@ def main():  # noqa: C901
                 "cmems_obs-wind_glo_phy_nrt_l4_0.125deg_PT1H",
             ]
             print("Using CMEMS datasets:\n - {}".format("\n - ".join(cmems_dataset_ids)))
-            readers = []
             for dataset_id in cmems_dataset_ids:
-                try:
-                    ds = copernicusmarine.open_dataset(dataset_id=dataset_id, chunk_size_limit=0)
-                    print(f"Opened {dataset_id}:")
-                    print(ds)
-                except Exception as exc:
-                    print(f"ERROR opening {dataset_id}: {exc}", file=sys.stderr)
-                    raise
-                readers.append(Reader(ds, name=dataset_id))
-            simulation.add_reader(readers)
+                ds = READER_CACHE.get(dataset_id, lambda dataset_id=dataset_id: open_cmems_dataset(dataset_id))
+                reader = cropped_reader(ds, dataset_id, envelope, start_time, end_time)
+                if reader is not None:
+                    readers.append(reader)
             if not local_sources:
                 sources += [
                     "https://pae-paha.pacioos.hawaii.edu/thredds/dodsC/ncep_global/NCEP_Global_Atmospheric_Model_best.ncd"
@@ -119,35 +761,69 @@ def main():  # noqa: C901
                 sources += [
                     "https://pae-paha.pacioos.hawaii.edu/thredds/dodsC/ncep_global/NCEP_Global_Atmospheric_Model_best.ncd",
                 ]
-    sources += local_sources
+    sources += list(local_sources)
     print("Using sources:\n - {}".format("\n - ".join(sources)))
-    simulation.add_readers_from_list(sources, lazy=False)
+    for source in sources:
+        # Local files are replaced by the ICON download, so a new modification time marks a new forecast cycle
+        cycle = local_sources.get(source)
+        try:
+            ds = READER_CACHE.get(source, lambda source=source: open_dataset_opendrift(source), cycle=cycle)
+            reader = cropped_reader(ds, source, envelope, start_time, end_time)
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            print(f"Could not open {source}: {exc}")
+            continue
+        if reader is not None:
+            readers.append(reader)
+    if readers:
+        # OpenDrift uses the first reader which covers a variable, so rotating changes the forcing source
+        rotate %= len(readers)
+        simulation.add_reader(readers[rotate:] + readers[:rotate])
+    READER_CACHE.report()
 
-    reader_landmask = reader_global_landmask.Reader()
-    simulation.add_reader([reader_landmask])
+    if landmask is None:
+        landmask = reader_global_landmask.Reader()
+    simulation.add_reader([landmask])
 
-    simulation.seed_elements(
-        lon=args.longitude,
-        lat=args.latitude,
-        time=datetime.strptime(args.start_time, "%Y-%m-%d %H:%M"),
-        number=args.number,
-        radius=args.radius,
-        object_type=args.object_type,
-    )
-
-    outfile = os.path.join("/tmp/code", "leeway", "output", args.id)
 
-    ds = simulation.run(duration=timedelta(hours=args.duration), time_step=600, outfile=f"{outfile}.nc")
+def write_results(ds, case, object_name, outfile, args):
+    """
+    Write the requested GeoJSON and PNG files of a case
 
-    # Plotting results
+    :param ds: The simulation result of the case
+    :param case: The case (see :func:`load_cases`)
+    :param object_name: The name of the simulated object type
+    :param outfile: The path of the output files without extension
+    :param args: The parsed simulation arguments
+    """
     lon = ds["lon"].values
     lat = ds["lat"].values
     lon[lon == 0] = np.nan
     lat[lat == 0] = np.nan
 
-    segments = [[(float(lo), float(la)) for lo, la in zip(lon_row, lat_row)] for lon_row, lat_row in zip(lon, lat)]
+    if "geojson" in args.outputs:
+        with TIMER.phase("geojson"):
+            write_geojson(f"{outfile}.geojson", lon, lat, args.geojson_precision)
+    if "png" in args.outputs:
+        with TIMER.phase("render"):
+            plot_results(lon, lat, case, object_name, outfile, args)
+
 
-    geojson = segments_to_geojson(segments)
+def plot_results(lon, lat, case, object_name, outfile, args):
+    """
+    Plot the trajectories of a case on the basemap and write the PNG file
+
+    :param lon: Longitudes of the particles (particle, time), NaN where a particle is not seeded or stranded
+    :param lat: Latitudes of the particles (particle, time)
+    :param case: The case (see :func:`load_cases`)
+    :param object_name: The name of the simulated object type
+    :param outfile: The path of the output files without extension
+    :param args: The parsed simulation arguments
+    """
+    # pylint: disable=import-outside-toplevel
+    import cartopy.crs as ccrs
+    import matplotlib.pyplot as plt
+    from cartopy.mpl import gridliner
+    from matplotlib import ticker
 
     crs = ccrs.Mercator()  # Mercator projection to have angle true projection
     gcrs = ccrs.PlateCarree(globe=crs.globe)  # PlateCarree for straight lines
@@ -155,67 +831,7 @@ def main():  # noqa: C901
     fig = plt.figure(figsize=(8, 8))  # figsize set low to get small files
     ax = plt.axes(projection=crs)
 
-    # base map layer
-    ax.add_wms(wms="https://sgx.geodatenzentrum.de/wms_topplus_open", layers=["web"])
-    # quote source: Kartendarstellung: © Bundesamt für Kartographie und Geodäsie
-    # (2021), Datenquellen:
-    # https://gdz.bkg.bund.de/index.php/default/wms-topplusopen-wms-topplus-open.html
-
-    stranded = None
-    active = None
-    for i in range(lon.shape[0]):
-        lon_max_idx = np.where(np.isnan(lon[i, ...]))[0][0] - 1 if np.isnan(lon[i, -1]) else -1
-        lat_max_idx = np.where(np.isnan(lat[i, ...]))[0][0] - 1 if np.isnan(lat[i, -1]) else -1
-
-        points = np.array([lon[i, ...], lat[i, ...]]).T.reshape(-1, 1, 2)
-        segments = np.concatenate([points[:-1], points[1:]], axis=1)
-
-        lc = LineCollection(segments, cmap="jet", norm=plt.Normalize(0, args.duration), transform=gcrs)
-        lc.set_array(np.linspace(0, args.duration, len(segments)))
-        lc.set_linewidth(2)
-        line = ax.add_collection(lc)
-
-        initial = ax.scatter(
-            lon[i, 0],
-            lat[i, 0],
-            transform=gcrs,
-            color="green",
-            zorder=100 + i,
-            s=15,
-            edgecolor="black",
-            linewidth=0.5,
-        )
-        if lon_max_idx > 0:
-            stranded = ax.scatter(
-                lon[i, lon_max_idx],
-                lat[i, lat_max_idx],
-                transform=gcrs,
-                color="red",
-                zorder=100 + i + 1,
-                s=15,
-                edgecolor="black",
-                linewidth=0.5,
-            )
-        else:
-            active = ax.scatter(
-                lon[i, lon_max_idx],
-                lat[i, lat_max_idx],
-                transform=gcrs,
-                color="blue",
-                zorder=100 + i + 1,
-                s=15,
-                edgecolor="black",
-                linewidth=0.5,
-            )
-
-    # print legend for points
-    initial.set_label("Initial")
-    if stranded is not None:
-        stranded.set_label("Stranded")
-    if active is not None:
-        active.set_label("Active")
-
-    ax.legend(loc="center right", bbox_to_anchor=(0, 0.5))
+    line = plot_trajectories(ax, lon, lat, case["duration"], gcrs)
 
     # add colorbar with hours
     cbar = fig.colorbar(line, location="bottom")
@@ -237,6 +853,14 @@ def main():  # noqa: C901
     ]
     ax.set_extent(extent)
 
+    # base map layer
+    if args.wms_url:
+        with TIMER.phase("basemap"):
+            add_basemap(ax, args.wms_url, args.wms_layer, extent)
+    # quote source: Kartendarstellung: © Bundesamt für Kartographie und Geodäsie
+    # (2021), Datenquellen:
+    # https://gdz.bkg.bund.de/index.php/default/wms-topplusopen-wms-topplus-open.html
+
     # prepare gridlines on good position
     x_step = 1 / 60  # step size for grid lines a line every minute
     x_step_div = 10  # num of zebra stripes between grid lines
@@ -310,12 +934,9 @@ def main():  # noqa: C901
     lc = get_zebra_line(points, gcrs)
     line = ax.add_collection(lc)
 
-    start = datetime.strptime(args.start_time, "%Y-%m-%d %H:%M")
-    end = start + timedelta(hours=args.duration)
-
     plt.title(
-        f"Leeway Simulation Object Type: {simulation.leewayprop[args.object_type]['OBJKEY']}\n"
-        f" From {start.strftime('%Y-%m-%d %H:%M')} to {end.strftime('%Y-%m-%d %H:%M')} UTC"
+        f"Leeway Simulation Object Type: {object_name}\n"
+        f" From {case['start_time'].strftime('%Y-%m-%d %H:%M')} to {case['end_time'].strftime('%Y-%m-%d %H:%M')} UTC"
     )
     fig.text(
         0,
@@ -325,13 +946,921 @@ def main():  # noqa: C901
         fontsize=8,
     )
 
-    fig.savefig(f"{outfile}.png")
-    with open(f"{outfile}.geojson", "w", encoding="utf-8") as fp:
-        json.dump(geojson, fp)
-
+    with TIMER.phase("savefig"):
+        fig.savefig(f"{outfile}.png")
+    plt.close(fig)
     print(f"Success: {outfile}.png written.")
 
 
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of this process, which the kernel otherwise keeps for its whole lifetime
+
+    :return: Whether the peak was reset, which requires Linux
+    :rtype: bool
+    """
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as fp:
+            fp.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss():
+    """
+    The peak resident set size of this process in KiB since it was started or :func:`reset_peak_rss` was called
+
+    :return: The peak or ``None`` if it is not available, which requires Linux
+    :rtype: int | None
+    """
+    try:
+        with open("/proc/self/status", encoding="ascii") as fp:
+            for line in fp:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+class PhaseTimer:
+    """
+    Wall clock time spent in the phases of a simulation and the peak memory usage.
+
+    The time of a phase excludes the time of the phases nested in it, so the phases add up to the total time.
+    The record is printed as a single line of JSON with the prefix :attr:`PREFIX`, which is parsed by the
+    web application. The peak resident set size is the maximum of this process and the processes of the
+    ensemble members during the current simulation. Its high-water mark is reset for every simulation, so it is
+    correct in a long-lived worker as well. Where it can't be reset, the peak is only recorded for the first
+    simulation of a process, because later ones would report the peak of all simulations so far.
+    """
+
+    #: Prefix of the line containing the timing record
+    PREFIX = "TIMING "
+
+    def __init__(self):
+        self.first = True
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new record
+        """
+        self.phases = {}
+        self.nested = []
+        self.started = time.perf_counter()
+        self.peak_resettable = reset_peak_rss()
+        # Peak resident set size in KiB of the processes of ensemble members
+        self.children_peak_rss = 0
+
+    def add_child_peak_rss(self, peak):
+        """
+        Include the peak resident set size of a child process in the record
+
+        :param peak: The peak in KiB (see :func:`peak_rss`) or ``None``
+        """
+        self.children_peak_rss = max(self.children_peak_rss, peak or 0)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager which adds the time spent within it to the phase *name*
+
+        :param name: The name of the phase
+        """
+        PROGRESS.report(name)
+        started = time.perf_counter()
+        self.nested.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            nested = self.nested.pop()
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed - nested
+            if self.nested:
+                self.nested[-1] += elapsed
+
+    def record(self):
+        """
+        Return the timing record with the durations in seconds and the peak resident set size in MiB,
+        if it can be measured for this simulation alone
+        """
+        record = {
+            "phases": {name: round(duration, 3) for name, duration in self.phases.items()},
+            "total": round(time.perf_counter() - self.started, 3),
+        }
+        if self.peak_resettable and (peak := peak_rss()) is not None:
+            record["peak_rss_mb"] = round(max(peak, self.children_peak_rss) / 1024, 1)
+        elif self.first:
+            # ru_maxrss is given in KiB on Linux and covers the whole lifetime of the process
+            peak = max(
+                resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+            )
+            record["peak_rss_mb"] = round(peak / 1024, 1)
+        return record
+
+    def report(self):
+        """
+        Print the timing record
+        """
+        print(f"{self.PREFIX}{json.dumps(self.record())}", flush=True)
+        self.first = False
+
+
+#: The timing of the current simulation
+TIMER = PhaseTimer()
+
+
+class SimulationCancelled(Exception):
+    """
+    Raised when the web application cancelled the running simulation
+    """
+
+
+class ProgressReporter:
+    """
+    Live progress of a simulation: the current phase (see :class:`PhaseTimer`) and the number of completed
+    steps out of the total steps of the phase, if known. The progress is printed as a single line of JSON
+    with the prefix :attr:`PREFIX`, which the web application publishes while the simulation is running.
+    Every change of the phase is printed, but steps at most once per :attr:`INTERVAL` seconds.
+
+    The web application cancels a simulation by creating its cancel file, which is checked on every report.
+    """
+
+    #: Prefix of the lines containing the progress
+    PREFIX = "PROGRESS "
+
+    #: Minimum number of seconds between two reports of steps within the same phase
+    INTERVAL = 2
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, cancel_file=None):
+        """
+        Start reporting a new simulation
+
+        :param cancel_file: The file whose existence means that the simulation was cancelled
+        """
+        self.phase = None
+        self.reported = 0.0
+        self.cancel_file = cancel_file
+
+    def report(self, phase, step=None, steps=None):
+        """
+        Print the progress unless the last report of the same phase was too recent
+
+        :param phase: The name of the current phase
+        :param step: The number of completed steps of the phase
+        :param steps: The total number of steps of the phase
+        :raises SimulationCancelled: If the cancel file exists
+        """
+        self.check_cancelled()
+        now = time.monotonic()
+        if phase == self.phase and step != steps and now - self.reported < self.INTERVAL:
+            return
+        self.phase, self.reported = phase, now
+        print(f"{self.PREFIX}{json.dumps({'phase': phase, 'step': step, 'steps': steps})}", flush=True)
+
+    def check_cancelled(self):
+        """
+        Stop the simulation if it was cancelled
+
+        :raises SimulationCancelled: If the cancel file exists
+        """
+        if self.cancel_file and os.path.exists(self.cancel_file):
+            raise SimulationCancelled(f"The simulation was cancelled ({os.path.basename(self.cancel_file)})")
+
+    def track(self, simulation, phase, report=True):
+        """
+        Report the completed time steps of an OpenDrift simulation while it is running
+
+        :param simulation: The OpenDrift simulation
+        :param phase: The name of the phase in which the simulation is run
+        :param report: Whether the steps are reported or only the cancel file is checked, e.g. for ensemble
+            members, whose progress is reported as a whole
+        """
+        update = simulation.update
+
+        def update_and_report():
+            update()
+            if not report:
+                self.check_cancelled()
+                return
+            # The step counter is increased after the update
+            self.report(phase, simulation.steps_calculation + 1, simulation.expected_steps_calculation)
+
+        # OpenDrift calls the update method of the model once per time step with active elements. If the
+        # simulation is cancelled, OpenDrift stops the run early and the next phase raises the exception again.
+        simulation.update = update_and_report
+
+
+#: The progress of the current simulation
+PROGRESS = ProgressReporter()
+
+
+class ReaderCache:
+    """
+    Cache of the opened forcing datasets from which the readers are constructed, keyed by CMEMS dataset id or URL.
+
+    Within a long-lived simulation worker this allows back-to-back simulations to skip the catalogue
+    lookups and metadata round-trips of opening the forcing datasets. The readers themselves are built
+    for every simulation from the dataset cropped to its drift envelope. An entry expires after *ttl*
+    seconds or as soon as a new forecast cycle starts.
+    """
+
+    def __init__(self, ttl, cycle_hours):
+        """
+        :param ttl: Maximum age of a cache entry in seconds
+        :param cycle_hours: Interval of the forecast cycles in hours
+        """
+        self.ttl = ttl
+        self.cycle_hours = cycle_hours
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def current_cycle(self):
+        """
+        Return the start of the current forecast cycle
+        """
+        now = datetime.now(timezone.utc)
+        return now.replace(hour=now.hour - now.hour % self.cycle_hours, minute=0, second=0, microsecond=0)
+
+    def get(self, key, factory, cycle=None):
+        """
+        Return the cached dataset for *key* or open it with *factory* if it is missing or expired
+
+        :param key: The dataset id, URL or path of the dataset
+        :param factory: Callable without arguments which opens the dataset
+        :param cycle: The forecast cycle of the source, defaults to :meth:`current_cycle`
+        """
+        if cycle is None:
+            cycle = self.current_cycle()
+        entry = self.entries.get(key)
+        if entry is not None:
+            dataset, created, entry_cycle = entry
+            if time.monotonic() - created < self.ttl and entry_cycle == cycle:
+                self.hits += 1
+                return dataset
+            del self.entries[key]
+            dataset.close()
+        self.misses += 1
+        dataset = factory()
+        self.entries[key] = (dataset, time.monotonic(), cycle)
+        return dataset
+
+    def reset(self):
+        """
+        Forget all entries without closing them, e.g. in forked processes which must not share file handles
+        """
+        self.entries = {}
+
+    def report(self):
+        """
+        Print the cache statistics
+        """
+        print(f"Reader cache: {self.hits} hits, {self.misses} misses, {len(self.entries)} entries")
+
+
+#: The forcing datasets cached across the simulations of a worker
+READER_CACHE = ReaderCache(
+    ttl=int(os.environ.get("READER_CACHE_TTL", 3 * 60 * 60)),
+    cycle_hours=int(os.environ.get("READER_CACHE_CYCLE_HOURS", 6)),
+)
+
+
+class WMSTileCache:
+    """
+    Disk cache of basemap tiles fetched from a WMS.
+
+    The maps are composed of the tiles of the Web Mercator tile grid which are requested from the WMS one by one,
+    so maps of nearby areas share their tiles and only the missing ones cause WMS requests. The tiles are
+    stored as ``<wms>/<layer>/<zoom>/<x>/<y>.png`` in the cache directory, where ``<wms>`` is a hash of the WMS URL,
+    so different services never share their tiles. Once the cache exceeds its maximum size, the least recently
+    used tiles are removed. The size is stored in the cache directory and updated from the fetched tiles, so the
+    processes which render the maps don't have to scan the cache directory (see :meth:`evict`).
+    """
+
+    #: Width and height of a tile in pixels
+    TILE_SIZE = 256
+    #: Half of the extent of the Web Mercator projection in meters
+    HALF_EXTENT = 20037508.342789244
+    #: Maximum zoom level which is requested
+    MAX_ZOOM = 18
+    #: Name of the file in the cache directory which stores the size of the cache
+    SIZE_FILE = "size.json"
+    #: Maximum age of the stored size in seconds, after which the cache directory is scanned again
+    SCAN_INTERVAL = 24 * 60 * 60
+
+    def __init__(self, directory, max_size, timeout):
+        """
+        :param directory: The directory in which the tiles are stored
+        :param max_size: Maximum size of the cache in bytes
+        :param timeout: Timeout of the WMS requests in seconds
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        #: Size of the fetched tiles in bytes which were not yet added to the stored size
+        self.fetched = 0
+        #: Size of the cache in bytes, ``None`` until it was evicted for the first time
+        self.size = None
+
+    def tile_path(self, url, layer, zoom, x, y):
+        """
+        Return the path of the cached tile
+        """
+        service = hashlib.sha256(url.encode()).hexdigest()[:16]
+        return os.path.join(self.directory, service, urllib.parse.quote(layer, safe=""), str(zoom), str(x), f"{y}.png")
+
+    def tile_bounds(self, zoom, x, y):
+        """
+        Return the bounds (min x, min y, max x, max y) of a tile in Web Mercator meters
+        """
+        size = 2 * self.HALF_EXTENT / 2**zoom
+        return (
+            -self.HALF_EXTENT + x * size,
+            self.HALF_EXTENT - (y + 1) * size,
+            -self.HALF_EXTENT + (x + 1) * size,
+            self.HALF_EXTENT - y * size,
+        )
+
+    def tile_range(self, extent, zoom):
+        """
+        Return the ranges of the tile columns and rows which cover an area
+
+        :param extent: The area (west, east, south, north) in degrees
+        :param zoom: The zoom level
+        """
+        tiles = 2**zoom
+        west, east, south, north = extent
+        latitudes = np.radians(np.clip([north, south], -85.0511, 85.0511))
+        rows = (1 - np.arcsinh(np.tan(latitudes)) / np.pi) / 2 * tiles
+        columns = (np.array([west, east]) + 180) / 360 * tiles
+        columns = np.clip(columns.astype(int), 0, tiles - 1)
+        rows = np.clip(rows.astype(int), 0, tiles - 1)
+        return range(columns[0], columns[1] + 1), range(rows[0], rows[1] + 1)
+
+    def zoom_for(self, extent, width):
+        """
+        Return the lowest zoom level at which the tiles have at least the resolution of the map
+
+        :param extent: The area (west, east, south, north) of the map in degrees
+        :param width: The width of the map in pixels
+        """
+        tiles = width * 360 / (self.TILE_SIZE * max(extent[1] - extent[0], 1e-6))
+        return int(np.clip(np.ceil(np.log2(tiles)), 0, self.MAX_ZOOM))
+
+    def get(self, url, layer, zoom, x, y):
+        """
+        Return the path of the cached tile and fetch it from the WMS if it is missing
+
+        :param url: The URL of the WMS
+        :param layer: The layer of the WMS
+        :return: The path of the tile or ``None`` if it could not be fetched
+        """
+        path = self.tile_path(url, layer, zoom, x, y)
+        if os.path.isfile(path):
+            # Mark the tile as recently used
+            os.utime(path)
+            self.hits += 1
+            return path
+        self.misses += 1
+        query = urllib.parse.urlencode(
+            {
+                "SERVICE": "WMS",
+                "VERSION": "1.1.1",
+                "REQUEST": "GetMap",
+                "LAYERS": layer,
+                "STYLES": "",
+                "SRS": "EPSG:3857",
+                "BBOX": ",".join(str(bound) for bound in self.tile_bounds(zoom, x, y)),
+                "WIDTH": self.TILE_SIZE,
+                "HEIGHT": self.TILE_SIZE,
+                "FORMAT": "image/png",
+            }
+        )
+        try:
+            with urllib.request.urlopen(f"{url}{'&' if '?' in url else '?'}{query}", timeout=self.timeout) as response:
+                if not response.headers.get_content_type().startswith("image/"):
+                    raise ValueError(f"Unexpected response of type {response.headers.get_content_type()}")
+                data = response.read()
+        except (OSError, ValueError) as exc:
+            self.errors += 1
+            print(f"Fetching basemap tile {zoom}/{x}/{y} failed: {exc}")
+            return None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a unique temporary file first, so concurrent processes never read incomplete tiles
+        part = f"{path}.{uuid.uuid4().hex}.PART"
+        with open(part, "wb") as fp:
+            fp.write(data)
+        os.replace(part, path)
+        self.fetched += len(data)
+        return path
+
+    def image(self, url, layer, extent, zoom):
+        """
+        Compose the tiles which cover an area into one image
+
+        :param url: The URL of the WMS
+        :param layer: The layer of the WMS
+        :param extent: The area (west, east, south, north) in degrees
+        :param zoom: The zoom level
+        :return: The RGBA image and its extent (min x, max x, min y, max y) in Web Mercator meters
+        """
+        # pylint: disable=import-outside-toplevel
+        import matplotlib.pyplot as plt
+
+        columns, rows = self.tile_range(extent, zoom)
+        image = np.zeros((len(rows) * self.TILE_SIZE, len(columns) * self.TILE_SIZE, 4), dtype=np.float32)
+        for row_index, y in enumerate(rows):
+            for column_index, x in enumerate(columns):
+                path = self.get(url, layer, zoom, x, y)
+                if path is None:
+                    continue
+                try:
+                    tile = plt.imread(path, format="png")
+                except (OSError, ValueError, SyntaxError):
+                    # Remove corrupt tiles, so they are fetched again next time
+                    os.remove(path)
+                    continue
+                if tile.dtype == np.uint8:
+                    tile = tile / 255
+                if tile.ndim == 2:
+                    tile = np.stack([tile] * 3, axis=-1)
+                if tile.shape[2] == 3:
+                    tile = np.concatenate([tile, np.ones(tile.shape[:2] + (1,))], axis=-1)
+                image[
+                    row_index * self.TILE_SIZE : (row_index + 1) * self.TILE_SIZE,
+                    column_index * self.TILE_SIZE : (column_index + 1) * self.TILE_SIZE,
+                ] = tile[: self.TILE_SIZE, : self.TILE_SIZE]
+        min_x, _, _, max_y = self.tile_bounds(zoom, columns[0], rows[0])
+        _, min_y, max_x, _ = self.tile_bounds(zoom, columns[-1], rows[-1])
+        return image, (min_x, max_x, min_y, max_y)
+
+    def warm_up(self, url, layer, extent, zooms):
+        """
+        Fetch all missing tiles of an area into the cache
+
+        :param url: The URL of the WMS
+        :param layer: The layer of the WMS
+        :param extent: The area (west, east, south, north) in degrees
+        :param zooms: The zoom levels
+        """
+        for zoom in zooms:
+            columns, rows = self.tile_range(extent, zoom)
+            for x in columns:
+                for y in rows:
+                    self.get(url, layer, zoom, x, y)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used tiles if the cache is larger than its maximum size
+
+        The size of the cache is stored in :attr:`SIZE_FILE`, which is locked while the tiles fetched by this
+        process are added, so the cache directory only has to be scanned if the size exceeds the maximum or is
+        older than :attr:`SCAN_INTERVAL`. The scan also corrects the size for tiles which were removed otherwise.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, self.SIZE_FILE), "a+", encoding="utf-8") as fp:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            fp.seek(0)
+            try:
+                stored = json.load(fp)
+                size, scanned = stored["size"] + self.fetched, stored["scanned"]
+            except (ValueError, KeyError, TypeError):
+                size, scanned = None, 0
+            self.fetched = 0
+            if size is None or size > self.max_size or time.time() - scanned > self.SCAN_INTERVAL:
+                size, scanned = self.remove_least_recently_used(), time.time()
+            fp.seek(0)
+            fp.truncate()
+            json.dump({"size": size, "scanned": scanned}, fp)
+        self.size = size
+
+    def remove_least_recently_used(self):
+        """
+        Scan the cache directory and remove the least recently used tiles until the cache is not larger than
+        its maximum size
+
+        :return: The size of the remaining tiles in bytes
+        """
+        tiles = []
+        for directory, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if filename.endswith(".png"):
+                    path = os.path.join(directory, filename)
+                    with contextlib.suppress(FileNotFoundError):
+                        stat = os.stat(path)
+                        tiles.append((stat.st_mtime, stat.st_size, path))
+        size = sum(tile[1] for tile in tiles)
+        for _, tile_size, path in sorted(tiles):
+            if size <= self.max_size:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            size -= tile_size
+        return size
+
+    def report(self):
+        """
+        Print the cache statistics
+        """
+        print(f"Basemap tile cache: {self.hits} hits, {self.misses} misses, {self.errors} errors")
+
+
+#: The basemap tiles cached on disk across simulations
+WMS_TILE_CACHE = WMSTileCache(
+    directory=os.environ.get("WMS_CACHE_DIR", os.path.join(ROOT, "wms-cache")),
+    max_size=int(os.environ.get("WMS_CACHE_SIZE", 500)) * 1024 * 1024,
+    timeout=int(os.environ.get("WMS_TIMEOUT", 10)),
+)
+
+
+def add_basemap(ax, url, layer, extent):
+    """
+    Draw the basemap from the cached WMS tiles below the other layers of the map
+
+    :param ax: The axes of the map
+    :param url: The URL of the WMS
+    :param layer: The layer of the WMS
+    :param extent: The area (west, east, south, north) of the map in degrees
+    """
+    # pylint: disable=import-outside-toplevel
+    import cartopy.crs as ccrs
+
+    zoom = WMS_TILE_CACHE.zoom_for(extent, ax.get_window_extent().width)
+    image, image_extent = WMS_TILE_CACHE.image(url, layer, extent, zoom)
+    ax.imshow(image, origin="upper", extent=image_extent, transform=ccrs.Mercator.GOOGLE, zorder=0)
+    ax.set_extent(extent)
+    WMS_TILE_CACHE.evict()
+    WMS_TILE_CACHE.report()
+
+
+def warm_up_basemap(args):
+    """
+    Fetch the basemap tiles of the warm-up areas into the tile cache
+
+    :param args: The parsed simulation arguments
+    """
+    min_zoom, max_zoom = (int(zoom) for zoom in args.wms_warm_up_zoom.split("-"))
+    for area in args.wms_warm_up:
+        extent = [float(bound) for bound in area.split(",")]
+        WMS_TILE_CACHE.warm_up(args.wms_url, args.wms_layer, extent, range(min_zoom, max_zoom + 1))
+    WMS_TILE_CACHE.report()
+
+
+def open_cmems_dataset(dataset_id):
+    """
+    Open a CMEMS dataset
+    """
+    # pylint: disable=import-outside-toplevel, import-error, no-name-in-module
+    import copernicusmarine
+
+    try:
+        ds = copernicusmarine.open_dataset(dataset_id=dataset_id, chunk_size_limit=0)
+        print(f"Opened {dataset_id}:")
+        print(ds)
+    except Exception as exc:
+        print(f"ERROR opening {dataset_id}: {exc}", file=sys.stderr)
+        raise
+    return ds
+
+
+def drift_envelope(longitude, latitude, radius, duration, max_speed):
+    """
+    Calculate the bounding box which a drifter can reach within the simulation
+
+    :param longitude: Start longitude
+    :param latitude: Start latitude
+    :param radius: Seeding radius in meters
+    :param duration: Duration of the simulation in hours
+    :param max_speed: Maximum plausible drift speed in m/s
+    :return: Minimum and maximum longitude and latitude
+    """
+    distance = radius + max_speed * duration * 3600
+    delta_lat = distance / METERS_PER_DEGREE
+    delta_lon = distance / (METERS_PER_DEGREE * max(np.cos(np.radians(latitude)), 0.01))
+    return (
+        longitude - delta_lon,
+        longitude + delta_lon,
+        max(latitude - delta_lat, -90),
+        min(latitude + delta_lat, 90),
+    )
+
+
+def _coordinate(ds, names):
+    """
+    Return the first one-dimensional coordinate of *ds* with one of the given names
+    """
+    for name in names:
+        if name in ds.coords and ds[name].ndim == 1:
+            return ds[name]
+    return None
+
+
+def _coordinate_slice(coordinate, lower, upper, padding=2):
+    """
+    Return a slice of *coordinate* from *lower* to *upper* in its order, widened by *padding* grid cells
+    """
+    values = coordinate.values
+    if len(values) > 1:
+        step = abs(values[1] - values[0]) * padding
+        lower, upper = lower - step, upper + step
+    if values[0] > values[-1]:
+        return slice(upper, lower)
+    return slice(lower, upper)
+
+
+def crop_dataset(ds, envelope, start_time, end_time):
+    """
+    Slice a forcing dataset in space and time to the drift envelope of a simulation.
+
+    Dimensions which cannot be cropped safely (e.g. projected or curvilinear grids or an envelope
+    crossing the longitude seam of the dataset) are left untouched.
+
+    :param ds: The forcing dataset
+    :param envelope: Minimum and maximum longitude and latitude (see :func:`drift_envelope`)
+    :param start_time: Start of the simulation
+    :param end_time: End of the simulation
+    :return: The cropped dataset
+    """
+    lon_min, lon_max, lat_min, lat_max = envelope
+    selection = {}
+    longitude = _coordinate(ds, ("longitude", "lon"))
+    if longitude is not None:
+        if float(longitude.max()) > 180:
+            lon_min, lon_max = lon_min % 360, lon_max % 360
+        if lon_min < lon_max and lon_max - lon_min < 360:
+            selection[longitude.name] = _coordinate_slice(longitude, lon_min, lon_max)
+    latitude = _coordinate(ds, ("latitude", "lat"))
+    if latitude is not None:
+        selection[latitude.name] = _coordinate_slice(latitude, lat_min, lat_max)
+    times = _coordinate(ds, ("time",))
+    if times is not None and np.issubdtype(times.dtype, np.datetime64) and len(times) > 1:
+        # Keep one time step before and after the simulation for the temporal interpolation
+        padding = abs(times.values[1] - times.values[0])
+        selection[times.name] = slice(np.datetime64(start_time) - padding, np.datetime64(end_time) + padding)
+    return ds.sel(selection)
+
+
+def cropped_reader(ds, name, envelope, start_time, end_time):
+    """
+    Construct a reader for the part of *ds* within the drift envelope
+
+    :return: The reader or ``None`` if the dataset does not cover the envelope
+    """
+    cropped = crop_dataset(ds, envelope, start_time, end_time)
+    if any(size == 0 for size in cropped.sizes.values()):
+        print(f"Skipping {name}, it does not cover the simulation area and time")
+        return None
+    return Reader(cropped, name=name)
+
+
+def serve(queue_dir=QUEUEDIR, poll_interval=1):
+    """
+    Process simulation jobs from the queue directory until the worker is stopped.
+
+    A job is a file ``<id>.json`` containing the command line arguments of the simulation in the key ``args``
+    and optionally the timestamp ``expires`` after which nobody waits for its result anymore.
+    Jobs are processed in the order in which they were queued. A job is claimed by locking it and renaming it to
+    ``<id>.running``, the output is written to ``<id>.log`` and ``<id>.err`` and ``<id>.done`` is created
+    with the exit code once the job is finished. The results of expired jobs and of jobs for which the web
+    application created ``<id>.abandoned`` are discarded. While the worker is alive, it touches :data:`HEARTBEAT_FILE`.
+    Several workers can share the queue directory.
+
+    :param queue_dir: The directory which is watched for new jobs
+    :param poll_interval: Seconds to wait before looking for new jobs again
+    """
+    os.makedirs(queue_dir, exist_ok=True)
+    threading.Thread(target=heartbeat, args=(os.path.join(queue_dir, HEARTBEAT_FILE),), daemon=True).start()
+    landmask = reader_global_landmask.Reader()
+    print(f"Simulation worker ready, watching {queue_dir}", flush=True)
+    while True:
+        fail_interrupted_jobs(queue_dir)
+        jobs = queued_jobs(queue_dir)
+        if not jobs:
+            time.sleep(poll_interval)
+            continue
+        for job in jobs:
+            job_id = job.removesuffix(".json")
+            lock = claim_job(queue_dir, job_id)
+            if lock is None:
+                # Another worker claimed the job in the meantime
+                continue
+            with lock:
+                running = os.path.join(queue_dir, f"{job_id}.running")
+                if job_expired(running):
+                    print(f"Skipping job {job_id}, nobody waits for its result anymore", flush=True)
+                    discard_job(queue_dir, job_id)
+                    break
+                print(f"Processing job {job_id}", flush=True)
+                exit_code = run_job(running, os.path.join(queue_dir, job_id), landmask)
+                if job_expired(running):
+                    print(f"Discarding the result of job {job_id}, nobody waits for it anymore", flush=True)
+                    discard_job(queue_dir, job_id)
+                    break
+                with open(os.path.join(queue_dir, f"{job_id}.done"), "w", encoding="utf-8") as fp:
+                    fp.write(str(exit_code))
+                # Remove the job while it is still locked, so other workers don't consider it interrupted
+                os.remove(running)
+            print(f"Finished job {job_id} with exit code {exit_code}", flush=True)
+            # Look for jobs which were queued in the meantime before continuing with older ones
+            break
+
+
+def queued_jobs(queue_dir):
+    """
+    Return the queued jobs in the order in which they were queued
+
+    :param queue_dir: The queue directory
+    :return: The file names of the jobs
+    """
+    jobs = []
+    for job in os.listdir(queue_dir):
+        if job.endswith(".json"):
+            try:
+                jobs.append((os.path.getmtime(os.path.join(queue_dir, job)), job))
+            except FileNotFoundError:
+                # Another worker claimed the job in the meantime
+                continue
+    return [job for _, job in sorted(jobs)]
+
+
+def lock_file(path):
+    """
+    Open a file and lock it exclusively without waiting. The kernel releases the lock when the file is closed
+    or the process dies, so the lock of a job tells whether the worker running it is still alive.
+
+    :param path: The file to lock
+    :return: The open and locked file, or ``None`` if it doesn't exist or is locked by another process
+    """
+    try:
+        fp = open(path, encoding="utf-8")  # pylint: disable=consider-using-with
+    except FileNotFoundError:
+        return None
+    try:
+        fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        fp.close()
+        return None
+    return fp
+
+
+def claim_job(queue_dir, job_id):
+    """
+    Claim a queued job by locking it and renaming it to ``<id>.running``. The lock has to be held until the job
+    is finished and ``<id>.running`` is removed.
+
+    :param queue_dir: The queue directory
+    :param job_id: The id of the job
+    :return: The open and locked job file, or ``None`` if the job was claimed or withdrawn in the meantime
+    """
+    lock = lock_file(os.path.join(queue_dir, f"{job_id}.json"))
+    if lock is None:
+        return None
+    try:
+        os.rename(os.path.join(queue_dir, f"{job_id}.json"), os.path.join(queue_dir, f"{job_id}.running"))
+    except FileNotFoundError:
+        # The job was finished by another worker after we opened it
+        lock.close()
+        return None
+    return lock
+
+
+def job_expired(job_file):
+    """
+    Check whether nobody waits for the result of a job anymore, because its Celery task timed out or was stopped
+
+    :param job_file: The JSON file of the job
+    :return: Whether the job expired or was abandoned
+    """
+    if os.path.exists(job_file.removesuffix(".running") + ".abandoned"):
+        return True
+    try:
+        with open(job_file, encoding="utf-8") as fp:
+            expires = json.load(fp).get("expires")
+    except (OSError, ValueError, AttributeError):
+        # Invalid jobs are run anyway, so the error is reported
+        return False
+    return expires is not None and expires < time.time()
+
+
+def discard_job(queue_dir, job_id):
+    """
+    Remove a job and all its files, including the cancel file of its simulation
+
+    :param queue_dir: The queue directory
+    :param job_id: The id of the job, which differs from the id of the simulation for the render stage
+    """
+    running = os.path.join(queue_dir, f"{job_id}.running")
+    paths = [os.path.join(queue_dir, f"{job_id}{suffix}") for suffix in (".log", ".err", ".abandoned")]
+    with contextlib.suppress(OSError, ValueError, KeyError, IndexError):
+        with open(running, encoding="utf-8") as fp:
+            argv = json.load(fp)["args"]
+        paths.append(os.path.join(queue_dir, f"{argv[argv.index('--id') + 1]}.cancel"))
+    for path in [*paths, running]:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+
+
+def fail_interrupted_jobs(queue_dir):
+    """
+    Mark the jobs whose worker stopped while running them as failed, so the web application doesn't wait for
+    them. They are not queued again, because the job itself may have crashed the worker. Jobs which are still
+    locked by their worker are not touched, so several workers can share the queue directory.
+
+    :param queue_dir: The queue directory
+    """
+    for running in os.listdir(queue_dir):
+        if not running.endswith(".running"):
+            continue
+        path = os.path.join(queue_dir, running)
+        lock = lock_file(path)
+        if lock is None:
+            # The job is still running or finished in the meantime
+            continue
+        with lock:
+            if not os.path.exists(path):
+                # The worker finished the job after we opened it
+                continue
+            job_id = running.removesuffix(".running")
+            print(f"Job {job_id} was interrupted", flush=True)
+            with open(os.path.join(queue_dir, f"{job_id}.err"), "a", encoding="utf-8") as fp:
+                fp.write("The simulation worker stopped while running the simulation\n")
+            with open(os.path.join(queue_dir, f"{job_id}.done"), "w", encoding="utf-8") as fp:
+                fp.write("1")
+            os.remove(path)
+
+
+def heartbeat(path, interval=HEARTBEAT_INTERVAL):
+    """
+    Touch the heartbeat file periodically, so the web application can detect a dead worker
+
+    :param path: The heartbeat file
+    :param interval: Seconds between the updates
+    """
+    while True:
+        with open(path, "w", encoding="utf-8") as fp:
+            fp.write(str(time.time()))
+        time.sleep(interval)
+
+
+def run_job(job_file, output_prefix, landmask):
+    """
+    Run a single queued simulation job and redirect its output to log files
+
+    :param job_file: The JSON file containing the command line arguments of the job
+    :param output_prefix: The path prefix for the ``.log`` and ``.err`` files
+    :param landmask: The preloaded landmask reader
+    :return: The exit code of the job
+    """
+    with (
+        # Line buffered, so the web application can stream the output while the job is running
+        open(f"{output_prefix}.log", "w", buffering=1, encoding="utf-8") as stdout,
+        open(f"{output_prefix}.err", "w", buffering=1, encoding="utf-8") as stderr,
+        contextlib.redirect_stdout(stdout),
+        contextlib.redirect_stderr(stderr),
+    ):
+        try:
+            with open(job_file, encoding="utf-8") as fp:
+                argv = json.load(fp)["args"]
+        except (OSError, ValueError, KeyError):
+            traceback.print_exc()
+            return 1
+        return run_arguments(argv, landmask)
+
+
+def run_arguments(argv, landmask=None):
+    """
+    Run a simulation with the given command line arguments within the current process, e.g. in the
+    simulation worker or the in-process runner of the web application. Errors are printed to stderr.
+
+    :param argv: The command line arguments of the simulation
+    :param landmask: A preloaded landmask reader which is reused instead of loading a new one
+    :return: The exit code of the simulation
+    """
+    try:
+        simulate(parse_arguments(argv), landmask=landmask)
+    except SystemExit as exc:
+        return exc.code if isinstance(exc.code, int) else 1
+    except Exception:  # pylint: disable=broad-exception-caught
+        traceback.print_exc()
+        return 1
+    finally:
+        # Close the figures of failed simulations, if matplotlib was loaded at all
+        if "matplotlib.pyplot" in sys.modules:
+            sys.modules["matplotlib.pyplot"].close("all")
+    return 0
+
+
 def floor_min(decimal):
     """
     floor funtion for arc minutes
@@ -356,6 +1885,11 @@ def get_zebra_line(points, gcrs):
     """
     Define a blak/white dashed line for a map frame
     """
+    # pylint: disable=import-outside-toplevel
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import LineCollection
+    from matplotlib.colors import ListedColormap
+
     segments = np.concatenate([points[:-1], points[1:]], axis=1)
     cmap = ListedColormap(["k", "w"])
     lc = LineCollection(segments, cmap=cmap, norm=plt.Normalize(0, 1), transform=gcrs)
@@ -366,19 +1900,59 @@ def get_zebra_line(points, gcrs):
     return lc
 
 
-def segments_to_geojson(segments):
+def particle_geometry(particle, valid):
+    """
+    Return the GeoJSON geometry of the track of one particle
+
+    The track is split where the particle has no position, e.g. before it is seeded or after it is stranded,
+    and the parts with positions become the lines of a MultiLineString. An isolated position within such a track
+    becomes a line of zero length. A track with only one position is a Point.
+
+    :param particle: The positions (time, lon/lat) of the particle
+    :param valid: Whether the particle has a position at each time
+    :return: The geometry or ``None`` if the particle has no position at all
+    :rtype: dict | None
     """
-    Convert a list of segments to a GeoJSON GeometryCollection of LineStrings.
+    indices = np.flatnonzero(valid)
+    if not indices.size:
+        return None
+    if indices.size == 1:
+        return {"type": "Point", "coordinates": particle[indices[0]].tolist()}
+    runs = np.split(indices, np.flatnonzero(np.diff(indices) > 1) + 1)
+    lines = [particle[run[[0, 0]] if run.size == 1 else run].tolist() for run in runs]
+    if len(lines) == 1:
+        return {"type": "LineString", "coordinates": lines[0]}
+    return {"type": "MultiLineString", "coordinates": lines}
 
-    Parameters:
-        segments: list of shape (N, 2+) where each element is a list of (lon, lat) points
 
-    Returns:
-        dict: GeoJSON GeometryCollection
+def write_geojson(path, lon, lat, precision):
     """
-    geometries = [{"type": "LineString", "coordinates": [list(point) for point in line]} for line in segments]
+    Write the trajectories as GeoJSON GeometryCollection with one geometry per particle in the order of the
+    particles (see :func:`particle_geometry`). Particles without any position are left out, because the members
+    of a GeometryCollection must be geometries (RFC 7946).
+
+    The file is streamed particle by particle, so the whole collection is never built in memory.
 
-    return {"type": "GeometryCollection", "geometries": geometries}
+    :param path: The path of the GeoJSON file
+    :param lon: Longitudes of the particles (particle, time), NaN where a particle is not seeded or stranded
+    :param lat: Latitudes of the particles (particle, time)
+    :param precision: Number of decimal places of the coordinates
+    """
+    positions = np.round(np.stack([lon, lat], axis=-1).astype(np.float64), precision)
+    valid = ~np.isnan(positions).any(axis=-1)
+    with open(f"{path}.PART", "w", encoding="utf-8") as fp:
+        fp.write('{"type": "GeometryCollection", "geometries": [')
+        separator = ""
+        for particle, particle_valid in zip(positions, valid):
+            geometry = particle_geometry(particle, particle_valid)
+            if geometry is None:
+                continue
+            fp.write(separator)
+            # Only valid positions are written, so the file never contains NaN
+            fp.write(json.dumps(geometry, allow_nan=False))
+            separator = ", "
+        fp.write("]}")
+    os.replace(f"{path}.PART", path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,3 @@
+"""
+This package contains tests of the :mod:`opendrift_leeway_webgui.api` app
+"""
@@ -0,0 +1,58 @@
+import pytest
+from django.contrib.auth import get_user_model
+from django.urls import reverse
+from django.utils import timezone
+
+from opendrift_leeway_webgui.leeway.models import LeewaySimulation
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("started", [False, True])
+def test_cancel(client, settings, tmp_path, revoked, started):
+    """
+    Test that queued and running simulations are cancelled via the API
+    """
+    settings.SIMULATION_RUNNER = "fake"
+    settings.SIMULATION_QUEUE = str(tmp_path)
+    user = get_user_model().objects.create(username="user")
+    simulation = LeewaySimulation.objects.create(
+        user=user, longitude=12.6, latitude=35.4, simulation_started=timezone.now() if started else None
+    )
+    client.force_login(user)
+    response = client.post(reverse("api:v1:simulations-cancel", kwargs={"uuid": simulation.uuid}))
+    assert response.status_code == 200
+    assert response.json()["status"] == "cancelled"
+    assert revoked == [str(simulation.uuid)]
+
+
+@pytest.mark.django_db
+def test_cancel_finished(client, revoked):
+    """
+    Test that finished simulations can't be cancelled via the API
+    """
+    user = get_user_model().objects.create(username="user")
+    simulation = LeewaySimulation.objects.create(
+        user=user, longitude=12.6, latitude=35.4, simulation_finished=timezone.now()
+    )
+    client.force_login(user)
+    response = client.post(reverse("api:v1:simulations-cancel", kwargs={"uuid": simulation.uuid}))
+    assert response.status_code == 409
+    simulation.refresh_from_db()
+    assert simulation.status == "finished"
+    assert not revoked
+
+
+@pytest.mark.django_db
+def test_cancel_permissions(client, revoked):
+    """
+    Test that only the owner of a simulation can cancel it via the API
+    """
+    owner = get_user_model().objects.create(username="owner")
+    simulation = LeewaySimulation.objects.create(user=owner, longitude=12.6, latitude=35.4)
+    url = reverse("api:v1:simulations-cancel", kwargs={"uuid": simulation.uuid})
+    assert client.post(url).status_code == 403
+    client.force_login(get_user_model().objects.create(username="other"))
+    assert client.post(url).status_code == 404
+    simulation.refresh_from_db()
+    assert simulation.status == "queued"
+    assert not revoked
@@ -2,12 +2,17 @@
 This module contains shared fixtures for pytest
 """
 
+import functools
+import threading
 import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
 
 import pytest
 from celery.contrib.testing import tasks as _celery_testing_tasks  # noqa: F401
+from django.conf import settings as django_settings
 
 from opendrift_leeway_webgui.leeway.models import LeewaySimulation
+from opendrift_leeway_webgui.leeway.tasks import run_leeway_simulation
 
 from .leeway.test_simulation import _teardown_test_simulation
 
@@ -33,11 +38,15 @@ def celery_enable_logging():
 @pytest.fixture(scope="session")
 def celery_config():
     """
-    Use the real Redis broker so the test worker receives tasks submitted by the app
+    Use the real Redis broker so the test worker receives tasks submitted by the app,
+    and consume the same queues as the configured workers
     """
     return {
         "broker_url": "redis://localhost:6379/0",
         "result_backend": "redis://localhost:6379/0",
+        "task_queues": django_settings.CELERY_TASK_QUEUES,
+        "task_routes": django_settings.CELERY_TASK_ROUTES,
+        "broker_transport_options": django_settings.CELERY_BROKER_TRANSPORT_OPTIONS,
     }
 
 
@@ -49,6 +58,43 @@ def celery_worker_parameters():
     return {"shutdown_timeout": 600, "loglevel": "info"}
 
 
+class QuietHandler(SimpleHTTPRequestHandler):
+    """
+    Serve files without logging the requests
+    """
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+@pytest.fixture
+def file_server(tmp_path):
+    """
+    Serve the files of a temporary directory via HTTP
+
+    :return: The directory and its URL
+    """
+    directory = tmp_path / "served"
+    directory.mkdir()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(QuietHandler, directory=str(directory)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield directory, f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def revoked(monkeypatch):
+    """
+    Record the ids of revoked Celery tasks instead of sending the revocation to the broker
+    """
+    task_ids = []
+    control = run_leeway_simulation.app.control
+    monkeypatch.setattr(control, "revoke", lambda task_id, **kwargs: task_ids.append(task_id))
+    return task_ids
+
+
 @pytest.fixture
 def uuid_store():
     """
@@ -59,12 +105,18 @@ def uuid_store():
 
 
 @pytest.fixture(autouse=True)
-# pylint: disable=redefined-outer-name,unused-argument
-def _run_teardown(uuid_store, settings, celery_worker):
+# pylint: disable=redefined-outer-name
+def _run_teardown(request, settings):
     """
     Run additional simulation checks after the test body and after the celery
     worker has finished processing, but before the worker shuts down.
+    Unit tests which don't use the celery worker run without a broker.
     """
+    if "celery_worker" not in request.fixturenames:
+        yield
+        return
+    uuid_store = request.getfixturevalue("uuid_store")
+    request.getfixturevalue("celery_worker")
     yield
     if uuid_store:
         uuid = uuid_store[0]
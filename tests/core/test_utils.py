@@ -0,0 +1,26 @@
+from opendrift_leeway_webgui.core import utils
+
+
+def test_host_concurrency(monkeypatch):
+    """
+    Test that the concurrency is bounded by the cores and the memory without the reserved processes
+    """
+    monkeypatch.setattr(utils, "host_cpus", lambda: 16.0)
+    monkeypatch.setattr(utils, "host_memory", lambda: 33 * 1024)
+    assert utils.host_concurrency(1, 4096, reserved_memory=1024) == 8
+    assert utils.host_concurrency(4, 1024) == 4
+    assert utils.host_concurrency(1, 4096, reserved_memory=1024, reserved_processes=2) == 6
+    assert utils.host_concurrency(1, 64 * 1024) == 1
+    assert utils.host_concurrency(1, 4096, reserved_processes=20) == 1
+
+
+def test_host_concurrency_without_limits(monkeypatch):
+    """
+    Test that unlimited cores or memory don't bound the concurrency
+    """
+    monkeypatch.setattr(utils, "host_cpus", lambda: 16.0)
+    monkeypatch.setattr(utils, "host_memory", lambda: 8 * 1024)
+    assert utils.host_concurrency(2, 0) == 8
+    assert utils.host_concurrency(0, 1024) == 8
+    assert utils.host_concurrency(0, 0) == 16
+    assert utils.host_concurrency(0, 0, reserved_processes=4) == 12
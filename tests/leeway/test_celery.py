@@ -0,0 +1,27 @@
+import pytest
+
+from opendrift_leeway_webgui.leeway import celery
+
+
+@pytest.mark.parametrize(("concurrency", "expected"), [(0, 7), (None, 7), (3, 3)])
+def test_worker_concurrency(monkeypatch, concurrency, expected):
+    """
+    Test that a worker without configured concurrency starts its pool with the concurrency derived from the host
+    """
+    monkeypatch.setattr(celery, "host_concurrency", lambda *args: 7)
+    worker = celery.app.Worker(hostname="test@localhost", concurrency=concurrency, pool_cls="prefork", quiet=True)
+    assert worker.concurrency == expected
+    assert worker.min_concurrency == expected
+
+
+def test_configured_worker_concurrency(settings, monkeypatch):
+    """
+    Test that a worker keeps the concurrency configured with CELERY_WORKER_CONCURRENCY
+    """
+    monkeypatch.setattr(celery, "host_concurrency", lambda *args: 7)
+    # The Celery configuration is read from the Django settings (see LEEWAY_CELERY_WORKER_CONCURRENCY)
+    settings.CELERY_WORKER_CONCURRENCY = 5
+    assert celery.app.conf.worker_concurrency == 5
+    worker = celery.app.Worker(hostname="test@localhost", pool_cls="prefork", quiet=True)
+    assert worker.concurrency == 5
+    assert worker.min_concurrency == 5
@@ -0,0 +1,47 @@
+from opendrift_leeway_webgui.leeway.progress import (
+    PROGRESS_PREFIX,
+    clear_progress,
+    get_progress,
+    parse_progress,
+    set_progress,
+)
+
+
+def test_parse_progress():
+    """
+    Test that only valid progress lines of the simulation output are parsed
+    """
+    assert parse_progress(f'{PROGRESS_PREFIX}{{"phase": "simulation", "step": 3, "steps": 12}}') == {
+        "phase": "simulation",
+        "step": 3,
+        "steps": 12,
+    }
+    assert parse_progress(f"{PROGRESS_PREFIX}{{invalid") is None
+    assert parse_progress("Simulation finished") is None
+
+
+def test_progress_cache(settings):
+    """
+    Test that the progress is stored in the progress cache and removed once the simulation is finished
+    """
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.dummy.DummyCache"},
+        "progress": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    }
+    set_progress("uuid", {"phase": "simulation"})
+    assert get_progress("uuid") == {"phase": "simulation"}
+    clear_progress("uuid")
+    assert get_progress("uuid") is None
+
+
+def test_progress_cache_unavailable(settings):
+    """
+    Test that an unavailable progress cache doesn't fail the simulation
+    """
+    settings.CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+        "progress": {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://localhost:1/1"},
+    }
+    set_progress("uuid", {"phase": "simulation"})
+    assert get_progress("uuid") is None
+    clear_progress("uuid")
@@ -0,0 +1,128 @@
+import os
+import time
+from types import SimpleNamespace
+
+import pytest
+from celery.exceptions import SoftTimeLimitExceeded
+
+from opendrift_leeway_webgui.leeway import runners
+
+
+def test_run_in_worker_without_heartbeat(settings, tmp_path):
+    """
+    Test that a job fails instead of waiting forever if the simulation worker is not running
+    """
+    settings.SIMULATION_QUEUE = str(tmp_path)
+    exit_code, _, stderr = runners.run_in_worker("job", ["--id", "job"], poll_interval=0)
+    assert exit_code == 1
+    assert "did not respond" in stderr
+    assert not list(tmp_path.iterdir())
+
+
+def test_run_in_worker_with_stale_heartbeat(settings, tmp_path):
+    """
+    Test that a job fails if the heartbeat of the simulation worker is older than the timeout
+    """
+    settings.SIMULATION_QUEUE = str(tmp_path)
+    settings.SIMULATION_WORKER_TIMEOUT = 10
+    heartbeat = tmp_path / runners.WORKER_HEARTBEAT
+    heartbeat.touch()
+    os.utime(heartbeat, (time.time() - 20, time.time() - 20))
+    exit_code, _, _ = runners.run_in_worker("job", ["--id", "job"], poll_interval=0)
+    assert exit_code == 1
+    assert not (tmp_path / "job.json").exists()
+
+
+@pytest.mark.parametrize("running", [False, True])
+def test_run_in_worker_interrupted(settings, tmp_path, monkeypatch, running):
+    """
+    Test that the job is withdrawn if the task is stopped while it waits for the simulation worker
+    """
+    settings.SIMULATION_QUEUE = str(tmp_path)
+
+    def sleep(seconds):
+        if running:
+            (tmp_path / "job-render.json").rename(tmp_path / "job-render.running")
+        raise SoftTimeLimitExceeded()
+
+    monkeypatch.setattr(runners.time, "sleep", sleep)
+    with pytest.raises(SoftTimeLimitExceeded):
+        runners.run_in_worker("job-render", ["--id", "job", "--render"])
+    assert not (tmp_path / "job-render.json").exists()
+    # A running job is stopped via the cancel file of its simulation and its result is discarded by the worker
+    assert (tmp_path / "job-render.abandoned").exists() == running
+    assert (tmp_path / "job.cancel").exists() == running
+
+
+def test_run_in_process_in_prefork_child(monkeypatch):
+    """
+    Test that ensemble members run sequentially in the daemonic children of the Celery prefork pool
+    """
+    calls = []
+
+    def run_arguments(arguments, landmask):
+        calls.append(arguments)
+        print("Simulation finished")
+        return 0
+
+    monkeypatch.setattr(runners, "simulation_module", lambda: SimpleNamespace(run_arguments=run_arguments))
+    monkeypatch.setattr(runners, "in_process_landmask", lambda: None)
+    monkeypatch.setattr(runners.billiard, "current_process", lambda: SimpleNamespace(daemon=True))
+    exit_code, stdout, _ = runners.run_in_process("job", ["--id", "job"])
+    assert exit_code == 0
+    assert "Simulation finished" in stdout
+    assert calls == [["--id", "job", "--workers", "1"]]
+
+
+def test_simulation_output_classification(settings):
+    """
+    Test that warnings and progress are separated from the output which is kept for the result
+    """
+    settings.SIMULATION_OUTPUT_TAIL = 3
+    progress = []
+    output = runners.SimulationOutput("job", on_progress=progress.append)
+    output.add_stdout('PROGRESS {"phase": "simulation", "step": 1, "steps": 2}\n')
+    output.add_stdout("Downloading 10%\rDownloading 100%\n")
+    output.add_stderr("/opt/opendrift/reader.py:12: UserWarning: Reader is slow\n")
+    output.add_stderr("  warnings.warn(message)\n")
+    output.add_stderr("WARNING: no forcing data for the last hour\n")
+    output.add_stderr("Traceback (most recent call last):\n")
+    output.add_stderr("ValueError: invalid position\n")
+    for line in range(5):
+        output.add_stdout(f"line {line}\n")
+    exit_code, stdout, stderr = output.result(1)
+    assert exit_code == 1
+    assert progress == [{"phase": "simulation", "step": 1, "steps": 2}]
+    assert stdout == "line 2\nline 3\nline 4"
+    assert stderr == "Traceback (most recent call last):\nValueError: invalid position"
+    assert output.warnings == 3
+
+
+def test_simulation_output_truncates_lines():
+    """
+    Test that long lines are truncated and only the last state of progress bars is kept
+    """
+    output = runners.SimulationOutput("job")
+    output.add_stdout("x" * 2 * runners.MAX_LINE_LENGTH)
+    output.add_stdout("Downloading 10%\rDownloading 100%\n")
+    _, stdout, _ = output.result(0)
+    assert stdout.splitlines() == ["x" * runners.MAX_LINE_LENGTH, "Downloading 100%"]
+
+
+def test_cancel_run_with_hung_docker(settings, tmp_path, monkeypatch, caplog):
+    """
+    Test that cancelling a run only waits a limited time for docker and logs the failure
+    """
+    settings.SIMULATION_QUEUE = str(tmp_path)
+    settings.SIMULATION_RUNNER = "docker"
+    timeouts = []
+
+    def run(command, timeout=None, **kwargs):
+        timeouts.append(timeout)
+        raise runners.subprocess.TimeoutExpired(command, timeout)
+
+    monkeypatch.setattr(runners.subprocess, "run", run)
+    runners.cancel_run("job")
+    assert timeouts == [runners.DOCKER_KILL_TIMEOUT]
+    assert runners.cancel_file("job").is_file()
+    assert "Could not kill the containers of simulation job" in caplog.text
@@ -0,0 +1,466 @@
+import importlib
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from types import ModuleType, SimpleNamespace
+
+import numpy as np
+import pytest
+import xarray as xr
+
+
+@pytest.fixture(scope="module")
+def simulation():
+    """
+    Import the simulation script, with stubs of the OpenDrift modules if OpenDrift is not installed,
+    so its helpers are tested without the simulation environment
+    """
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        try:
+            importlib.import_module("opendrift.models.leeway")
+        except ImportError:
+            stubs = {
+                "opendrift": {},
+                "opendrift.models": {},
+                "opendrift.models.leeway": {"Leeway": None},
+                "opendrift.readers": {"open_dataset_opendrift": None, "reader_global_landmask": None},
+                "opendrift.readers.reader_netCDF_CF_generic": {"Reader": None},
+            }
+            for name, attributes in stubs.items():
+                module = ModuleType(name)
+                module.__dict__.update(attributes)
+                monkeypatch.setitem(sys.modules, name, module)
+        # Import the script again and remove it afterwards, so other tests don't get the stubs
+        monkeypatch.delitem(sys.modules, "opendrift_leeway_webgui.simulation", raising=False)
+        module = importlib.import_module("opendrift_leeway_webgui.simulation")
+        yield module
+        sys.modules.pop("opendrift_leeway_webgui.simulation", None)
+
+
+def test_write_geojson(tmp_path, simulation):
+    """
+    Test that the GeoJSON file is valid JSON with one geometry per particle, split where positions are missing,
+    and without particles that never had a position
+    """
+    nan = np.nan
+    lon = np.array(
+        [
+            [nan, 12.0, 12.1, 12.2, nan],
+            [12.0, 12.1, nan, 12.3, 12.4],
+            [nan, nan, 12.5, nan, nan],
+            [nan, nan, nan, nan, nan],
+            [12.0, nan, 12.2, 12.3, nan],
+        ]
+    )
+    lat = lon + 22
+    path = tmp_path / "result.geojson"
+    simulation.write_geojson(path, lon, lat, 2)
+    geometries = json.loads(path.read_text(encoding="utf-8"))["geometries"]
+    assert geometries == [
+        {"type": "LineString", "coordinates": [[12.0, 34.0], [12.1, 34.1], [12.2, 34.2]]},
+        {"type": "MultiLineString", "coordinates": [[[12.0, 34.0], [12.1, 34.1]], [[12.3, 34.3], [12.4, 34.4]]]},
+        {"type": "Point", "coordinates": [12.5, 34.5]},
+        {"type": "MultiLineString", "coordinates": [[[12.0, 34.0], [12.0, 34.0]], [[12.2, 34.2], [12.3, 34.3]]]},
+    ]
+    assert not (tmp_path / "result.geojson.PART").exists()
+    simulation.write_geojson(path, lon[3:4], lat[3:4], 2)
+    assert json.loads(path.read_text(encoding="utf-8")) == {"type": "GeometryCollection", "geometries": []}
+
+
+def test_valid_index(simulation):
+    """
+    Test the indices of the first and last positions of particles which are seeded late, stranded or never seeded
+    """
+    nan = np.nan
+    lon = np.array(
+        [
+            [12.0, 12.1, 12.2, 12.3],
+            [nan, nan, 12.2, 12.3],
+            [12.0, 12.1, nan, nan],
+            [nan, 12.1, nan, nan],
+            [nan, nan, nan, nan],
+        ]
+    )
+    assert simulation.first_valid_index(lon).tolist() == [0, 2, 0, 1, -1]
+    assert simulation.last_valid_index(lon).tolist() == [3, 3, 1, 1, -1]
+    assert simulation.first_valid_index(np.empty((2, 0))).tolist() == [-1, -1]
+    assert simulation.last_valid_index(np.empty((2, 0))).tolist() == [-1, -1]
+
+
+def test_plot_trajectories_single_time_step(simulation):
+    """
+    Test that trajectories with only one time step are plotted without segments
+    """
+    matplotlib = pytest.importorskip("matplotlib")
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt  # pylint: disable=import-outside-toplevel
+
+    _, ax = plt.subplots()
+    # Plain axes with the identity as map projection
+    ax.projection = SimpleNamespace(transform_points=lambda transform, x, y: np.stack([x, y, np.zeros_like(x)], -1))
+    lon = np.array([[12.0], [np.nan]])
+    line = simulation.plot_trajectories(ax, lon, lon + 22, 12, None)
+    assert not line.get_segments()
+    assert len(line.get_array()) == 0
+    plt.close("all")
+
+
+def test_wms_tile_cache_separates_services(tmp_path, simulation):
+    """
+    Test that the tiles of the same layer of different WMS are cached in different files
+    """
+    cache = simulation.WMSTileCache(tmp_path, max_size=1024, timeout=1)
+    first = cache.tile_path("https://first.example.com/wms", "layer", 5, 1, 2)
+    second = cache.tile_path("https://second.example.com/wms", "layer", 5, 1, 2)
+    assert first != second
+    assert first == cache.tile_path("https://first.example.com/wms", "layer", 5, 1, 2)
+
+
+def test_wms_tile_cache_evict(tmp_path, monkeypatch, simulation):
+    """
+    Test that the cache directory is only scanned if the stored size exceeds the maximum size or is outdated
+    """
+    cache = simulation.WMSTileCache(tmp_path, max_size=250, timeout=1)
+    scans = []
+    scan = cache.remove_least_recently_used
+    monkeypatch.setattr(cache, "remove_least_recently_used", lambda: scans.append(1) or scan())
+    for index in range(3):
+        tile = tmp_path / f"{index}.png"
+        tile.write_bytes(b"0" * 100)
+        simulation.os.utime(tile, (index, index))
+    cache.evict()
+    assert sorted(path.name for path in tmp_path.glob("*.png")) == ["1.png", "2.png"]
+    assert cache.size == 200
+    assert len(scans) == 1
+    # Tiles of other processes are only noticed by the next scan
+    (tmp_path / "3.png").write_bytes(b"0" * 100)
+    cache.evict()
+    assert len(list(tmp_path.glob("*.png"))) == 3
+    assert len(scans) == 1
+    # The size is shared with other processes, which add the tiles they fetched
+    other = simulation.WMSTileCache(tmp_path, max_size=250, timeout=1)
+    other.evict()
+    assert other.size == 200
+    other.fetched = 100
+    other.evict()
+    assert other.size == 200
+    assert sorted(path.name for path in tmp_path.glob("*.png")) == ["2.png", "3.png"]
+    # An outdated size is corrected by scanning the cache directory again
+    cache.SCAN_INTERVAL = -1
+    cache.evict()
+    assert cache.size == 200
+    assert len(scans) == 2
+
+
+def test_wms_tile_cache_get(file_server, tmp_path, simulation):
+    """
+    Test that missing tiles are fetched from the WMS, cached tiles are reused and failed requests are counted
+    """
+    directory, url = file_server
+    (directory / "wms.png").write_bytes(b"0" * 100)
+    (directory / "error.html").write_text("Invalid layer", encoding="utf-8")
+    cache = simulation.WMSTileCache(tmp_path / "cache", max_size=150, timeout=5)
+    path = cache.get(f"{url}/wms.png", "layer", 5, 1, 2)
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert open(path, "rb").read() == b"0" * 100
+    assert cache.get(f"{url}/wms.png", "layer", 5, 1, 2) == path
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert cache.get(f"{url}/error.html", "layer", 5, 1, 2) is None
+    assert cache.get(f"{url}/missing.png", "layer", 5, 1, 2) is None
+    assert cache.errors == 2
+    other = cache.get(f"{url}/wms.png", "layer", 5, 1, 3)
+    os.utime(path, (0, 0))
+    # The least recently used tile is removed
+    cache.evict()
+    assert cache.size == 100
+    assert not os.path.exists(path)
+    assert os.path.exists(other)
+
+
+def test_crop_dataset(simulation):
+    """
+    Test that forcing data is cropped to the drift envelope with a margin of grid cells and time steps
+    """
+    times = np.arange("2026-10-01T00", "2026-10-03T00", 3, dtype="datetime64[h]").astype("datetime64[ns]")
+    ds = xr.Dataset(
+        {"x_wind": (("time", "lat", "lon"), np.zeros((len(times), 21, 41)))},
+        coords={"time": times, "lat": np.arange(40.0, 29.5, -0.5), "lon": np.arange(0.0, 20.5, 0.5)},
+    )
+    cropped = simulation.crop_dataset(ds, (10.2, 11.4, 34.1, 34.8), datetime(2026, 10, 1, 7), datetime(2026, 10, 1, 13))
+    assert cropped.lon.values.tolist() == [9.5, 10.0, 10.5, 11.0, 11.5, 12.0]
+    assert cropped.lat.values.tolist() == [35.5, 35.0, 34.5, 34.0, 33.5]
+    assert cropped.time.values.tolist() == ds.time.values[2:6].tolist()
+
+
+def test_crop_dataset_across_longitude_seam(simulation):
+    """
+    Test that the longitudes of a 0-360° dataset are not cropped if the envelope crosses its seam
+    """
+    ds = xr.Dataset(coords={"lat": np.arange(-10.0, 11.0), "lon": np.arange(0.0, 360.0)})
+    cropped = simulation.crop_dataset(ds, (-1.0, 1.0, -1.0, 1.0), datetime(2026, 10, 1), datetime(2026, 10, 2))
+    assert cropped.sizes["lon"] == 360
+    assert cropped.lat.values.tolist() == list(range(-3, 4))
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/clear_refs"), reason="Requires Linux")
+def test_phase_timer_peak_rss_per_simulation(simulation):
+    """
+    Test that the peak memory of a simulation doesn't include the peak of an earlier simulation in the same process
+    """
+    timer = simulation.PhaseTimer()
+    data = np.ones(256 * 2**20 // 8)
+    del data
+    first = timer.record()["peak_rss_mb"]
+    timer.report()
+    timer.reset()
+    assert timer.record()["peak_rss_mb"] < first - 200
+
+
+def test_phase_timer_peak_rss_without_reset(monkeypatch, capsys, simulation):
+    """
+    Test that the lifetime peak memory is only recorded for the first simulation if it can't be reset
+    """
+    monkeypatch.setattr(simulation, "reset_peak_rss", lambda: False)
+    timer = simulation.PhaseTimer()
+    assert "peak_rss_mb" in timer.record()
+    timer.report()
+    assert capsys.readouterr().out.startswith(simulation.PhaseTimer.PREFIX)
+    timer.reset()
+    assert "peak_rss_mb" not in timer.record()
+
+
+def test_fail_interrupted_jobs(tmp_path, simulation):
+    """
+    Test that only the jobs of stopped workers fail, while jobs of other workers sharing the queue keep running
+    """
+    for job_id in ("alive", "dead"):
+        (tmp_path / f"{job_id}.json").write_text(json.dumps({"args": []}), encoding="utf-8")
+    lock = simulation.claim_job(str(tmp_path), "alive")
+    # The job can only be claimed once
+    assert simulation.claim_job(str(tmp_path), "alive") is None
+    # The lock of a stopped worker is released by the kernel
+    simulation.claim_job(str(tmp_path), "dead").close()
+    with lock:
+        simulation.fail_interrupted_jobs(str(tmp_path))
+        assert (tmp_path / "alive.running").exists()
+        assert not (tmp_path / "alive.done").exists()
+    assert not (tmp_path / "dead.running").exists()
+    assert (tmp_path / "dead.done").read_text(encoding="utf-8") == "1"
+    assert "stopped" in (tmp_path / "dead.err").read_text(encoding="utf-8")
+
+
+def test_job_expired(tmp_path, simulation):
+    """
+    Test that jobs whose task timed out or was stopped are recognized
+    """
+    job = tmp_path / "job.running"
+    job.write_text(json.dumps({"args": [], "expires": time.time() + 60}), encoding="utf-8")
+    assert not simulation.job_expired(str(job))
+    (tmp_path / "job.abandoned").touch()
+    assert simulation.job_expired(str(job))
+    (tmp_path / "job.abandoned").unlink()
+    job.write_text(json.dumps({"args": [], "expires": time.time() - 60}), encoding="utf-8")
+    assert simulation.job_expired(str(job))
+    # Jobs without expiry are never discarded
+    job.write_text(json.dumps({"args": []}), encoding="utf-8")
+    assert not simulation.job_expired(str(job))
+
+
+def test_case_cancelled(tmp_path, monkeypatch, simulation):
+    """
+    Test that cancelled cases of a batch are recognized by their own cancel file
+    """
+    monkeypatch.setattr(simulation, "QUEUEDIR", str(tmp_path))
+    (tmp_path / "member.cancel").touch()
+    assert simulation.case_cancelled({"id": "member"})
+    assert not simulation.case_cancelled({"id": "leader"})
+
+
+def test_discard_job(tmp_path, simulation):
+    """
+    Test that all files of a discarded job are removed, including the cancel file of its simulation
+    """
+    (tmp_path / "job-render.running").write_text(json.dumps({"args": ["--id", "job", "--render"]}), encoding="utf-8")
+    for name in ("job-render.log", "job-render.err", "job-render.abandoned", "job.cancel", "other.cancel"):
+        (tmp_path / name).touch()
+    simulation.discard_job(str(tmp_path), "job-render")
+    assert [path.name for path in tmp_path.iterdir()] == ["other.cancel"]
+
+
+def test_write_netcdf_in_memory_results(tmp_path, simulation):
+    """
+    Test that results which OpenDrift kept in memory are stored with the types declared in their attributes
+    """
+    status = np.array([[0, 0, np.nan]], dtype=np.float32)
+    ds = xr.Dataset(
+        {
+            "status": (("trajectory", "time"), status, {"dtype": np.int32}),
+            "lon": (("trajectory", "time"), np.array([[12.0, 12.1, np.nan]], dtype=np.float32), {"dtype": np.float32}),
+        },
+        coords={
+            "trajectory": ("trajectory", [0], {"dtype": np.int32}),
+            "time": ("time", [datetime(2026, 10, 1, hour) for hour in range(3)], {"dtype": np.float64}),
+        },
+    )
+    args = SimpleNamespace(
+        netcdf_precision="float32", netcdf_compression="zlib", netcdf_compression_level=4, netcdf_chunk_trajectories=1
+    )
+    simulation.write_netcdf(ds, str(tmp_path / "result.nc"), args)
+    assert ds["status"].attrs == {"dtype": np.int32}
+    with xr.open_dataset(tmp_path / "result.nc") as result:
+        assert result["status"].encoding["dtype"] == np.int32
+        assert result["trajectory"].dtype == np.int32
+        np.testing.assert_array_equal(result["status"].values, status)
+        np.testing.assert_array_equal(result["time"].values, ds["time"].values)
+
+
+class FakeDataset:
+    """
+    Dataset which records whether it was closed
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_reader_cache(monkeypatch, simulation):
+    """
+    Test that datasets are reused until they expire or a new forecast cycle starts
+    """
+    now = [0.0]
+    monkeypatch.setattr(simulation, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    opened = []
+
+    def opener(key):
+        def factory():
+            opened.append(FakeDataset(key))
+            return opened[-1]
+
+        return factory
+
+    cache = simulation.ReaderCache(ttl=60, cycle_hours=6)
+    cycle = datetime(2026, 10, 1, 0)
+    first = cache.get("wind", opener("wind"), cycle=cycle)
+    assert cache.get("wind", opener("wind"), cycle=cycle) is first
+    assert cache.get("current", opener("current"), cycle=cycle) is not first
+    assert (cache.hits, cache.misses) == (1, 2)
+    # Expired after the time to live
+    now[0] = 61.0
+    second = cache.get("wind", opener("wind"), cycle=cycle)
+    assert second is not first
+    assert first.closed
+    # Invalidated by a new forecast cycle
+    third = cache.get("wind", opener("wind"), cycle=datetime(2026, 10, 1, 6))
+    assert third is not second
+    assert second.closed
+    assert not third.closed
+    assert (cache.hits, cache.misses) == (1, 4)
+    assert [dataset.key for dataset in opened] == ["wind", "current", "wind", "wind"]
+    # Forked processes forget the entries without closing the datasets of the parent
+    cache.reset()
+    assert cache.get("wind", opener("wind"), cycle=datetime(2026, 10, 1, 6)) is not third
+    assert not third.closed
+
+
+def test_reader_cache_current_cycle(simulation):
+    """
+    Test that the current forecast cycle starts at a multiple of the cycle interval
+    """
+    cycle = simulation.ReaderCache(ttl=60, cycle_hours=6).current_cycle()
+    assert cycle.hour % 6 == 0
+    assert (cycle.minute, cycle.second, cycle.microsecond) == (0, 0, 0)
+    assert datetime.now(cycle.tzinfo) - cycle < timedelta(hours=6)
+
+
+def test_simulate_ensemble_removes_member_files(tmp_path, monkeypatch, simulation):
+    """
+    Test that the files of the finished and the failed members are removed if a member fails
+    """
+    monkeypatch.setattr(simulation, "OUTPUTDIR", str(tmp_path))
+    case = {"id": "ensemble"}
+
+    def run_ensemble_member(args, case, member):
+        member_file = simulation.ensemble_member_file(case, member)
+        with open(member_file, "wb") as fp:
+            fp.write(b"partial")
+        if member == 1:
+            raise ValueError("Member failed")
+        return member_file, None
+
+    monkeypatch.setattr(simulation, "run_ensemble_member", run_ensemble_member)
+    args = SimpleNamespace(workers=1, ensemble=3, outputs="nc")
+    with pytest.raises(ValueError, match="Member failed"):
+        simulation.simulate_ensemble(args, case)
+    assert not list(tmp_path.iterdir())
+
+
+def test_ensemble_member_rng(simulation):
+    """
+    Test that the perturbations of the members depend on the case, but are reproducible
+    """
+
+    def draw(case_id, member):
+        return simulation.ensemble_member_rng({"id": case_id}, member).normal(size=3).tolist()
+
+    assert draw("first", 1) == draw("first", 1)
+    assert draw("first", 1) != draw("first", 2)
+    assert draw("first", 1) != draw("second", 1)
+
+
+def test_simulate_ensemble_merge(tmp_path, monkeypatch, simulation):
+    """
+    Test that the members are merged on the time axis of the nominal start and the probability density
+    of the final positions is added
+    """
+    monkeypatch.setattr(simulation, "OUTPUTDIR", str(tmp_path))
+    start = datetime(2026, 10, 1, 12)
+    case = {"id": "ensemble", "start_time": start, "object_type": 27}
+    nan = np.nan
+    tracks = {
+        # Both members have two particles, the second member starts one hour earlier
+        0: (start, [[11.8, 11.9, 12.0], [11.8, 11.9, 12.0]], [[33.8, 33.9, 34.0], [33.8, 33.9, 34.0]]),
+        1: (
+            start - timedelta(hours=1),
+            [[12.2, 12.3, 12.4, 12.5], [12.3, 12.4, 12.5, nan]],
+            [[34.2, 34.3, 34.4, 34.5], [34.3, 34.4, 34.5, nan]],
+        ),
+    }
+
+    def run_ensemble_member(args, case, member):
+        member_start, lon, lat = tracks[member]
+        times = [member_start + timedelta(hours=hour) for hour in range(len(lon[0]))]
+        member_file = simulation.ensemble_member_file(case, member)
+        xr.Dataset(
+            {"lon": (("trajectory", "time"), np.array(lon)), "lat": (("trajectory", "time"), np.array(lat))},
+            coords={"trajectory": [0, 1], "time": times},
+        ).to_netcdf(member_file)
+        return member_file, None
+
+    results = []
+    monkeypatch.setattr(simulation, "run_ensemble_member", run_ensemble_member)
+    monkeypatch.setattr(simulation, "Leeway", lambda loglevel: SimpleNamespace(leewayprop={27: {"OBJKEY": "PIW-1"}}))
+    monkeypatch.setattr(simulation, "write_results", lambda ds, *args: results.append(ds))
+    args = SimpleNamespace(workers=1, ensemble=2, outputs="geojson")
+    simulation.simulate_ensemble(args, case)
+    (ds,) = results
+    assert ds.attrs["ensemble_members"] == 2
+    assert ds["trajectory"].values.tolist() == [0, 1, 2, 3]
+    times = np.array([start + timedelta(hours=hour) for hour in range(3)], dtype="datetime64[ns]")
+    np.testing.assert_array_equal(ds["time"].values, times)
+    np.testing.assert_array_equal(ds["lon"].values[2], [12.3, 12.4, 12.5])
+    np.testing.assert_array_equal(ds["lon"].values[3], [12.4, 12.5, nan])
+    density = ds["probability_density"]
+    assert density.shape == (50, 50)
+    assert density.values.sum() == pytest.approx(1)
+    # Half of the particles end in the south west, the other half including the stranded one in the north east
+    assert density.values[0, 0] == pytest.approx(0.5)
+    assert density.values[-1, -1] == pytest.approx(0.5)
+    assert density["density_lon"].values[0] == pytest.approx(12.005)
+    assert density["density_lat"].values[-1] == pytest.approx(34.495)
+    assert not list(tmp_path.iterdir())
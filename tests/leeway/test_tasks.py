@@ -0,0 +1,401 @@
+import json
+from datetime import timedelta
+from types import SimpleNamespace
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.utils import timezone
+
+from opendrift_leeway_webgui.leeway.models import LeewaySimulation
+from opendrift_leeway_webgui.leeway.runners import SIMULATION_RUNNERS, cancel_file
+from opendrift_leeway_webgui.leeway.tasks import (
+    cancel_simulation,
+    claim_batch_members,
+    claim_simulation_of_user,
+    compatible_simulations,
+    finish_cancelled_simulation,
+    parse_timing,
+    render_leeway_simulation,
+    resource_limits,
+    run_leeway_simulation,
+)
+
+
+class Retry(Exception):
+    """
+    Raised by :func:`retry` instead of Celery's retry
+    """
+
+
+def retry(countdown):
+    """
+    Replace the retry of the bound task
+    """
+    return Retry(countdown)
+
+
+@pytest.fixture
+def simulation_root(settings, tmp_path, monkeypatch):
+    """
+    Run the simulations with the fake runner in a temporary simulation root
+    """
+    settings.SIMULATION_RUNNER = "fake"
+    settings.SIMULATION_ROOT = str(tmp_path)
+    settings.SIMULATION_QUEUE = str(tmp_path / "queue")
+    settings.SIMULATION_OUTPUT = str(tmp_path / "output")
+    # The storage of the result image is configured on import, but its path is needed for the result mail
+    monkeypatch.setattr(LeewaySimulation._meta.get_field("img").storage, "location", settings.SIMULATION_OUTPUT)
+    return tmp_path
+
+
+def test_resource_limits(settings):
+    """
+    Test that the limits scale with the processes of ensemble simulations and the simulated drifter hours
+    """
+    settings.SIMULATION_CPUS = 1.5
+    settings.SIMULATION_MEMORY = 1000
+    settings.SIMULATION_MEMORY_PER_DRIFTER_HOUR = 0.5
+    settings.SIMULATION_ENSEMBLE_WORKERS = 2
+    settings.OPENDRIFT_NUMBER_DRIFTERS = 10
+    single = SimpleNamespace(ensemble_members=1, duration=12)
+    ensemble = SimpleNamespace(ensemble_members=8, duration=6)
+    assert resource_limits([single]) == {"cpus": 1.5, "memory": 1060}
+    assert resource_limits([single, ensemble]) == {"cpus": 3.0, "memory": 2090}
+
+
+def test_resource_limits_without_memory_limit(settings):
+    """
+    Test that the memory is not limited if :setting:`SIMULATION_MEMORY` is ``0``
+    """
+    settings.SIMULATION_MEMORY = 0
+    assert resource_limits([SimpleNamespace(ensemble_members=1, duration=12)])["memory"] == 0
+
+
+@pytest.mark.django_db
+def test_claim_simulation_of_user(settings):
+    """
+    Test that a simulation is only claimed while its user runs fewer than the maximum number of simulations
+    """
+    settings.SIMULATION_MAX_RUNNING_PER_USER = 1
+    settings.SIMULATION_USER_RETRY_DELAY = 42
+    user = get_user_model().objects.create(username="user")
+    first = LeewaySimulation.objects.create(user=user, longitude=12.6, latitude=35.4)
+    second = LeewaySimulation.objects.create(user=user, longitude=12.6, latitude=35.4)
+    task = SimpleNamespace(retry=retry)
+    assert claim_simulation_of_user(task, first)
+    with pytest.raises(Retry, match="42"):
+        claim_simulation_of_user(task, second)
+    second.refresh_from_db()
+    assert second.simulation_started is None
+    first.simulation_finished = timezone.now()
+    first.save()
+    assert claim_simulation_of_user(task, second)
+    assert not claim_simulation_of_user(task, LeewaySimulation.objects.get(pk=second.pk))
+
+
+@pytest.mark.django_db
+def test_claim_batch_members(settings):
+    """
+    Test that simulations of users at capacity are not claimed as members of a batch
+    """
+    settings.SIMULATION_MAX_RUNNING_PER_USER = 1
+    busy = get_user_model().objects.create(username="busy")
+    idle = get_user_model().objects.create(username="idle")
+    leader = LeewaySimulation.objects.create(user=busy, longitude=12.6, latitude=35.4)
+    claim_simulation_of_user(SimpleNamespace(retry=retry), leader)
+    held_back = LeewaySimulation.objects.create(user=busy, longitude=12.6, latitude=35.4)
+    member = LeewaySimulation.objects.create(user=idle, longitude=12.6, latitude=35.4)
+    assert claim_batch_members(leader) == [member]
+    held_back.refresh_from_db()
+    assert held_back.simulation_started is None
+
+
+@pytest.mark.django_db
+def test_claim_simulation_of_user_ensembles(settings):
+    """
+    Test that only :setting:`SIMULATION_MAX_RUNNING_ENSEMBLES` ensemble simulations are claimed at the same time,
+    while simulations with one member are not held back by them
+    """
+    settings.SIMULATION_MAX_RUNNING_PER_USER = 0
+    settings.SIMULATION_MAX_RUNNING_ENSEMBLES = 1
+    first = get_user_model().objects.create(username="first")
+    second = get_user_model().objects.create(username="second")
+    task = SimpleNamespace(retry=retry)
+    running = LeewaySimulation.objects.create(user=first, longitude=12.6, latitude=35.4, ensemble_members=4)
+    assert claim_simulation_of_user(task, running)
+    waiting = LeewaySimulation.objects.create(user=second, longitude=12.6, latitude=35.4, ensemble_members=4)
+    with pytest.raises(Retry):
+        claim_simulation_of_user(task, waiting)
+    single = LeewaySimulation.objects.create(user=second, longitude=12.6, latitude=35.4)
+    assert claim_simulation_of_user(task, single)
+    running.simulation_finished = timezone.now()
+    running.save()
+    assert claim_simulation_of_user(task, waiting)
+
+
+@pytest.mark.django_db
+def test_cancel_simulation_queued(settings, tmp_path, revoked):
+    """
+    Test that a queued simulation is cancelled by revoking its task without stopping a run
+    """
+    settings.SIMULATION_QUEUE = str(tmp_path)
+    user = get_user_model().objects.create(username="user")
+    simulation = LeewaySimulation.objects.create(user=user, longitude=12.6, latitude=35.4)
+    assert cancel_simulation(simulation)
+    assert simulation.status == "cancelled"
+    assert revoked == [str(simulation.uuid)]
+    assert not cancel_file(str(simulation.uuid)).exists()
+
+
+@pytest.mark.django_db
+def test_cancel_simulation_running(settings, tmp_path, revoked):
+    """
+    Test that the run of a running simulation is stopped and its partial results are removed
+    """
+    settings.SIMULATION_RUNNER = "fake"
+    settings.SIMULATION_QUEUE = str(tmp_path / "queue")
+    settings.SIMULATION_OUTPUT = str(tmp_path / "output")
+    user = get_user_model().objects.create(username="user")
+    simulation = LeewaySimulation.objects.create(
+        user=user, longitude=12.6, latitude=35.4, simulation_started=timezone.now()
+    )
+    (tmp_path / "output").mkdir()
+    (tmp_path / "output" / f"{simulation.uuid}.nc.tmp").touch()
+    assert cancel_simulation(simulation)
+    assert simulation.status == "cancelled"
+    assert revoked == [str(simulation.uuid)]
+    assert cancel_file(str(simulation.uuid)).exists()
+    assert not list((tmp_path / "output").iterdir())
+    # The task removes the cancel file once the run has stopped
+    finish_cancelled_simulation(simulation)
+    assert not cancel_file(str(simulation.uuid)).exists()
+
+
+@pytest.mark.django_db
+def test_cancel_simulation_finished(settings, tmp_path, revoked):
+    """
+    Test that finished simulations can't be cancelled
+    """
+    settings.SIMULATION_QUEUE = str(tmp_path)
+    user = get_user_model().objects.create(username="user")
+    simulation = LeewaySimulation.objects.create(
+        user=user,
+        longitude=12.6,
+        latitude=35.4,
+        simulation_started=timezone.now(),
+        simulation_finished=timezone.now(),
+    )
+    assert not cancel_simulation(simulation)
+    simulation.refresh_from_db()
+    assert simulation.status == "finished"
+    assert not revoked
+    assert not cancel_file(str(simulation.uuid)).exists()
+
+
+@pytest.mark.django_db
+def test_cancel_simulation_between_stages(settings, tmp_path, revoked):
+    """
+    Test that the render task removes the cancel file of a simulation which was cancelled after its run
+    """
+    settings.SIMULATION_RUNNER = "fake"
+    settings.SIMULATION_QUEUE = str(tmp_path / "queue")
+    settings.SIMULATION_OUTPUT = str(tmp_path / "output")
+    user = get_user_model().objects.create(username="user")
+    simulation = LeewaySimulation.objects.create(
+        user=user, longitude=12.6, latitude=35.4, simulation_started=timezone.now()
+    )
+    assert cancel_simulation(simulation)
+    assert f"{simulation.uuid}-render" not in revoked
+    render_leeway_simulation(simulation.uuid)
+    assert not cancel_file(str(simulation.uuid)).exists()
+
+
+@pytest.mark.django_db
+def test_compatible_simulations(settings):
+    """
+    Test that only pending simulations close in space and time with the same duration and outputs are batched
+    """
+    settings.SIMULATION_BATCH_TIME_WINDOW = 6
+    settings.SIMULATION_BATCH_DISTANCE = 50
+    settings.SIMULATION_BATCH_SIZE = 10
+    user = get_user_model().objects.create(username="user")
+    start = timezone.now()
+
+    def create(**kwargs):
+        return LeewaySimulation.objects.create(
+            **{"user": user, "longitude": 12.6, "latitude": 35.4, "start_time": start, **kwargs}
+        )
+
+    leader = create()
+    nearby = create(longitude=12.8, latitude=35.6, start_time=start + timedelta(hours=5))
+    # Different object types are seeded into the same run
+    other_object = create(object_type=1)
+    create(start_time=start - timedelta(hours=7))
+    create(latitude=36.0)
+    create(ensemble_members=4)
+    create(profiling=True)
+    create(outputs="nc")
+    create(duration=1)
+    create(simulation_started=timezone.now())
+    create(simulation_cancelled=timezone.now())
+    assert list(compatible_simulations(leader)) == [nearby, other_object]
+    settings.SIMULATION_BATCH_SIZE = 2
+    assert list(compatible_simulations(leader)) == [nearby]
+
+
+@pytest.mark.django_db
+def test_run_batch(settings, tmp_path, simulation_root, mailoutbox):
+    """
+    Test that the results of a batch are mapped back to its simulations
+    """
+    settings.SIMULATION_BATCHING = True
+    settings.SIMULATION_RENDER_STAGE = False
+    start = timezone.now()
+    leader = LeewaySimulation.objects.create(
+        user=get_user_model().objects.create(username="leader", email="leader@example.com"),
+        longitude=12.6,
+        latitude=35.4,
+        start_time=start,
+    )
+    member = LeewaySimulation.objects.create(
+        user=get_user_model().objects.create(username="member", email="member@example.com"),
+        longitude=12.7,
+        latitude=35.5,
+        start_time=start + timedelta(hours=1),
+        object_type=1,
+    )
+    run_leeway_simulation(str(leader.uuid))
+    for simulation in (leader, member):
+        simulation.refresh_from_db()
+        assert simulation.status == "finished"
+        assert simulation.timing["batch_size"] == 2
+        assert simulation.netcdf.name == f"{simulation.uuid}.nc"
+        assert simulation.img.name == f"{simulation.uuid}.png"
+        geojson = json.loads((tmp_path / "output" / simulation.geojson.name).read_text(encoding="utf-8"))
+        assert geojson["geometries"][0]["coordinates"][0] == [simulation.longitude, simulation.latitude]
+    assert sorted(message.to[0] for message in mailoutbox) == ["leader@example.com", "member@example.com"]
+    # The batch file is removed after the run
+    assert not list((tmp_path / "queue").iterdir())
+
+
+def test_parse_timing():
+    """
+    Test that the last timing record of the output is parsed and invalid or missing records are ignored
+    """
+    timing = {"phases": {"forcing": 4.7, "run": 0.5}, "total": 5.2, "peak_rss_mb": 2525.6}
+    stdout = f'PROGRESS {{"phase": "run"}}\nTIMING {{"total": 1}}\nTIMING {json.dumps(timing)}\nDone\n'
+    assert parse_timing(stdout) == timing
+    assert parse_timing("Simulation failed\n") is None
+    assert parse_timing("") is None
+    assert parse_timing('TIMING {"total": \n') is None
+
+
+@pytest.mark.django_db
+def test_render_stage(settings, simulation_root, monkeypatch):
+    """
+    Test that the results are rendered in a separate task after a successful run
+    """
+    settings.SIMULATION_BATCHING = False
+    settings.SIMULATION_RENDER_STAGE = True
+    rendered = []
+    monkeypatch.setattr(render_leeway_simulation, "apply_async", lambda args, **kwargs: rendered.append((args, kwargs)))
+    user = get_user_model().objects.create(username="user")
+    simulation = LeewaySimulation.objects.create(user=user, longitude=12.6, latitude=35.4, outputs="geojson,png")
+    run_leeway_simulation(str(simulation.uuid))
+    assert rendered == [
+        ([simulation.uuid], {"queue": settings.SIMULATION_RENDER_QUEUE, "task_id": f"{simulation.uuid}-render"})
+    ]
+    simulation.refresh_from_db()
+    assert simulation.status == "running"
+    assert (simulation_root / "output" / f"{simulation.uuid}.nc").is_file()
+    render_leeway_simulation(simulation.uuid)
+    simulation.refresh_from_db()
+    assert simulation.status == "finished"
+    assert simulation.img.name == f"{simulation.uuid}.png"
+    assert simulation.timing["render"]["phases"] == {"fake": 0}
+    # The NetCDF file was only kept for rendering
+    assert not simulation.netcdf
+    assert not (simulation_root / "output" / f"{simulation.uuid}.nc").exists()
+
+
+@pytest.mark.django_db
+def test_finish_simulation_without_image(settings, simulation_root, caplog):
+    """
+    Test that a missing image is only logged as error if it was requested
+    """
+    settings.SIMULATION_BATCHING = False
+    settings.SIMULATION_RENDER_STAGE = False
+    user = get_user_model().objects.create(username="user")
+    simulation = LeewaySimulation.objects.create(user=user, longitude=12.6, latitude=35.4, outputs="geojson")
+    run_leeway_simulation(str(simulation.uuid))
+    simulation.refresh_from_db()
+    assert simulation.status == "finished"
+    assert simulation.geojson.name == f"{simulation.uuid}.geojson"
+    assert "Could not find simulation result." not in caplog.text
+
+
+@pytest.mark.django_db
+def test_render_stage_with_spaced_outputs(settings, simulation_root, monkeypatch):
+    """
+    Test that requested outputs separated by comma and space are recognized when rendering
+    """
+    settings.SIMULATION_BATCHING = False
+    settings.SIMULATION_RENDER_STAGE = True
+    monkeypatch.setattr(render_leeway_simulation, "apply_async", lambda args, **kwargs: None)
+    user = get_user_model().objects.create(username="user")
+    simulation = LeewaySimulation.objects.create(user=user, longitude=12.6, latitude=35.4, outputs="png, nc")
+    assert simulation.outputs == "png,nc"
+    run_leeway_simulation(str(simulation.uuid))
+    render_leeway_simulation(simulation.uuid)
+    simulation.refresh_from_db()
+    assert simulation.status == "finished"
+    assert simulation.img.name == f"{simulation.uuid}.png"
+    assert simulation.netcdf.name == f"{simulation.uuid}.nc"
+
+
+@pytest.mark.django_db
+def test_render_stage_after_failure(settings, simulation_root, monkeypatch):
+    """
+    Test that nothing is rendered after a failed run
+    """
+    settings.SIMULATION_BATCHING = False
+    settings.SIMULATION_RENDER_STAGE = True
+    rendered = []
+    monkeypatch.setattr(render_leeway_simulation, "apply_async", lambda args, **kwargs: rendered.append(args))
+    monkeypatch.setitem(
+        SIMULATION_RUNNERS, "fake", lambda job_id, arguments, **kwargs: (1, "", "ValueError: no forcing data")
+    )
+    user = get_user_model().objects.create(username="user")
+    simulation = LeewaySimulation.objects.create(user=user, longitude=12.6, latitude=35.4)
+    run_leeway_simulation(str(simulation.uuid))
+    assert not rendered
+    simulation.refresh_from_db()
+    assert simulation.status == "failed"
+    assert simulation.error == "ValueError: no forcing data"
+
+
+@pytest.mark.django_db
+def test_render_stage_after_failure_with_netcdf(settings, simulation_root, monkeypatch):
+    """
+    Test that a NetCDF file written by a failed run is not rendered and the failure is recorded
+    """
+    settings.SIMULATION_BATCHING = False
+    settings.SIMULATION_RENDER_STAGE = True
+    rendered = []
+    monkeypatch.setattr(render_leeway_simulation, "apply_async", lambda args, **kwargs: rendered.append(args))
+    fake = SIMULATION_RUNNERS["fake"]
+
+    def fail(job_id, arguments, **kwargs):
+        fake(job_id, arguments, **kwargs)
+        return 1, "", "ValueError: simulation aborted"
+
+    monkeypatch.setitem(SIMULATION_RUNNERS, "fake", fail)
+    user = get_user_model().objects.create(username="user")
+    simulation = LeewaySimulation.objects.create(user=user, longitude=12.6, latitude=35.4, outputs="geojson,png")
+    run_leeway_simulation(str(simulation.uuid))
+    assert not rendered
+    simulation.refresh_from_db()
+    assert simulation.status == "failed"
+    assert simulation.error == "ValueError: simulation aborted"
+    assert not simulation.netcdf
+    assert not (simulation_root / "output" / f"{simulation.uuid}.nc").exists()
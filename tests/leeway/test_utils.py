@@ -0,0 +1,247 @@
+import bz2
+import shutil
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pytest
+import xarray as xr
+
+from opendrift_leeway_webgui.leeway import utils
+from opendrift_leeway_webgui.leeway.models import IconFiles
+from opendrift_leeway_webgui.leeway.utils import MAX_ENSEMBLE_MEMBERS, parse_mail_arguments
+
+
+def test_parse_mail_arguments_clamps_ensemble_members():
+    """
+    Test that the number of ensemble members of a mailed simulation is kept within the limits of the form
+    """
+    assert parse_mail_arguments("ensemble_members=1000")["ensemble_members"] == MAX_ENSEMBLE_MEMBERS
+    assert parse_mail_arguments("ensemble_members=0")["ensemble_members"] == 1
+    assert parse_mail_arguments("ensemble_members=5")["ensemble_members"] == 5
+    assert "ensemble_members" not in parse_mail_arguments("ensemble_members=many")
+
+
+def test_download_multi_stream_bz2(file_server, tmp_path, monkeypatch):
+    """
+    Test that all streams of a bz2 file which consists of several streams are decompressed
+    """
+    monkeypatch.setattr(utils, "DOWNLOAD_CHUNK_SIZE", 64)
+    directory, url = file_server
+    parts = [bytes(range(256)) * 20, b"GRIB" * 1000, b"7777"]
+    (directory / "multi.grib2.bz2").write_bytes(b"".join(bz2.compress(part) for part in parts))
+    path, compressed, decompressed, _ = utils._download_and_decompress(f"{url}/multi.grib2.bz2", tmp_path / "multi")
+    assert path.read_bytes() == b"".join(parts)
+    assert compressed == (directory / "multi.grib2.bz2").stat().st_size
+    assert decompressed == sum(len(part) for part in parts)
+
+
+def test_download_truncated_bz2(file_server, tmp_path):
+    """
+    Test that a download which ends in the middle of the bz2 stream fails
+    """
+    directory, url = file_server
+    (directory / "truncated.grib2.bz2").write_bytes(bz2.compress(bytes(range(256)) * 100)[:-20])
+    with pytest.raises(EOFError):
+        utils._download_and_decompress(f"{url}/truncated.grib2.bz2", tmp_path / "truncated")
+
+
+def test_list_bz2_files(file_server):
+    """
+    Test that the modification times and sizes are read from the directory listing
+    """
+    directory, url = file_server
+    (directory / "index.html").write_text(
+        '<a href="icon_U_10M_001.grib2.bz2">icon_U_10M_001.grib2.bz2</a>    17-Oct-2026 09:41     1234\n'
+        '<a href="icon_V_10M_001.grib2.bz2">icon_V_10M_001.grib2.bz2</a>\n'
+        '<a href="readme.txt">readme.txt</a>    17-Oct-2026 09:41     12\n',
+        encoding="utf-8",
+    )
+    assert utils._list_bz2_files(f"{url}/") == {
+        "icon_U_10M_001.grib2.bz2": (datetime(2026, 10, 17, 9, 41, tzinfo=timezone.utc), 1234),
+        "icon_V_10M_001.grib2.bz2": (None, None),
+    }
+
+
+def test_changed_time_steps():
+    """
+    Test that only complete time steps with a new or changed U or V file are downloaded
+    """
+    modified = datetime(2026, 10, 17, 9, 41, tzinfo=timezone.utc)
+    u_files = {
+        "icon_U_10M_001.grib2.bz2": (modified, 100),
+        "icon_U_10M_002.grib2.bz2": (modified, 100),
+        "icon_U_10M_003.grib2.bz2": (modified, 100),
+        "icon_U_10M_004.grib2.bz2": (modified, 100),
+    }
+    v_files = {
+        "icon_V_10M_001.grib2.bz2": (modified, 100),
+        "icon_V_10M_002.grib2.bz2": (modified, 200),
+        "icon_V_10M_003.grib2.bz2": (modified, 100),
+    }
+    known = {
+        "icon_U_10M_001.grib2.bz2": (modified, 100),
+        "icon_V_10M_001.grib2.bz2": (modified, 100),
+        "icon_U_10M_002.grib2.bz2": (modified, 100),
+        "icon_V_10M_002.grib2.bz2": (modified, 100),
+    }
+    assert utils._changed_time_steps(u_files, v_files, known) == [
+        ("icon_U_10M_002.grib2.bz2", "icon_V_10M_002.grib2.bz2"),
+        ("icon_U_10M_003.grib2.bz2", "icon_V_10M_003.grib2.bz2"),
+    ]
+
+
+def test_crop_to_regions(settings):
+    """
+    Test that the ICON time steps are cropped to each region and stored in its own subdirectory
+    """
+    ds = xr.Dataset(
+        {"u10": (("time", "latitude", "longitude"), np.zeros((1, 11, 21)))},
+        coords={"time": [0], "latitude": np.arange(30.0, 41.0), "longitude": np.arange(0.0, 21.0)},
+    )
+    settings.ICON_REGIONS = {}
+    assert [(store, cropped.sizes) for store, cropped in utils._crop_to_regions(ds, "icon")] == [
+        (Path("icon"), ds.sizes)
+    ]
+    settings.ICON_REGIONS = {"central": (10.0, 15.0, 33.0, 38.0), "west": (-5.0, 2.5, 35.5, 50.0)}
+    regions = dict(utils._crop_to_regions(ds, "icon"))
+    assert list(regions) == [Path("icon/central"), Path("icon/west")]
+    assert regions[Path("icon/central")].longitude.values.tolist() == list(range(10, 16))
+    assert regions[Path("icon/central")].latitude.values.tolist() == list(range(33, 39))
+    assert regions[Path("icon/west")].longitude.values.tolist() == [0, 1, 2]
+    assert regions[Path("icon/west")].latitude.values.tolist() == [36, 37, 38, 39, 40]
+
+
+def icon_time_steps(times, value):
+    """
+    Build ICON wind components with a constant value for the given time steps
+    """
+    shape = (len(times), 3, 4)
+    return xr.Dataset(
+        {
+            "u10": (("time", "latitude", "longitude"), np.full(shape, value)),
+            "v10": (("time", "latitude", "longitude"), np.full(shape, -value)),
+        },
+        coords={"time": times, "latitude": np.arange(34.0, 37.0), "longitude": np.arange(10.0, 14.0)},
+    )
+
+
+def read_store(store):
+    """
+    Read all time steps of a time-chunked store
+    """
+    steps = []
+    for path in sorted(Path(store).glob("*.nc")):
+        with xr.open_dataset(path) as ds:
+            assert ds["u10"].encoding["dtype"] == np.int16
+            steps.append(ds.load())
+    return xr.concat(steps, dim="time")
+
+
+def test_append_to_store(settings, tmp_path):
+    """
+    Test that the time steps of a new forecast run replace those of older runs and outdated time steps are removed
+    """
+    settings.ICON_ENCODING = "int16"
+    settings.NETCDF_COMPRESSION = "zlib"
+    settings.NETCDF_COMPRESSION_LEVEL = 4
+    start = np.datetime64("now").astype("datetime64[h]") - np.timedelta64(48, "h")
+    day = np.timedelta64(24, "h")
+    store = tmp_path / "icon"
+    written = utils._append_to_store(store, icon_time_steps([start, start + day], 1.23))
+    assert written == [store / f"{np.datetime_as_string(time, unit='h')}.nc" for time in (start, start + day)]
+    utils._append_to_store(store, icon_time_steps([start + day, start + 2 * day], 4.56))
+    ds = read_store(store)
+    np.testing.assert_array_equal(ds.time.values, [start, start + day, start + 2 * day])
+    np.testing.assert_allclose(ds["u10"].values[:, 0, 0], [1.23, 4.56, 4.56])
+    np.testing.assert_allclose(ds["v10"].values[:, 0, 0], [-1.23, -4.56, -4.56])
+    # The first time step is older than the cutoff
+    utils._append_to_store(store, icon_time_steps([start + 2 * day], 7.89), cutoff_hours=36)
+    ds = read_store(store)
+    np.testing.assert_array_equal(ds.time.values, [start + day, start + 2 * day])
+    np.testing.assert_allclose(ds["u10"].values[:, 0, 0], [4.56, 7.89])
+    assert not list(store.glob("*.PART"))
+
+
+def test_migrate_merged_file(settings, tmp_path):
+    """
+    Test that the time steps of the merged file of earlier versions are moved into the stores of the regions
+    """
+    settings.ICON_ENCODING = "int16"
+    settings.ICON_REGIONS = {"central": (11.0, 12.0, 35.0, 36.0)}
+    start = np.datetime64("2026-10-17T00", "h")
+    times = [start, start + np.timedelta64(1, "h")]
+    icon_time_steps(times, 2.5).to_netcdf(tmp_path / "icon.nc", encoding=utils._icon_encoding())
+    utils._migrate_merged_file(str(tmp_path / "icon"))
+    assert not (tmp_path / "icon.nc").exists()
+    ds = read_store(tmp_path / "icon" / "central")
+    np.testing.assert_array_equal(ds.time.values, times)
+    assert ds.longitude.values.tolist() == [11.0, 12.0]
+    np.testing.assert_allclose(ds["u10"].values, 2.5)
+    # Without a merged file, nothing happens
+    utils._migrate_merged_file(str(tmp_path / "icon"))
+    assert len(list((tmp_path / "icon" / "central").glob("*.nc"))) == 2
+
+
+def write_grib(path, short_name, step, value):
+    """
+    Write a GRIB2 file with a constant wind component of an ICON-EU run on a small regular grid
+    """
+    eccodes = pytest.importorskip("eccodes")
+    message = eccodes.codes_grib_new_from_samples("regular_ll_sfc_grib2")
+    for key, value_of_key in (
+        ("Ni", 4),
+        ("Nj", 3),
+        ("latitudeOfFirstGridPointInDegrees", 36.0),
+        ("longitudeOfFirstGridPointInDegrees", 10.0),
+        ("latitudeOfLastGridPointInDegrees", 34.0),
+        ("longitudeOfLastGridPointInDegrees", 13.0),
+        ("iDirectionIncrementInDegrees", 1.0),
+        ("jDirectionIncrementInDegrees", 1.0),
+        ("dataDate", 20261017),
+        ("dataTime", 0),
+        ("step", step),
+    ):
+        eccodes.codes_set(message, key, value_of_key)
+    eccodes.codes_set_string(message, "shortName", short_name)
+    eccodes.codes_set_values(message, np.full(12, value))
+    with open(path, "wb") as fp:
+        eccodes.codes_write(message, fp)
+    eccodes.codes_release(message)
+
+
+@pytest.mark.django_db
+def test_download_and_merge(settings, tmp_path, monkeypatch):
+    """
+    Test that the U and V files of each time step are paired, decoded and stored together
+    """
+    pytest.importorskip("cfgrib")
+    settings.ICON_REGIONS = {}
+    settings.ICON_ENCODING = "int16"
+    source = tmp_path / "source"
+    source.mkdir()
+    modified = datetime(2026, 10, 17, 3, tzinfo=timezone.utc)
+    listing = {"u_10m": {}, "v_10m": {}}
+    for step, wind in ((1, (3.0, -2.0)), (2, (5.0, -4.0))):
+        for component, short_name, value in zip(("U", "V"), ("10u", "10v"), wind):
+            name = f"icon-eu_europe_regular-lat-lon_single-level_2026101700_{step:03d}_{component}_10M.grib2"
+            write_grib(source / name, short_name, step, value)
+            listing[f"{component.lower()}_10m"][f"{name}.bz2"] = (modified, 100)
+
+    def download(url, dest_path):
+        shutil.copy(source / url.rsplit("/", 1)[1].removesuffix(".bz2"), dest_path)
+        return dest_path, 100, 100, 0.0
+
+    monkeypatch.setattr(utils, "_list_bz2_files", lambda url: listing[url.rstrip("/").rsplit("/", 1)[1]])
+    monkeypatch.setattr(utils, "_download_and_decompress", download)
+    written = utils.download_and_merge("00", max_workers=4, output_file=str(tmp_path / "icon"))
+    assert len(written) == 2
+    ds = read_store(tmp_path / "icon")
+    np.testing.assert_array_equal(ds.time.values, np.array(["2026-10-17T01", "2026-10-17T02"], dtype="datetime64[ns]"))
+    np.testing.assert_allclose(ds["u10"].values, np.array([3.0, 5.0])[:, None, None] * np.ones((1, 3, 4)))
+    np.testing.assert_allclose(ds["v10"].values, np.array([-2.0, -4.0])[:, None, None] * np.ones((1, 3, 4)))
+    assert ds["u10"].attrs["standard_name"] == "x_wind"
+    assert ds["v10"].attrs["standard_name"] == "y_wind"
+    # The files of the run are known now, so nothing is downloaded again
+    assert IconFiles.objects.filter(frt="00").count() == 4
+    assert utils.download_and_merge("00", max_workers=4, output_file=str(tmp_path / "icon")) is None
@@ -0,0 +1,90 @@
+import pytest
+from django.contrib.auth import get_user_model
+from django.contrib.messages import get_messages
+from django.urls import reverse
+from django.utils import timezone
+
+from opendrift_leeway_webgui.leeway.models import LeewaySimulation
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize("started", [False, True])
+def test_cancel(client, settings, tmp_path, revoked, started):
+    """
+    Test that users can cancel their queued and running simulations
+    """
+    settings.SIMULATION_RUNNER = "fake"
+    settings.SIMULATION_QUEUE = str(tmp_path)
+    user = get_user_model().objects.create(username="user")
+    simulation = LeewaySimulation.objects.create(
+        user=user, longitude=12.6, latitude=35.4, simulation_started=timezone.now() if started else None
+    )
+    client.force_login(user)
+    response = client.post(reverse("simulation_cancel", kwargs={"pk": simulation.pk}))
+    assert response.status_code == 302
+    assert response.headers["Location"] == reverse("simulation_list")
+    assert "was cancelled" in str(next(iter(get_messages(response.wsgi_request))))
+    simulation.refresh_from_db()
+    assert simulation.status == "cancelled"
+    assert revoked == [str(simulation.uuid)]
+
+
+@pytest.mark.django_db
+def test_cancel_finished(client, revoked):
+    """
+    Test that finished simulations can't be cancelled
+    """
+    user = get_user_model().objects.create(username="user")
+    simulation = LeewaySimulation.objects.create(
+        user=user, longitude=12.6, latitude=35.4, simulation_finished=timezone.now()
+    )
+    client.force_login(user)
+    response = client.post(reverse("simulation_cancel", kwargs={"pk": simulation.pk}))
+    assert response.status_code == 302
+    assert "already finished" in str(next(iter(get_messages(response.wsgi_request))))
+    simulation.refresh_from_db()
+    assert simulation.status == "finished"
+    assert not revoked
+
+
+@pytest.mark.django_db
+def test_cancel_permissions(client, revoked):
+    """
+    Test that only the owner of a simulation can cancel it
+    """
+    owner = get_user_model().objects.create(username="owner")
+    simulation = LeewaySimulation.objects.create(user=owner, longitude=12.6, latitude=35.4)
+    url = reverse("simulation_cancel", kwargs={"pk": simulation.pk})
+    response = client.post(url)
+    assert response.status_code == 302
+    assert response.headers["Location"].startswith(reverse("login"))
+    client.force_login(get_user_model().objects.create(username="other"))
+    assert client.post(url).status_code == 404
+    simulation.refresh_from_db()
+    assert simulation.status == "queued"
+    assert not revoked
+
+
+@pytest.mark.django_db
+def test_simulation_file_profile(client, settings, tmp_path):
+    """
+    Test that profiles are only served to staff, but for the simulations of all users
+    """
+    settings.SIMULATION_OUTPUT = str(tmp_path)
+    owner = get_user_model().objects.create(username="owner")
+    simulation = LeewaySimulation.objects.create(user=owner, longitude=12.6, latitude=35.4)
+    (tmp_path / f"{simulation.uuid}.prof").write_bytes(b"profile")
+    (tmp_path / f"{simulation.uuid}.png").write_bytes(b"image")
+    profile = reverse("simulation_file", kwargs={"path": f"{simulation.uuid}.prof"})
+    image = reverse("simulation_file", kwargs={"path": f"{simulation.uuid}.png"})
+    client.force_login(owner)
+    assert client.get(profile).status_code == 403
+    response = client.get(image)
+    assert response.status_code == 200
+    assert b"".join(response.streaming_content) == b"image"
+    client.force_login(get_user_model().objects.create(username="staff", is_staff=True))
+    response = client.get(profile)
+    assert response.status_code == 200
+    assert b"".join(response.streaming_content) == b"profile"
+    # Staff can't access the other results of other users
+    assert client.get(image).status_code == 403